@@ -1,14 +1,45 @@
 import os
+import time
+from datetime import datetime
 
-from flask import (Flask, render_template, request,
-                   flash, redirect, session, g)
+from flask import (Flask, render_template, request, flash, redirect,
+                   session, g, abort, jsonify, Response, stream_with_context,
+                   send_from_directory)
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_wtf.csrf import CSRFProtect
 from sqlalchemy.exc import IntegrityError
-
-from forms import (UserAddForm, LoginForm, MessageForm, UserEditForm,
-                   LogoutForm, LikeMessageForm, DeleteUserForm)
-from models import (db, connect_db, User, Message, Like, DEFAULT_IMAGE_URL,
-                    DEFAULT_HEADER_IMAGE_URL)
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
+from models import (db, connect_db, User, Message, Like, RenumberedMessage,
+                    DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
+from archive import archive_cli, find_archived_message
+import blocks
+from compression import Compressor
+from dtos import JSONEncoder, UserDTO, MessageDTO
+from export import export_cli
+from follows import follows_cli, follow_many, unfollow_many, BatchTooLarge
+import geo
+from geo import geo_cli
+import images
+from images import images_cli, refresh_user_images
+from jobs import enqueue, jobs_cli
+from likebuffer import like_buffer
+from live import broker, format_event
+from migrations import migrate_cli, LEGACY_ID_LIMIT
+from pagecache import page_cache
+import notifications
+from purge import purge_deleted_users_command
+from ratelimit import RateLimiter, by_ip
+import readmodels
+import rollups
+from rollups import rollups_cli
+from shards import shards
+import snowflake
+import tags
+from tags import tags_cli
+import trending
+from usernames import username_filter
 
 CURR_USER_KEY = "curr_user"
 
@@ -22,11 +53,69 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+app.config['JSON_SORT_KEYS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# Share rate-limit buckets between nodes, e.g. redis://localhost:6379/0
+app.config['RATELIMIT_STORAGE_URL'] = os.environ.get('RATELIMIT_STORAGE_URL')
+# Broadcast new messages to live timelines on every node, e.g. redis://...
+app.config['LIVE_BROADCAST_URL'] = os.environ.get('LIVE_BROADCAST_URL')
+# Live timeline requests a process lets wait at once; keep it well below
+# gunicorn's --threads (see Procfile and live.py)
+app.config['LIVE_MAX_WAITING'] = int(os.environ.get('LIVE_MAX_WAITING', 4))
+# Where resized profile images are kept; defaults to instance/images
+app.config['IMAGE_CACHE_DIR'] = os.environ.get('IMAGE_CACHE_DIR')
+# Comma-separated databases to spread messages and likes over; see shards.py
+app.config['SHARD_DATABASE_URIS'] = os.environ.get('SHARD_DATABASE_URIS')
+# Fixes this process's message id worker (0-1023); see snowflake.py
+app.config['SNOWFLAKE_WORKER_ID'] = os.environ.get('SNOWFLAKE_WORKER_ID')
+# Buffer likes and write them in batches; see likebuffer.py
+app.config['LIKES_WRITE_BEHIND'] = bool(os.environ.get('LIKES_WRITE_BEHIND'))
+# Share buffered likes between processes and nodes, e.g.
+# redis://localhost:6379/0; needed with more than one web process
+app.config['LIKES_BUFFER_URL'] = os.environ.get('LIKES_BUFFER_URL')
+# Web processes per node, as gunicorn (and Heroku) read it
+app.config['WEB_CONCURRENCY'] = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Share cached profile and message pages between processes and nodes;
+# needed with more than one web process, see pagecache.py
+app.config['PAGE_CACHE_URL'] = os.environ.get('PAGE_CACHE_URL')
+# Proxies in front of the app whose X-Forwarded-For is trusted for the
+# client's address, e.g. by rate limits: 1 for Heroku's router, 0 when
+# clients connect directly
+app.config['PROXY_COUNT'] = int(os.environ.get('PROXY_COUNT', 1))
+app.json_encoder = JSONEncoder
+if app.config['PROXY_COUNT']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'])
 toolbar = DebugToolbarExtension(app)
+# checks the token of every POST, whether sent as a form field or, by
+# static/script.js, in an X-CSRFToken header; pages carry one token, in
+# a meta tag (see base.html)
+csrf = CSRFProtect(app)
+# logged-in users' pages carry their CSRF token; see compression.py
+Compressor(app, is_private=lambda: g.get('user') is not None)
+limiter = RateLimiter(app)
+broker.init_app(app)
+shards.init_app(app)
+snowflake.generator.init_app(app)
+username_filter.init_app(app)
+like_buffer.init_app(app)
+page_cache.init_app(app)
 
 connect_db(app)
 
+app.cli.add_command(archive_cli)
+app.cli.add_command(export_cli)
+app.cli.add_command(follows_cli)
+app.cli.add_command(geo_cli)
+app.cli.add_command(images_cli)
+app.cli.add_command(jobs_cli)
+app.cli.add_command(migrate_cli)
+app.cli.add_command(purge_deleted_users_command)
+app.cli.add_command(rollups_cli)
+app.cli.add_command(tags_cli)
+
+app.add_template_filter(tags.link_tags)
+
 ##############################################################################
 # User signup/login/logout
 
@@ -35,14 +124,11 @@ connect_db(app)
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-        g.logout_form = LogoutForm()
-        g.like_form = LikeMessageForm()
-        g.delete_user_form = DeleteUserForm()
+    g.user = None
 
-    else:
-        g.user = None
+    if CURR_USER_KEY in session:
+        # a deleted account is treated as logged out
+        g.user = User.active().filter_by(id=session[CURR_USER_KEY]).first()
 
 
 def do_login(user):
@@ -58,6 +144,7 @@ def do_logout():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@limiter.limit("5/minute", key=by_ip)
 def signup():
     """Handle user signup.
 
@@ -72,6 +159,12 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # turn duplicates away before hashing the password; the unique
+        # constraints still catch a race between two signups
+        if username_filter.is_taken(form.username.data, form.email.data):
+            flash("Username/Email already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -79,6 +172,8 @@ def signup():
                 email=form.email.data,
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
+            db.session.flush()
+            refresh_user_images(user)
             db.session.commit()
 
         except IntegrityError:
@@ -98,6 +193,7 @@ class DefaultValueForLogin(object):
     password = "demopassword"
 
 @app.route('/login', methods=["GET", "POST"])
+@limiter.limit("10/minute", key=by_ip)
 def login():
     """Handle user login."""
     
@@ -105,8 +201,10 @@ def login():
     form = LoginForm(obj=default_value)
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        # no query for a username nobody has
+        user = (username_filter.might_exist(form.username.data)
+                and User.authenticate(form.username.data,
+                                      form.password.data))
 
         if user:
             do_login(user)
@@ -126,7 +224,8 @@ def logout():
         flash("No user logged in.", "danger")
         return redirect("/login")
 
-    if g.logout_form.validate_on_submit():
+    # CSRFProtect has checked the token of a POST
+    if request.method == 'POST':
         do_logout()
         flash("You have successfully logged out", "success")
 
@@ -145,21 +244,117 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    return render_template('users/index.html',
+                           cards=readmodels.user_cards(search, viewer_id()),
+                           following_ids=current_following_ids())
+
+
+def current_following_ids():
+    """Ids of the users the logged-in user follows (empty if logged out)."""
+
+    return readmodels.following_ids(g.user.id) if g.user else set()
+
+
+def profile_user_or_404(user_id):
+    """The active user `user_id`, and how the logged-in user stands with
+    them (a `readmodels.Relation`; None if logged out or the same user).
+
+    404 if they blocked the logged-in user.
+    """
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+
+    relation = None
+    if g.user and g.user.id != user.id:
+        relation = readmodels.relation(g.user.id, user.id)
+        if relation.blocked_by:
+            abort(404)
+
+    return user, relation
+
+
+def render_user_detail(template, user, relation, **context):
+    """Render a page extending users/detail.html for `user`, as seen by a
+    viewer with `relation` to them (see `profile_user_or_404()`)."""
+
+    return render_template(template,
+                           user=user,
+                           relation=relation,
+                           counts=readmodels.user_counts(user.id),
+                           following_ids=current_following_ids(),
+                           **context)
+
+
+def viewer_id():
+    """Id of the logged-in user, or None."""
+
+    return g.user.id if g.user else None
 
-    return render_template('users/index.html', users=users)
+
+@app.route('/users/nearby')
+def users_nearby():
+    """Show users near the logged-in user's location, nearest first.
+
+    Can take a 'radius' param in querystring, in km: one of geo.RADII.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    radius = request.args.get('radius', geo.DEFAULT_RADIUS, type=int)
+    if radius not in geo.RADII:
+        radius = geo.DEFAULT_RADIUS
+
+    cards = []
+    if g.user.geohash is not None:
+        cards = readmodels.nearby_cards(g.user.id, g.user.latitude,
+                                        g.user.longitude, radius)
+
+    return render_template('users/nearby.html',
+                           cards=cards,
+                           radius=radius,
+                           radii=geo.RADII,
+                           following_ids=current_following_ids())
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    What every viewer sees alike is cached (see pagecache.py); the
+    viewer's likes and relation to the user are read for each request.
+
+    Can take a 'before' message id in querystring, to show older messages;
+    those pages are not cached.
+    """
 
-    user = User.query.get_or_404(user_id)
+    page = page_cache.get(f"user:{user_id}",
+                          lambda: readmodels.profile_page(user_id))
+    if page is None:
+        abort(404)
+
+    relation = None
+    if g.user and g.user.id != user_id:
+        relation = readmodels.relation(g.user.id, user_id)
+        if relation.blocked_by:
+            abort(404)
+
+    before = request.args.get('before', type=int)
+    if before is None:
+        messages = readmodels.as_seen_by(page.messages, viewer_id())
+        before = page.before
+    else:
+        messages, before = readmodels.user_timeline(user_id, viewer_id(),
+                                                    before)
 
-    return render_template('users/show.html', user=user)
+    return render_template('users/show.html',
+                           user=page.user,
+                           relation=relation,
+                           counts=page.counts,
+                           following_ids=current_following_ids(),
+                           messages=messages,
+                           before=before)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -170,8 +365,11 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user, relation = profile_user_or_404(user_id)
+    return render_user_detail('users/following.html',
+                              user,
+                              relation,
+                              cards=readmodels.following_cards(user.id))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -182,11 +380,15 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user, relation = profile_user_or_404(user_id)
+    return render_user_detail('users/followers.html',
+                              user,
+                              relation,
+                              cards=readmodels.follower_cards(user.id))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@limiter.limit("60/minute")
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -194,9 +396,16 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = User.active().filter_by(id=follow_id).first_or_404()
+    if blocks.between(g.user.id, followed_user.id):
+        flash("You can't follow this user.", "danger")
+        return redirect(request.referrer)
+
+    user_ids = (g.user.id, followed_user.id)
     g.user.following.append(followed_user)
+    notifications.notify_follows(g.user.id, [followed_user.id])
     db.session.commit()
+    page_cache.forget_users(*user_ids)
 
     return redirect(request.referrer)
 
@@ -209,20 +418,115 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    user_ids = (g.user.id, follow_id)
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
     db.session.commit()
+    page_cache.forget_users(*user_ids)
+
+    return redirect(request.referrer)
+
+
+@app.route('/users/block/<int:user_id>', methods=['POST'])
+@limiter.limit("60/minute")
+def block_user(user_id):
+    """Have the currently-logged-in user block this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    if user.id == g.user.id:
+        abort(400)
+
+    user_ids = (g.user.id, user.id)
+    blocks.block(*user_ids)
+    # blocking unfollowed them both ways
+    page_cache.forget_users(*user_ids)
+    flash(f"You blocked @{user.username}.", "success")
+
+    return redirect(request.referrer)
+
+
+@app.route('/users/unblock/<int:user_id>', methods=['POST'])
+def unblock_user(user_id):
+    """Have the currently-logged-in user unblock this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    blocks.unblock(g.user.id, user_id)
+
+    return redirect(request.referrer)
+
+
+@app.route('/users/mute/<int:user_id>', methods=['POST'])
+@limiter.limit("60/minute")
+def mute_user(user_id):
+    """Have the currently-logged-in user mute this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    if user.id == g.user.id:
+        abort(400)
+
+    blocks.mute(g.user.id, user.id)
+
+    return redirect(request.referrer)
+
+
+@app.route('/users/unmute/<int:user_id>', methods=['POST'])
+def unmute_user(user_id):
+    """Have the currently-logged-in user unmute this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    blocks.unmute(g.user.id, user_id)
 
     return redirect(request.referrer)
 
 
 @app.route('/users/<int:user_id>/likes')
 def show_liked_warbles(user_id):
-    """Renders page which lists all warbles liked by user """
+    """Renders page which lists warbles liked by user, newest first.
+
+    Can take a 'before' message id in querystring, to show older ones.
+    """
+
+    user, relation = profile_user_or_404(user_id)
+    messages, before = readmodels.liked_timeline(
+        user.id, viewer_id(), request.args.get('before', type=int))
 
-    user = User.query.get_or_404(user_id)
+    return render_user_detail("users/likes.html",
+                              user,
+                              relation,
+                              messages=messages,
+                              before=before)
 
-    return render_template("users/likes.html", user=user)
+
+@app.route('/users/<int:user_id>/mentions')
+def show_mentions(user_id):
+    """Show messages mentioning a user, newest first.
+
+    Can take a 'before' message id in querystring, to show older ones.
+    """
+
+    user, relation = profile_user_or_404(user_id)
+    messages, before = readmodels.mentions_timeline(
+        user.id, viewer_id(), request.args.get('before', type=int))
+
+    return render_user_detail("users/mentions.html",
+                              user,
+                              relation,
+                              messages=messages,
+                              before=before)
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -240,6 +544,9 @@ def profile():
             flash("Profile update unsuccessful.", "danger")
             return render_template("users/edit.html", form=form)
 
+        old_images = (g.user.image_url, g.user.header_image_url)
+        old_location = g.user.location
+
         g.user.username = form.username.data
         g.user.email = form.email.data
         g.user.image_url = (form.image_url.data
@@ -249,7 +556,13 @@ def profile():
         g.user.bio = form.bio.data
         g.user.location = form.location.data
 
+        if (g.user.image_url, g.user.header_image_url) != old_images:
+            refresh_user_images(g.user)
+        if g.user.location != old_location:
+            geo.location_changed(g.user)
+
         db.session.commit()
+        page_cache.forget_users(g.user.id)
         flash(f"{g.user.username}'s information has been successfully updated",
               "success")
 
@@ -268,9 +581,12 @@ def delete_user():
 
     do_logout()
 
-    if g.delete_user_form.validate_on_submit():
-        db.session.delete(g.user)
-        db.session.commit()
+    # hide the account now; a background job reclaims its rows
+    g.user.deleted_at = datetime.utcnow()
+    enqueue('purge_user', dedup_key=f"purge_user:{g.user.id}",
+            user_id=g.user.id)
+    db.session.commit()
+    page_cache.forget_users(g.user.id)
 
     return redirect("/signup")
 
@@ -279,6 +595,7 @@ def delete_user():
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@limiter.limit("10/minute")
 def messages_add():
     """Add a message:
 
@@ -292,9 +609,14 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        session = shards.add_message(msg)
+        tags.index_message(session, msg)
+        trending.record_message(msg)
+        shards.commit()
+        page_cache.forget_users(g.user.id)
+
+        broker.publish(g.user.id, msg.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -303,10 +625,39 @@ def messages_add():
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message. Cached, like users_show()."""
+
+    page = page_cache.get(f"message:{message_id}",
+                          lambda: load_message_page(message_id))
+    if page is None:
+        # a link from before messages had snowflake ids
+        renumbered = (RenumberedMessage.query.get(message_id)
+                      if message_id < LEGACY_ID_LIMIT else None)
+        if renumbered is None:
+            abort(404)
+        return redirect(f"/messages/{renumbered.new_id}", 301)
+
+    return render_template('messages/show.html',
+                           message=page.message,
+                           user=page.user,
+                           following_ids=current_following_ids())
+
+
+def load_message_page(message_id):
+    """The `readmodels.MessagePage` of `message_id`, or None if there is
+    no such message or its author deleted their account."""
+
+    session, msg = shards.find_message(message_id)
+    if msg is None:
+        session, msg = find_archived_message(message_id)
+    if msg is None:
+        return None
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    user = readmodels.profile(msg.user_id)
+    if user is None:
+        return None
+
+    return readmodels.MessagePage(MessageDTO.from_model(msg), user)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -317,35 +668,99 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
-    db.session.commit()
+    session, msg = shards.find_message(message_id, write=True)
+    if msg is None:
+        session, msg = find_archived_message(message_id)
+    if msg is None:
+        abort(404)
+
+    session.delete(msg)
+    tags.forget_messages(session, [message_id])
+    trending.forget_message(message_id)
+    shards.commit()
+    page_cache.forget(f"message:{message_id}")
+    page_cache.forget_users(msg.user_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
 @app.route('/messages/<int:message_id>/like', methods=['POST'])
+@limiter.limit("120/minute")
 def messages_like_toggle(message_id):
-    """Like/unlike a message."""
+    """Like/unlike a message.
+
+    With JSON {"liked": true or false}, as static/script.js sends, the
+    message ends up liked or not whatever it was; otherwise the like is
+    toggled.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    like = Like.query.filter_by(message_id=message_id,
-                                user_id=g.user.id).one_or_none()
+    data = request.get_json(silent=True)
+    liked = data.get('liked') if isinstance(data, dict) else None
+    if not isinstance(liked, bool):
+        liked = None
+
+    # likes are kept with the message they are on
+    session, msg = shards.find_message(message_id, write=True)
+    if msg is None or blocks.between(g.user.id, msg.user_id):
+        abort(404)
+
+    if like_buffer.enabled:
+        # written, with others', by the next flush
+        like_buffer.toggle(session, msg, g.user.id, liked)
+        return redirect(request.referrer)
+
+    like = (session
+            .query(Like)
+            .filter_by(message_id=message_id, user_id=g.user.id)
+            .one_or_none())
+
+    if liked is not None and liked == bool(like):
+        return redirect(request.referrer)
 
     if like:
-        db.session.delete(like)
+        session.delete(like)
     else:
-        new_like = Like(message_id=message_id, user_id=g.user.id)
-        db.session.add(new_like)
+        session.add(Like(message_id=message_id, user_id=g.user.id))
+        notifications.notify_like(msg, g.user.id)
 
-    db.session.commit()
+    user_id = g.user.id
+    trending.record_like(msg, liked=not like,
+                         liked_at=like.created_at if like else None)
+    shards.commit()
+    page_cache.forget_users(user_id)
 
     return redirect(request.referrer)
 
 
+##############################################################################
+# Notifications (see notifications.py)
+
+
+@app.route('/notifications')
+def show_notifications():
+    """Show the current user's notifications, newest first, and mark them
+    read.
+
+    Can take a 'before' notification id in querystring, to show older ones.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    items, before = notifications.page(g.user.id,
+                                       request.args.get('before', type=int))
+
+    notifications.mark_read(g.user)
+    db.session.commit()
+
+    return render_template('notifications.html', items=items, before=before)
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -359,21 +774,294 @@ def homepage():
     """
 
     if g.user:
-        ids_of_following = [user.id for user in g.user.following] + [g.user.id]
+        # anything posted after this render has a higher id; live updates
+        # continue from here
+        cursor = shards.last_message_id()
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(ids_of_following))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages = readmodels.timeline(timeline_user_ids(g.user), g.user.id)
 
-        return render_template('home.html', messages=messages)
+        return render_template('home.html',
+                               messages=messages,
+                               counts=readmodels.user_counts(g.user.id),
+                               cursor=cursor)
 
     else:
         return render_template('home-anon.html')
 
 
+def timeline_user_ids(user):
+    """Ids of the users whose messages are on `user`'s timeline (not
+    those they muted or blocked; see blocks.py)."""
+
+    return readmodels.timeline_author_ids(user.id)
+
+
+##############################################################################
+# Live timeline updates
+#
+# Both endpoints take an 'after' message id (the cursor) and return the
+# timeline messages posted since, rendered as in home.html, oldest first.
+# Streams are capped at LIVE_STREAM_SECONDS so they don't hold a server
+# thread forever; EventSource reconnects by itself, sending Last-Event-ID.
+# Only LIVE_MAX_WAITING requests of a process wait at once (see live.py);
+# the rest get what is new and come back in LIVE_RETRY_SECONDS.
+
+LIVE_STREAM_SECONDS = 300
+LIVE_HEARTBEAT_SECONDS = 15
+LIVE_POLL_SECONDS = 25
+LIVE_RETRY_SECONDS = 10
+
+
+def render_timeline_items(messages):
+    """Timeline items as {id, message, html} dicts for the live endpoints.
+    Ids are strings, as in every JSON payload (see dtos.py)."""
+
+    return [{'id': str(msg.id),
+             'message': msg,
+             'html': render_template('messages/_item.html', msg=msg)}
+            for msg in messages]
+
+
+@app.route('/timeline/stream')
+def timeline_stream():
+    """Stream new timeline messages as server-sent events."""
+
+    if not g.user:
+        abort(401)
+
+    after = (request.args.get('after', type=int)
+             or request.headers.get('Last-Event-ID', type=int)
+             or 0)
+    user_id = g.user.id
+    user_ids = timeline_user_ids(g.user)
+
+    # subscribe before the first read so nothing posted in between is missed
+    subscription = broker.subscribe(user_ids)
+
+    @stream_with_context
+    def events():
+        cursor = after
+        deadline = time.monotonic() + LIVE_STREAM_SECONDS
+
+        with subscription, broker.waiting() as may_wait:
+            while True:
+                messages = readmodels.timeline_since(user_ids, cursor, user_id)
+                for item in render_timeline_items(messages):
+                    yield format_event(item['id'], item)
+                if messages:
+                    cursor = messages[-1].id
+
+                if not may_wait:
+                    # EventSource reconnects after this long
+                    yield f"retry: {LIVE_RETRY_SECONDS * 1000}\n\n"
+                    return
+                if time.monotonic() >= deadline:
+                    return
+
+                # end the transactions so the stream holds no connections
+                db.session.commit()
+                shards.remove()
+
+                if not subscription.wait(timeout=LIVE_HEARTBEAT_SECONDS):
+                    yield ": keep-alive\n\n"
+
+    response = Response(events(),
+                        mimetype='text/event-stream',
+                        headers={'X-Accel-Buffering': 'no'})
+    # a client gone before the first event closes the stream without ever
+    # running events(), so its `with` can't be what unsubscribes
+    response.call_on_close(subscription.close)
+    return response
+
+
+@app.route('/timeline/poll')
+def timeline_poll():
+    """Long-poll fallback: wait for new timeline messages, return as JSON."""
+
+    if not g.user:
+        abort(401)
+
+    after = request.args.get('after', 0, type=int)
+    user_ids = timeline_user_ids(g.user)
+
+    retry_after = None
+
+    with broker.subscribe(user_ids) as subscription, \
+            broker.waiting() as may_wait:
+        messages = readmodels.timeline_since(user_ids, after, g.user.id)
+
+        if not messages and not may_wait:
+            retry_after = LIVE_RETRY_SECONDS
+        elif not messages:
+            db.session.commit()
+            shards.remove()
+            if subscription.wait(timeout=LIVE_POLL_SECONDS):
+                messages = readmodels.timeline_since(user_ids, after,
+                                                     g.user.id)
+
+    items = render_timeline_items(messages)
+    cursor = items[-1]['id'] if items else str(after)
+
+    return jsonify(messages=items, cursor=cursor, retry_after=retry_after)
+
+
+##############################################################################
+# JSON API
+
+
+@app.route('/api/users/<int:user_id>')
+def api_users_show(user_id):
+    """Return a user's public profile as JSON."""
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    return jsonify(user=UserDTO.from_model(user))
+
+
+@app.route('/api/username-available')
+@limiter.limit("60/minute", key=by_ip, methods=('GET',))
+def api_username_available():
+    """Return whether ?username= is free to sign up with, as JSON."""
+
+    username = request.args.get('username', '').strip()
+    if not username:
+        return jsonify(error="Expected ?username="), 400
+
+    taken = username_filter.is_taken(username=username)
+    return jsonify(username=username, available=not taken)
+
+
+@app.route('/api/following', methods=['POST', 'DELETE'])
+@limiter.limit("10/minute", methods=('POST', 'DELETE'))
+def api_following():
+    """Follow (POST) or unfollow (DELETE) many users at once.
+
+    Takes JSON {"users": [...]} of user ids and/or usernames, at most
+    follows.MAX_BATCH of them, and returns a result for each.
+    """
+
+    if not g.user:
+        abort(401)
+
+    # JSON only: a cross-site form can't send it without a CORS preflight
+    data = request.get_json(silent=True)
+    refs = data.get('users') if isinstance(data, dict) else None
+
+    if not isinstance(refs, list) or not all(
+            isinstance(ref, (int, str)) and not isinstance(ref, bool)
+            for ref in refs):
+        return jsonify(error='Expected {"users": [ids or usernames]}'), 400
+
+    apply = follow_many if request.method == 'POST' else unfollow_many
+
+    try:
+        results = apply(g.user.id, refs)
+    except BatchTooLarge as exc:
+        return jsonify(error=str(exc)), 413
+
+    changed = [result['user_id'] for result in results
+               if result['status'] in ('followed', 'unfollowed')]
+    if changed:
+        page_cache.forget_users(g.user.id, *changed)
+
+    return jsonify(results=results)
+
+
+@app.route('/api/messages/<int:message_id>')
+def api_messages_show(message_id):
+    """Return a message and its author as JSON."""
+
+    session, msg = shards.find_message(message_id)
+    if msg is None:
+        abort(404)
+
+    user = User.active().filter_by(id=msg.user_id).first_or_404()
+
+    return jsonify(message=MessageDTO.from_model(msg),
+                   user=UserDTO.from_model(user))
+
+
+@app.route('/api/stats')
+@limiter.limit("60/minute", key=by_ip, methods=('GET',))
+def api_stats():
+    """Return activity per day over the last ?days= days rolled up, and
+    the users with the most ?by= (default: followers gained) over them,
+    as JSON. Reads only the rollups (see rollups.py)."""
+
+    days = request.args.get('days', 7, type=int)
+    by = request.args.get('by', 'followers_gained')
+    if not 1 <= days <= 366 or by not in rollups.USER_COUNTS:
+        return jsonify(error="Expected ?days= from 1 to 366 and ?by= one "
+                             f"of {', '.join(rollups.USER_COUNTS)}"), 400
+
+    through = rollups.last_day()
+    if through is None:
+        return jsonify(through=None, days=[], top_users=[])
+
+    return jsonify(through=through,
+                   days=rollups.daily_stats(days, through),
+                   top_users=rollups.top_users(days, through, by))
+
+
+##############################################################################
+# Trending
+
+
+@app.route('/trending')
+def show_trending():
+    """Show the hottest messages and most active users.
+
+    Can take a 'window' param in querystring: one of 1h, 24h (default), 7d.
+    """
+
+    window = request.args.get('window', trending.DEFAULT_WINDOW)
+    if window not in trending.WINDOWS:
+        window = trending.DEFAULT_WINDOW
+
+    return render_template('trending.html',
+                           window=window,
+                           windows=trending.WINDOWS,
+                           messages=trending.top_messages(window),
+                           users=trending.top_users(window))
+
+
+@app.route('/tags/<tag>')
+def show_tag(tag):
+    """Show messages using a hashtag, newest first.
+
+    Can take a 'before' message id in querystring, to show older ones.
+    """
+
+    tag = tag.lower()
+    messages, before = readmodels.tag_timeline(
+        tag, viewer_id(), request.args.get('before', type=int))
+
+    return render_template('tags/show.html',
+                           tag=tag,
+                           messages=messages,
+                           before=before)
+
+
+##############################################################################
+# Resized profile images (see images.py)
+
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+@app.route('/images/<filename>')
+def cached_image(filename):
+    """Serve a resized profile image.
+
+    File names are content hashes, so a file never changes once written
+    and may be cached for good.
+    """
+
+    response = send_from_directory(images.cache_dir(), filename,
+                                   cache_timeout=IMAGE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -386,5 +1074,6 @@ def add_header(response):
     """Add non-caching headers on every request."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if not response.cache_control.immutable:
+        response.cache_control.no_store = True
     return response
@@ -0,0 +1,350 @@
+"""Monthly partitions of messages and likes, and cold storage for old
+messages.
+
+On Postgres (12 or later), `flask migrate partition-messages` turns
+`messages` and `likes` into tables partitioned by month, as ranges of
+message id: ids are time-ordered (see snowflake.py), so the ids that
+`snowflake.from_datetime()` gives for the first of two months bound every
+message posted in between, and a like goes in the partition of the
+message it is on. Message queries filter and order by id, so Postgres only
+reads the partitions that can match: one for `/messages/<id>`, the newest
+few for timelines (see `readmodels.timeline()`). There is no default
+partition, so a message can only be posted once its month's partition
+exists: `flask archive partitions` (and `flask migrate schema`) create
+the partitions for the coming PARTITIONS_AHEAD months and queue the
+`archive_partitions` job, which does the same again every day for as
+long as the worker runs.
+
+`flask archive run` moves messages older than ARCHIVE_AFTER_DAYS (365 by
+default) to `archived_messages`, and the likes on them to
+`archived_likes`. Archived messages drop out of timelines, profiles,
+counts and the tag and mention index (see tags.py), but `/messages/<id>`
+still shows them, looking in the archive only when a message isn't in
+`messages`. On partitioned databases, whole months are archived by
+detaching their partitions and attaching them to the archive tables,
+which copies no rows; elsewhere rows are moved in batches.
+"""
+
+import re
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, text
+
+import snowflake
+from jobs import job, enqueue
+from models import db, Message, Like, ArchivedMessage, ArchivedLike
+from shards import shards
+from tags import forget_messages
+
+ARCHIVE_AFTER_DAYS = 365
+
+# months of partitions kept ready beyond the current one
+PARTITIONS_AHEAD = 3
+
+# how often the `archive_partitions` job runs
+PARTITIONS_EVERY = timedelta(days=1)
+
+BATCH_SIZE = 1000
+
+# each partitioned table and the message id column it is partitioned by,
+# referenced tables first
+PARTITION_KEYS = {
+    'messages': 'id',
+    'likes': 'message_id',
+    'archived_messages': 'id',
+    'archived_likes': 'message_id',
+}
+
+ARCHIVE_TABLES = {
+    'messages': ArchivedMessage.__table__,
+    'likes': ArchivedLike.__table__,
+}
+
+archive_cli = AppGroup('archive', help="Partition and archive old messages.")
+
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def months(first, last):
+    """The first of each month from `first`'s to `last`'s."""
+
+    month = month_start(first)
+    while month <= last:
+        yield month
+        month = next_month(month)
+
+
+def id_range(month):
+    """The ids of messages posted in `month`, as [start, end)."""
+
+    return (snowflake.from_datetime(month),
+            snowflake.from_datetime(next_month(month)))
+
+
+def partition_name(table, month):
+    return f"{table}_{month:%Y_%m}"
+
+
+def _month_of(partition):
+    match = re.search(r'_(\d{4})_(\d{2})$', partition)
+    return datetime(int(match[1]), int(match[2]), 1)
+
+
+def databases():
+    """(engine, session) of every database holding messages."""
+
+    if shards.enabled:
+        return list(zip(shards.engines, shards.sessions))
+    return [(db.engine, db.session)]
+
+
+def is_partitioned(conn, table='messages'):
+    """Whether `table` is a partitioned table in the database of `conn`."""
+
+    if conn.dialect.name != 'postgresql':
+        return False
+
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+        "JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = :table AND pg_table_is_visible(c.oid))"),
+        table=table).scalar()
+
+
+def partitions(conn, table):
+    """Names of the partitions of `table`, oldest first."""
+
+    rows = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :table AND pg_table_is_visible(p.oid) "
+        "ORDER BY c.relname"),
+        table=table)
+
+    return [name for (name,) in rows]
+
+
+def create_partition(conn, table, month):
+    """Create `table`'s partition for `month`, unless it exists."""
+
+    start, end = id_range(month)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {partition_name(table, month)} "
+                 f"PARTITION OF {table} FOR VALUES FROM ({start}) TO ({end})")
+
+
+def ensure_partitions(months_ahead=PARTITIONS_AHEAD):
+    """Create the partitions of `messages` and `likes` for this month and
+    the next `months_ahead`, in every partitioned database. Returns the
+    number of partitioned databases."""
+
+    now = datetime.utcnow()
+    last = month_start(now)
+    for i in range(months_ahead):
+        last = next_month(last)
+
+    partitioned = 0
+    for engine, session in databases():
+        with engine.begin() as conn:
+            if not is_partitioned(conn):
+                continue
+
+            for month in months(now, last):
+                for table in ('messages', 'likes'):
+                    create_partition(conn, table, month)
+
+        partitioned += 1
+
+    return partitioned
+
+
+def maintain_partitions(months_ahead=PARTITIONS_AHEAD):
+    """Create the partitions for the coming months, and, if any database
+    is partitioned, queue the `archive_partitions` job to do so again
+    after PARTITIONS_EVERY. Returns the number of partitioned databases.
+    """
+
+    partitioned = ensure_partitions(months_ahead)
+    if partitioned:
+        run_at = datetime.utcnow() + PARTITIONS_EVERY
+        # one a day, however often this runs
+        enqueue('archive_partitions',
+                dedup_key=f"archive_partitions:{run_at:%Y-%m-%d}",
+                delay=PARTITIONS_EVERY)
+        db.session.commit()
+
+    return partitioned
+
+
+@job('archive_partitions')
+def partitions_job():
+    """Create the partitions for the coming months, and run again later."""
+
+    maintain_partitions()
+
+
+def archive_cutoff():
+    """Messages posted before this are archived."""
+
+    days = current_app.config.get('ARCHIVE_AFTER_DAYS', ARCHIVE_AFTER_DAYS)
+    return datetime.utcnow() - timedelta(days=days)
+
+
+def _archive_rows(session, before_id, batch_size):
+    messages, likes = Message.__table__, Like.__table__
+    archived = 0
+
+    while True:
+        ids = [id for (id,) in (session
+                                .query(Message.id)
+                                .filter(Message.id < before_id)
+                                .order_by(Message.id)
+                                .limit(batch_size))]
+        if not ids:
+            return archived
+
+        for table, criterion in ((messages, messages.c.id.in_(ids)),
+                                 (likes, likes.c.message_id.in_(ids))):
+            columns = [column.name for column in table.c]
+            session.execute(ARCHIVE_TABLES[table.name].insert().from_select(
+                columns, select([table.c[name] for name in columns])
+                .where(criterion)))
+
+        (session
+         .query(Like)
+         .filter(Like.message_id.in_(ids))
+         .delete(synchronize_session=False))
+        forget_messages(session, ids)
+        (session
+         .query(Message)
+         .filter(Message.id.in_(ids))
+         .delete(synchronize_session=False))
+        session.commit()
+
+        archived += len(ids)
+
+
+def _archive_partition(conn, month):
+    """Move `month`'s partitions of `messages` and `likes` to the archive
+    tables."""
+
+    start, end = id_range(month)
+    likes = partition_name('likes', month)
+
+    conn.execute(f"ALTER TABLE likes DETACH PARTITION {likes}")
+    # the detached likes would still reference rows leaving `messages`
+    constraints = conn.execute(text(
+        "SELECT conname FROM pg_constraint "
+        "WHERE conrelid = CAST(:table AS regclass) "
+        "AND confrelid = CAST('messages' AS regclass)"),
+        table=likes).fetchall()
+    for (constraint,) in constraints:
+        conn.execute(f'ALTER TABLE {likes} DROP CONSTRAINT "{constraint}"')
+
+    # archived messages leave the tag and mention index
+    for index in ('message_tags', 'message_mentions'):
+        conn.execute(f"DELETE FROM {index} "
+                     f"WHERE message_id >= {start} AND message_id < {end}")
+
+    conn.execute(f"ALTER TABLE messages "
+                 f"DETACH PARTITION {partition_name('messages', month)}")
+
+    # messages first: archived likes reference them
+    for table in ('messages', 'likes'):
+        partition = partition_name(table, month)
+        archive = ARCHIVE_TABLES[table].name
+        archived = partition_name(archive, month)
+
+        if archived in partitions(conn, archive):
+            # part of the month was archived before the tables were
+            # partitioned
+            columns = ', '.join(column.name
+                                for column in ARCHIVE_TABLES[table].c)
+            conn.execute(f"INSERT INTO {archive} ({columns}) "
+                         f"SELECT {columns} FROM {partition}")
+            conn.execute(f"DROP TABLE {partition}")
+        else:
+            conn.execute(f"ALTER TABLE {partition} RENAME TO {archived}")
+            conn.execute(f"ALTER TABLE {archive} ATTACH PARTITION {archived} "
+                         f"FOR VALUES FROM ({start}) TO ({end})")
+
+
+def _archive_partitions(engine, before):
+    with engine.connect() as conn:
+        old = [_month_of(name) for name in partitions(conn, 'messages')
+               if next_month(_month_of(name)) <= before]
+
+    archived = 0
+    for month in old:
+        with engine.begin() as conn:
+            archived += conn.execute(
+                f"SELECT count(*) FROM {partition_name('messages', month)}"
+            ).scalar()
+            _archive_partition(conn, month)
+
+    return archived
+
+
+def archive_messages(before=None, batch_size=BATCH_SIZE):
+    """Move messages posted before `before` (by default, `archive_cutoff()`),
+    and the likes on them, to the archive tables of every database.
+
+    Partitioned databases only archive whole months. Returns the number
+    of messages archived.
+    """
+
+    before = before or archive_cutoff()
+    archived = 0
+
+    for engine, session in databases():
+        with engine.connect() as conn:
+            partitioned = is_partitioned(conn)
+
+        if partitioned:
+            archived += _archive_partitions(engine, before)
+        else:
+            archived += _archive_rows(session,
+                                      snowflake.from_datetime(before),
+                                      batch_size)
+
+    return archived
+
+
+def find_archived_message(message_id):
+    """The archived message with `message_id` and the session it was
+    loaded in, as (session, message), or (None, None)."""
+
+    # archives aren't moved with their bucket, so look on every shard
+    for session in shards.all():
+        msg = session.query(ArchivedMessage).get(message_id)
+        if msg is not None:
+            return session, msg
+
+    return None, None
+
+
+@archive_cli.command('partitions')
+@click.option('--months-ahead', default=PARTITIONS_AHEAD, show_default=True)
+def partitions_command(months_ahead):
+    """Create message and like partitions for the coming months."""
+
+    partitioned = maintain_partitions(months_ahead)
+    click.echo(f"Partitions are ready in {partitioned} databases.")
+
+
+@archive_cli.command('run')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True)
+def run_command(batch_size):
+    """Move old messages to the archive tables."""
+
+    archived = archive_messages(batch_size=batch_size)
+    click.echo(f"Archived {archived} messages.")
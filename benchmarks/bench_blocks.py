@@ -0,0 +1,119 @@
+"""Time the timeline, likes and search reads with thousands of mutes.
+
+Run with `python -m benchmarks.bench_blocks` from the project root. On
+the seeded dataset, the most-following user likes every third message and
+then mutes MUTED_USERS accounts (a quarter of those they follow, and the
+rest newly made). Each read is timed with no mutes, with the anti-joins
+readmodels uses in the main database, and with the exclusion set it uses
+across shards, then the real pages end to end.
+"""
+
+import timeit
+
+from benchmarks.dataset import seed, most_followed_user_id
+from app import CURR_USER_KEY
+from models import db, User, Message, Like, Follows, Mutes
+import readmodels
+
+N = 50
+
+MUTED_USERS = 5000
+
+
+class ExclusionSet(readmodels._Hidden):
+    """`_Hidden` as it is with shards enabled: the hidden ids are read
+    first and excluded with NOT IN."""
+
+    def excluding(self, session, column):
+        return super().excluding(None, column)
+
+
+def add_likes(user_id):
+    message_ids = [id for (id,) in db.session.query(Message.id)]
+    db.session.bulk_insert_mappings(Like, [
+        {'user_id': user_id, 'message_id': id} for id in message_ids[::3]])
+    db.session.commit()
+
+
+def add_mutes(user_id):
+    followed = [id for (id,) in (db.session
+                                 .query(Follows.user_being_followed_id)
+                                 .filter_by(user_following_id=user_id))]
+    muted = followed[::4]
+
+    db.session.bulk_insert_mappings(User, [
+        {'username': f"muted{i}", 'email': f"muted{i}@example.com",
+         'password': "x"}
+        for i in range(MUTED_USERS - len(muted))])
+    db.session.flush()
+    muted += [id for (id,) in (db.session
+                               .query(User.id)
+                               .filter(User.username.like('muted%')))]
+
+    db.session.bulk_insert_mappings(Mutes, [
+        {'user_muting_id': user_id, 'user_being_muted_id': id}
+        for id in muted])
+    db.session.commit()
+
+
+def reads(user_id):
+    return {
+        'timeline': lambda: readmodels.timeline(
+            readmodels.timeline_author_ids(user_id), user_id),
+        'likes': lambda: readmodels.liked_timeline(user_id, user_id),
+        'search': lambda: readmodels.user_cards('a', user_id),
+    }
+
+
+def measure(read):
+    """Return seconds per call of read(), each call in a fresh session as
+    in a request."""
+
+    def once():
+        read()
+        db.session.remove()
+
+    once()
+    return timeit.timeit(once, number=N) / N
+
+
+def bench_request(app, user_id, path):
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        client.get(path)
+        return timeit.timeit(lambda: client.get(path), number=N) / N
+
+
+if __name__ == '__main__':
+    app = seed()
+    user_id = most_followed_user_id()
+
+    with app.app_context():
+        add_likes(user_id)
+        unmuted = {name: measure(read)
+                   for name, read in reads(user_id).items()}
+
+        add_mutes(user_id)
+
+        anti_join = {name: measure(read)
+                     for name, read in reads(user_id).items()}
+
+        hidden = readmodels._Hidden
+        readmodels._Hidden = ExclusionSet
+        try:
+            exclusion_set = {name: measure(read)
+                             for name, read in reads(user_id).items()}
+        finally:
+            readmodels._Hidden = hidden
+
+        print(f"{'':10} {'no mutes':>10} {'anti-join':>10} "
+              f"{'NOT IN set':>10}   ({MUTED_USERS} muted)")
+        for name in unmuted:
+            print(f"{name:10} {unmuted[name] * 1e3:7.2f} ms "
+                  f"{anti_join[name] * 1e3:7.2f} ms "
+                  f"{exclusion_set[name] * 1e3:7.2f} ms")
+
+    for path in ['/', '/users?q=a', f'/users/{user_id}/likes']:
+        seconds = bench_request(app, user_id, path)
+        print(f"GET {path:18} {seconds * 1e3:7.2f} ms")
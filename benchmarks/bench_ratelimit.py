@@ -0,0 +1,52 @@
+"""Measure the per-request overhead of rate limiting.
+
+Run with `python -m benchmarks.bench_ratelimit` from the project root.
+Times the token-bucket check on its own and the full check a limited view
+pays per request (config lookup, key, bucket), which should stay well
+under a millisecond.
+"""
+
+import os
+import timeit
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import app, limiter  # noqa: E402
+from ratelimit import MemoryStore  # noqa: E402
+
+N = 100000
+
+
+def bench_store():
+    """Time MemoryStore.take() across many keys."""
+
+    store = MemoryStore()
+    keys = [f"user:{i}" for i in range(1000)]
+
+    seconds = timeit.timeit(
+        lambda: [store.take(key, 1000000, 1000) for key in keys],
+        number=N // len(keys))
+
+    return seconds / N
+
+
+def bench_decorator():
+    """Time a no-op view called directly and through limiter.limit()."""
+
+    def view():
+        return None
+
+    limited = limiter.limit("1000000/second")(view)
+    app.config['RATELIMIT_ENABLED'] = True
+    limiter.store.reset()
+
+    with app.test_request_context('/signup', method='POST'):
+        plain = timeit.timeit(view, number=N)
+        checked = timeit.timeit(limited, number=N)
+
+    return (checked - plain) / N
+
+
+if __name__ == '__main__':
+    print(f"MemoryStore.take:          {bench_store() * 1e6:.2f} us")
+    print(f"limiter.limit() overhead:  {bench_decorator() * 1e6:.2f} us")
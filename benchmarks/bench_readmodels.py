@@ -0,0 +1,97 @@
+"""Compare ORM instances with column-only records on listing pages.
+
+Run with `python -m benchmarks.bench_readmodels` from the project root.
+For the homepage timeline and the /users listing, loads the data the page
+shows both ways — full ORM instances (as the pages used to) and
+readmodels records (as they do now) — and reports time and peak memory
+per load, then times the real pages end to end.
+"""
+
+import timeit
+import tracemalloc
+
+from benchmarks.dataset import seed, most_followed_user_id
+from app import CURR_USER_KEY
+from models import db, User, Message
+import readmodels
+
+N = 50
+
+
+def orm_timeline(user):
+    ids = [followed.id for followed in user.following] + [user.id]
+    messages = (Message
+                .query
+                .filter(Message.user_id.in_(ids))
+                .order_by(Message.id.desc())
+                .limit(100)
+                .all())
+    # what the template touched for every row
+    return [(m.id, m.text, m.timestamp, m.user.id, m.user.username,
+             m.user.image_url, m in user.messages_liked) for m in messages]
+
+
+def record_timeline(user):
+    messages = readmodels.timeline(readmodels.following_ids(user.id)
+                                   | {user.id},
+                                   user.id)
+    return [(m.id, m.text, m.timestamp, m.user_id, m.username, m.image_url,
+             m.liked) for m in messages]
+
+
+def orm_users(user):
+    return [(u.id, u.username, u.image_url, u.header_image_url, u.bio,
+             user.is_following(u)) for u in User.query.all()]
+
+
+def record_users(user):
+    following = readmodels.following_ids(user.id)
+    return [(c.id, c.username, c.image_url, c.header_image_url, c.bio,
+             c.id in following) for c in readmodels.user_cards()]
+
+
+def measure(load, user_id):
+    """Return (seconds, peak bytes) per call of load(user), each call in a
+    fresh session as in a request."""
+
+    def once():
+        user = User.query.get(user_id)
+        load(user)
+        db.session.remove()
+
+    once()
+    seconds = timeit.timeit(once, number=N) / N
+
+    tracemalloc.start()
+    once()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return seconds, peak
+
+
+def bench_request(app, user_id, path):
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        client.get(path)
+        return timeit.timeit(lambda: client.get(path), number=N) / N
+
+
+if __name__ == '__main__':
+    app = seed()
+    user_id = most_followed_user_id()
+
+    with app.app_context():
+        for name, orm, records in [('timeline', orm_timeline, record_timeline),
+                                   ('/users', orm_users, record_users)]:
+            orm_s, orm_peak = measure(orm, user_id)
+            rec_s, rec_peak = measure(records, user_id)
+            print(f"{name:10} ORM:     {orm_s * 1e3:7.2f} ms  "
+                  f"{orm_peak / 1024:8.1f} KiB peak")
+            print(f"{name:10} records: {rec_s * 1e3:7.2f} ms  "
+                  f"{rec_peak / 1024:8.1f} KiB peak")
+
+    for path in ['/', '/users', f'/users/{user_id}']:
+        seconds = bench_request(app, user_id, path)
+        print(f"GET {path:12} {seconds * 1e3:7.2f} ms")
@@ -0,0 +1,68 @@
+"""Load the generator's seed data into a scratch database for benchmarks.
+
+Benchmarks import this before anything else: it points the app at
+BENCH_DATABASE_URL (default: a temporary SQLite file) and seeds it from
+generator/*.csv the same way seed.py does.
+"""
+
+import os
+import tempfile
+from csv import DictReader
+from datetime import datetime
+
+os.environ.setdefault(
+    'DATABASE_URL',
+    os.environ.get('BENCH_DATABASE_URL',
+                   f"sqlite:///{tempfile.gettempdir()}/warbler-bench.db"))
+
+from app import app  # noqa: E402
+from models import db, User, Message, Follows  # noqa: E402
+from sqlalchemy import func  # noqa: E402
+import snowflake  # noqa: E402
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['RATELIMIT_ENABLED'] = False
+app.config['DEBUG_TB_ENABLED'] = False
+
+GENERATOR_DIR = os.path.join(os.path.dirname(__file__), '..', 'generator')
+
+
+def _read(name):
+    with open(os.path.join(GENERATOR_DIR, name)) as f:
+        return list(DictReader(f))
+
+
+def seed():
+    """Recreate the tables and load the seed CSVs. Returns the app."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, _read('users.csv'))
+    messages = []
+    for sequence, row in enumerate(_read('messages.csv')):
+        timestamp = _parse_timestamp(row['timestamp'])
+        # ids are time-ordered, so make them from the seed timestamps
+        message_id = snowflake.from_datetime(
+            timestamp, sequence=sequence % (snowflake.MAX_SEQUENCE + 1))
+        messages.append(dict(row, id=message_id, timestamp=timestamp))
+    db.session.bulk_insert_mappings(Message, messages)
+    db.session.bulk_insert_mappings(Follows, _read('follows.csv'))
+    db.session.commit()
+
+    return app
+
+
+def _parse_timestamp(value):
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+
+
+def most_followed_user_id():
+    """The user following the most others, for timeline benchmarks."""
+
+    return (db.session
+            .query(Follows.user_following_id)
+            .group_by(Follows.user_following_id)
+            .order_by(func.count().desc())
+            .limit(1)
+            .scalar())
@@ -0,0 +1,75 @@
+"""Blocking and muting users.
+
+Muting a user takes their messages out of the muter's home timeline and
+of the likes, tag and mentions pages they read. Blocking does that both
+ways, and also ends any follows between the two, keeps them from following
+or liking each other, and hides each from the other's user search. The
+blocked user's profile shows a 404 to the user who blocked them.
+
+The relations are kept in `mutes` and `blocks`, next to `follows`, and
+enforced inside the read queries (see `readmodels._Hidden`).
+"""
+
+from models import db, Follows, Blocks, Mutes
+
+
+def between(user_id, other_id):
+    """Whether either of `user_id` and `other_id` blocked the other."""
+
+    return db.session.query(
+        Blocks
+        .query
+        .filter(db.or_(
+            db.and_(Blocks.user_blocking_id == user_id,
+                    Blocks.user_being_blocked_id == other_id),
+            db.and_(Blocks.user_blocking_id == other_id,
+                    Blocks.user_being_blocked_id == user_id)))
+        .exists()).scalar()
+
+
+def block(user_id, blocked_id):
+    """Have `user_id` block `blocked_id`, ending the follows between them.
+    Commits."""
+
+    (Follows
+     .query
+     .filter(db.or_(
+         db.and_(Follows.user_following_id == user_id,
+                 Follows.user_being_followed_id == blocked_id),
+         db.and_(Follows.user_following_id == blocked_id,
+                 Follows.user_being_followed_id == user_id)))
+     .delete(synchronize_session=False))
+
+    if not Blocks.query.get((blocked_id, user_id)):
+        db.session.add(Blocks(user_blocking_id=user_id,
+                              user_being_blocked_id=blocked_id))
+    db.session.commit()
+
+
+def unblock(user_id, blocked_id):
+    """Have `user_id` unblock `blocked_id`. Commits."""
+
+    (Blocks
+     .query
+     .filter_by(user_blocking_id=user_id, user_being_blocked_id=blocked_id)
+     .delete(synchronize_session=False))
+    db.session.commit()
+
+
+def mute(user_id, muted_id):
+    """Have `user_id` mute `muted_id`. Commits."""
+
+    if not Mutes.query.get((user_id, muted_id)):
+        db.session.add(Mutes(user_muting_id=user_id,
+                             user_being_muted_id=muted_id))
+    db.session.commit()
+
+
+def unmute(user_id, muted_id):
+    """Have `user_id` unmute `muted_id`. Commits."""
+
+    (Mutes
+     .query
+     .filter_by(user_muting_id=user_id, user_being_muted_id=muted_id)
+     .delete(synchronize_session=False))
+    db.session.commit()
@@ -0,0 +1,61 @@
+"""A counting Bloom filter: a set that can answer "definitely not a member"
+from memory.
+
+Each item sets `hashes` counters out of `size`; it may be a member if all
+of them are non-zero. Counters (rather than bits) let items be removed
+again. A counter that reaches 255 stays there, so an item sharing it can
+never be lost, only become a false positive.
+"""
+
+import hashlib
+import math
+
+MAX_COUNT = 255
+
+
+class CountingBloomFilter:
+    """Set membership with false positives at about `error_rate` while it
+    holds up to `capacity` items, and no false negatives."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate)
+                              / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        self._counters = bytearray(self.size)
+
+    def _positions(self, item):
+        # double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            if self._counters[position] < MAX_COUNT:
+                self._counters[position] += 1
+        self.count += 1
+
+    def discard(self, item):
+        """Remove `item`, which must have been added (and not removed
+        since): removing anything else corrupts the filter."""
+
+        positions = self._positions(item)
+        if not all(self._counters[position] for position in positions):
+            return
+
+        for position in positions:
+            if self._counters[position] < MAX_COUNT:
+                self._counters[position] -= 1
+        self.count -= 1
+
+    def __contains__(self, item):
+        return all(self._counters[position]
+                   for position in self._positions(item))
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,160 @@
+"""Response compression and precompressed static files.
+
+Text responses (HTML, JSON, CSS, JS) of at least COMPRESS_MIN_SIZE bytes
+are compressed with brotli when the client accepts it and the `brotli`
+package is installed, else with gzip. Streamed responses (like the live
+timeline) and responses that already have a Content-Encoding are left
+alone.
+
+HTML for logged-in users is left alone too: it carries their CSRF token
+next to text others write and requests can reflect, and the size of a
+compressed page would tell an attacker how much of the token they have
+guessed (BREACH). Whether a request is a logged-in user's is up to the
+app's `is_private` callback.
+
+Static files are compressed once ahead of time by `flask compress-static`
+(run at deploy from bin/post_compile), which writes `.br` and `.gz`
+siblings next to each file; the static view serves those when present.
+"""
+
+import gzip
+import mimetypes
+import os
+
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import with_appcontext
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIMETYPES = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'application/json',
+    'application/javascript',
+}
+
+STATIC_EXTENSIONS = ('.css', '.js')
+
+# file suffix for each Content-Encoding, most preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def _compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level)
+
+
+def _accepted_encodings():
+    return [(encoding, suffix) for encoding, suffix in ENCODINGS
+            if encoding in request.accept_encodings
+            and (encoding != 'br' or brotli)]
+
+
+class Compressor:
+    """Compresses responses of a Flask app.
+
+    `is_private`, called during a request, says whether its HTML holds a
+    user's secrets, and so is sent uncompressed.
+    """
+
+    def __init__(self, app=None, is_private=None):
+        self.is_private = is_private or (lambda: False)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+        app.config.setdefault('COMPRESS_BROTLI_QUALITY', 5)
+
+        self.app = app
+        app.after_request(self.compress_response)
+        app.view_functions['static'] = self.send_static_file
+        app.cli.add_command(compress_static_command)
+
+    def compress_response(self, response):
+        response.vary.add('Accept-Encoding')
+
+        if (response.status_code != 200
+                or response.direct_passthrough
+                or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in MIMETYPES
+                or response.content_length is None
+                or response.content_length < self.app.config['COMPRESS_MIN_SIZE']
+                or (response.mimetype == 'text/html' and self.is_private())):
+            return response
+
+        accepted = _accepted_encodings()
+        if not accepted:
+            return response
+
+        encoding = accepted[0][0]
+        level = (self.app.config['COMPRESS_BROTLI_QUALITY'] if encoding == 'br'
+                 else self.app.config['COMPRESS_GZIP_LEVEL'])
+
+        response.set_data(_compress(response.get_data(), encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def send_static_file(self, filename):
+        """Serve a static file, precompressed if possible."""
+
+        folder = self.app.static_folder
+
+        for encoding, suffix in _accepted_encodings():
+            path = safe_join(folder, filename + suffix)
+            if path and os.path.isfile(path):
+                response = send_from_directory(
+                    folder,
+                    filename + suffix,
+                    mimetype=mimetypes.guess_type(filename)[0],
+                    cache_timeout=self.app.get_send_file_max_age(filename))
+                response.headers['Content-Encoding'] = encoding
+                response.vary.add('Accept-Encoding')
+                return response
+
+        return self.app.send_static_file(filename)
+
+
+def compress_static_files(folder):
+    """Write `.gz` (and, with brotli installed, `.br`) copies of the CSS
+    and JS files under `folder`. Returns the paths written."""
+
+    written = []
+
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if not name.endswith(STATIC_EXTENSIONS):
+                continue
+
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            for encoding, suffix in ENCODINGS:
+                if encoding == 'br' and not brotli:
+                    continue
+
+                level = 11 if encoding == 'br' else 9
+                with open(path + suffix, 'wb') as f:
+                    f.write(_compress(data, encoding, level))
+                written.append(path + suffix)
+
+    return written
+
+
+@click.command('compress-static')
+@with_appcontext
+def compress_static_command():
+    """Precompress static CSS and JS files."""
+
+    for path in compress_static_files(current_app.static_folder):
+        click.echo(f"Wrote {path}")
@@ -0,0 +1,88 @@
+"""Plain read-only records of users, messages and their activity.
+
+These carry only the columns a page or API response needs, with
+`__slots__` so they are small and cheap to build, and have no ties to a
+database session. They serialize to compact JSON through `JSONEncoder`.
+"""
+
+from datetime import date
+
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+
+class DTO:
+    """Base for records: positional or keyword construction, equality,
+    and conversion to a dict."""
+
+    __slots__ = ()
+
+    # fields holding message ids, which are sent to JSON as strings: a
+    # snowflake id is too large for a JavaScript number to hold exactly
+    id_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name in self.__slots__[len(args):]:
+            setattr(self, name, kwargs.get(name))
+
+    @classmethod
+    def from_model(cls, instance):
+        """Copy the record's fields from an ORM instance."""
+
+        return cls(*(getattr(instance, name) for name in cls.__slots__))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+        return (type(self) is type(other)
+                and self.as_dict() == other.as_dict())
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}"
+                           for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class UserDTO(DTO):
+    """Public profile fields of a user."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url',
+                 'bio', 'location')
+
+
+class MessageDTO(DTO):
+    """A message without its author."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id')
+    id_fields = ('id',)
+
+
+class DailyStatsDTO(DTO):
+    """Activity on one day (see rollups.py)."""
+
+    __slots__ = ('day', 'messages', 'posters', 'likes', 'follows')
+
+
+class UserActivityDTO(DTO):
+    """A user's activity totals over some days (see rollups.py)."""
+
+    __slots__ = ('user_id', 'messages', 'likes_given', 'likes_received',
+                 'follows_made', 'followers_gained')
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    """Flask's encoder, plus records and ISO 8601 dates and datetimes."""
+
+    def default(self, o):
+        if isinstance(o, DTO):
+            data = o.as_dict()
+            for name in o.id_fields:
+                if data[name] is not None:
+                    data[name] = str(data[name])
+            return data
+        # datetimes too
+        if isinstance(o, date):
+            return o.isoformat()
+        return super().default(o)
@@ -0,0 +1,238 @@
+"""Export users' messages, likes and follows to compressed files.
+
+`flask export user USERNAME DIRECTORY` writes one gzipped file per
+section (messages, likes, following, followers) to DIRECTORY/<user id>/,
+as CSV with a header row or as NDJSON (one JSON object per line).
+`flask export all DIRECTORY` does the same for every active user,
+spread over several worker processes.
+
+Rows are read with `yield_per`, which streams them from a server-side
+cursor where the driver supports one (psycopg2 does), as plain column
+tuples rather than ORM objects, and written out as they arrive, so
+memory use does not grow with the size of an account. Each file is
+written under a temporary name and renamed when complete, so an
+interrupted export never leaves a truncated file behind.
+"""
+
+import csv
+import gzip
+import json
+import multiprocessing
+import os
+from datetime import datetime
+from functools import partial
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import (db, User, Message, Like, ArchivedMessage, ArchivedLike,
+                    Follows)
+from shards import shards
+
+FORMATS = ('csv', 'ndjson')
+
+# rows fetched from the cursor at a time
+BATCH_SIZE = 1000
+
+export_cli = AppGroup('export', help="Export users' data to files.")
+
+
+def _stream(query):
+    return query.yield_per(BATCH_SIZE)
+
+
+def _follow_rows(user_id, own_column, other_column):
+    return _stream(db.session
+                   .query(User.id, User.username)
+                   .join(Follows, other_column == User.id)
+                   .filter(own_column == user_id,
+                           User.deleted_at.is_(None))
+                   .order_by(User.id))
+
+
+def sections(user_id):
+    """(name, columns, row iterables) for each section of `user_id`'s
+    export; the rows of a section are the concatenation of its
+    iterables."""
+
+    # archived messages (see archive.py) are older than any left, and
+    # may be on any shard; likes are kept with the message liked
+    messages = [_stream(session
+                        .query(ArchivedMessage.id, ArchivedMessage.timestamp,
+                               ArchivedMessage.text)
+                        .filter(ArchivedMessage.user_id == user_id)
+                        .order_by(ArchivedMessage.id))
+                for session in shards.all()]
+    messages.append(_stream(shards.for_user(user_id)
+                            .query(Message.id, Message.timestamp, Message.text)
+                            .filter(Message.user_id == user_id)
+                            .order_by(Message.id)))
+
+    likes = []
+    for model, like in ((ArchivedMessage, ArchivedLike), (Message, Like)):
+        likes += [_stream(session
+                          .query(like.message_id, model.user_id,
+                                 model.timestamp)
+                          .join(model, model.id == like.message_id)
+                          .filter(like.user_id == user_id)
+                          .order_by(like.message_id))
+                  for session in shards.all()]
+
+    return [
+        ('messages', ('id', 'timestamp', 'text'), messages),
+        ('likes', ('message_id', 'author_id', 'timestamp'), likes),
+        ('following', ('user_id', 'username'),
+         [_follow_rows(user_id, Follows.user_following_id,
+                       Follows.user_being_followed_id)]),
+        ('followers', ('user_id', 'username'),
+         [_follow_rows(user_id, Follows.user_being_followed_id,
+                       Follows.user_following_id)]),
+    ]
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _write_csv(file, columns, rows):
+    writer = csv.writer(file)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow([_value(value) for value in row])
+        count += 1
+    return count
+
+
+# message ids, written as strings: too large for a JavaScript number
+ID_COLUMNS = ('id', 'message_id')
+
+
+def _write_ndjson(file, columns, rows):
+    count = 0
+    for row in rows:
+        record = {column: (str(value) if column in ID_COLUMNS
+                           else _value(value))
+                  for column, value in zip(columns, row)}
+        file.write(json.dumps(record) + '\n')
+        count += 1
+    return count
+
+
+WRITERS = {'csv': _write_csv, 'ndjson': _write_ndjson}
+
+
+def export_user(user_id, directory, fmt='csv'):
+    """Write `user_id`'s export to `directory`/<user_id>/.
+
+    Returns {section: number of rows written}.
+    """
+
+    if fmt not in WRITERS:
+        raise ValueError(f"Format must be one of {', '.join(FORMATS)}")
+
+    user_dir = os.path.join(directory, str(user_id))
+    os.makedirs(user_dir, exist_ok=True)
+
+    counts = {}
+    for name, columns, parts in sections(user_id):
+        path = os.path.join(user_dir, f"{name}.{fmt}.gz")
+        partial_path = path + '.part'
+
+        with gzip.open(partial_path, 'wt', encoding='utf-8',
+                       newline='') as file:
+            counts[name] = WRITERS[fmt](
+                file, columns, (row for rows in parts for row in rows))
+
+        os.replace(partial_path, path)
+
+    return counts
+
+
+def _disconnect():
+    """Close this process's pooled connections, so forked children don't
+    share them."""
+
+    db.session.remove()
+    db.engine.dispose()
+    shards.remove()
+    for engine in shards.engines:
+        engine.dispose()
+
+
+_worker_context = None
+
+
+def _start_worker(app):
+    global _worker_context
+    _worker_context = app.app_context()
+    _worker_context.push()
+
+
+def _export_in_worker(user_id, directory, fmt):
+    try:
+        return user_id, export_user(user_id, directory, fmt)
+    finally:
+        # don't hold a connection open between users
+        db.session.remove()
+        shards.remove()
+
+
+def export_all(directory, fmt='csv', processes=1):
+    """Export every active user to `directory`, using `processes` worker
+    processes.
+
+    Yields (user id, {section: rows written}) as each user is done.
+    """
+
+    # only the ids are held in memory, never users' rows
+    user_ids = [user_id for (user_id,) in (db.session
+                                           .query(User.id)
+                                           .filter(User.deleted_at.is_(None))
+                                           .order_by(User.id))]
+
+    if processes <= 1:
+        for user_id in user_ids:
+            yield user_id, export_user(user_id, directory, fmt)
+        return
+
+    _disconnect()
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes, initializer=_start_worker,
+                      initargs=(current_app._get_current_object(),)) as pool:
+        yield from pool.imap_unordered(
+            partial(_export_in_worker, directory=directory, fmt=fmt),
+            user_ids, chunksize=16)
+
+
+format_option = click.option('--format', 'fmt', type=click.Choice(FORMATS),
+                             default='csv', show_default=True)
+
+
+@export_cli.command('user')
+@click.argument('username')
+@click.argument('directory', type=click.Path(file_okay=False))
+@format_option
+def user_command(username, directory, fmt):
+    """Export USERNAME's data to DIRECTORY."""
+
+    user = User.active().filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username}")
+
+    counts = export_user(user.id, directory, fmt)
+    click.echo(", ".join(f"{count} {name}" for name, count in counts.items()))
+
+
+@export_cli.command('all')
+@click.argument('directory', type=click.Path(file_okay=False))
+@format_option
+@click.option('--processes', '-p', type=click.IntRange(min=1),
+              default=os.cpu_count() or 1, show_default=True,
+              help="Number of worker processes.")
+def all_command(directory, fmt, processes):
+    """Export every active user's data to DIRECTORY."""
+
+    exported = sum(1 for done in export_all(directory, fmt, processes))
+    click.echo(f"Exported {exported} users.")
@@ -0,0 +1,221 @@
+"""Following and unfollowing many users at once.
+
+Used by the `/api/following` endpoint and `flask follows import` for
+onboarding and for bringing follow lists over from other networks. A
+batch of up to MAX_BATCH users, given by id (ints) or username (strings),
+is resolved in one query and applied in one statement; every item gets
+its own result.
+"""
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Follows, Blocks
+from notifications import notify_follows
+
+MAX_BATCH = 100
+
+follows_cli = AppGroup('follows', help="Follow or unfollow users in bulk.")
+
+
+class BatchTooLarge(ValueError):
+    """More than MAX_BATCH users in one batch."""
+
+
+def resolve(refs):
+    """Map each of `refs` (user ids or usernames) to an active user's id,
+    in one query. Unknown refs are left out."""
+
+    ids = {ref for ref in refs if isinstance(ref, int)}
+    names = {ref for ref in refs if isinstance(ref, str)}
+
+    rows = (db.session
+            .query(User.id, User.username)
+            .filter(User.deleted_at.is_(None),
+                    db.or_(User.id.in_(ids), User.username.in_(names))))
+
+    found = {}
+    for user_id, username in rows:
+        if user_id in ids:
+            found[user_id] = user_id
+        if username in names:
+            found[username] = user_id
+
+    return found
+
+
+def _check(refs):
+    if len(refs) > MAX_BATCH:
+        raise BatchTooLarge(f"At most {MAX_BATCH} users per batch")
+
+
+def _followed_ids(user_id, candidates):
+    return {followed_id for (followed_id,) in (
+        db.session
+        .query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user_id,
+                Follows.user_being_followed_id.in_(candidates)))}
+
+
+def _followed_and_blocked_ids(user_id, candidates):
+    """Those of `candidates` that `user_id` follows, and those they blocked
+    or were blocked by, in one query."""
+
+    rows = db.session.execute(db.union_all(
+        db.select([Follows.user_being_followed_id, db.literal(False)])
+        .where(Follows.user_following_id == user_id)
+        .where(Follows.user_being_followed_id.in_(candidates)),
+        db.select([Blocks.user_being_blocked_id, db.literal(True)])
+        .where(Blocks.user_blocking_id == user_id)
+        .where(Blocks.user_being_blocked_id.in_(candidates)),
+        db.select([Blocks.user_blocking_id, db.literal(True)])
+        .where(Blocks.user_being_blocked_id == user_id)
+        .where(Blocks.user_blocking_id.in_(candidates))))
+
+    followed, blocked = set(), set()
+    for target_id, is_block in rows:
+        (blocked if is_block else followed).add(target_id)
+
+    return followed, blocked
+
+
+def _insert_follows(rows):
+    """Insert follows in one multi-row statement; on Postgres, rows that
+    already exist are skipped rather than failing the statement."""
+
+    if db.engine.dialect.name == 'postgresql':
+        statement = (postgresql.insert(Follows.__table__)
+                     .values(rows)
+                     .on_conflict_do_nothing())
+    else:
+        statement = Follows.__table__.insert().values(rows)
+
+    db.session.execute(statement)
+
+
+def _results(user_id, refs, found, status_of):
+    """One {ref, user_id, status} per ref, in order."""
+
+    results = []
+    seen = set()
+
+    for ref in refs:
+        target_id = found.get(ref)
+
+        if target_id is None:
+            status = 'not_found'
+        elif target_id in seen:
+            status = 'duplicate'
+        elif target_id == user_id:
+            status = 'self'
+        else:
+            status = status_of(target_id)
+
+        if target_id is not None:
+            seen.add(target_id)
+        results.append({'ref': ref, 'user_id': target_id, 'status': status})
+
+    return results
+
+
+def follow_many(user_id, refs):
+    """Have `user_id` follow every user in `refs`.
+
+    Returns a result per ref, each with a status of 'followed',
+    'already_following', 'blocked', 'self', 'duplicate' or 'not_found'.
+    Commits.
+    """
+
+    _check(refs)
+    found = resolve(refs)
+    candidates = set(found.values()) - {user_id}
+    existing, blocked = _followed_and_blocked_ids(user_id, candidates)
+
+    new_ids = candidates - blocked - existing
+    if new_ids:
+        try:
+            _insert_follows([{'user_following_id': user_id,
+                              'user_being_followed_id': followed_id}
+                             for followed_id in sorted(new_ids)])
+            notify_follows(user_id, new_ids)
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent request followed some of them first
+            db.session.rollback()
+            return follow_many(user_id, refs)
+
+    return _results(user_id, refs, found,
+                    lambda target_id: ('followed' if target_id in new_ids
+                                       else 'blocked' if target_id in blocked
+                                       else 'already_following'))
+
+
+def unfollow_many(user_id, refs):
+    """Have `user_id` stop following every user in `refs`.
+
+    Returns a result per ref, each with a status of 'unfollowed',
+    'not_following', 'self', 'duplicate' or 'not_found'. Commits.
+    """
+
+    _check(refs)
+    found = resolve(refs)
+    existing = _followed_ids(user_id, set(found.values()) - {user_id})
+
+    if existing:
+        (Follows
+         .query
+         .filter(Follows.user_following_id == user_id,
+                 Follows.user_being_followed_id.in_(existing))
+         .delete(synchronize_session=False))
+        db.session.commit()
+
+    return _results(user_id, refs, found,
+                    lambda target_id: ('unfollowed' if target_id in existing
+                                       else 'not_following'))
+
+
+def parse_ref(text):
+    """A ref from a line of a follow list: digits are a user id, anything
+    else (with an optional leading @) a username."""
+
+    text = text.strip()
+    if text.isdigit():
+        return int(text)
+    return text[1:] if text.startswith('@') else text
+
+
+def _in_batches(refs):
+    for start in range(0, len(refs), MAX_BATCH):
+        yield refs[start:start + MAX_BATCH]
+
+
+@follows_cli.command('import')
+@click.argument('username')
+@click.argument('follow_list', type=click.File())
+@click.option('--unfollow', is_flag=True,
+              help="Unfollow the listed users instead.")
+def import_command(username, follow_list, unfollow):
+    """Have USERNAME follow every user in FOLLOW_LIST.
+
+    FOLLOW_LIST has one user id or username per line ('-' for stdin).
+    """
+
+    user = User.active().filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username}")
+
+    refs = [parse_ref(line) for line in follow_list if line.strip()]
+    apply = unfollow_many if unfollow else follow_many
+
+    counts = {}
+    for batch in _in_batches(refs):
+        for result in apply(user.id, batch):
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+            if result['status'] == 'not_found':
+                click.echo(f"Not found: {result['ref']}")
+
+    summary = ", ".join(f"{count} {status}"
+                        for status, count in sorted(counts.items()))
+    click.echo(summary or "Nothing to do.")
@@ -37,14 +37,3 @@ class LoginForm(FlaskForm):
     # password set to StringField so password can be set to a default value for demo purposes
     password = StringField('Password', validators=[Length(min=6)])
 
-
-class LogoutForm(FlaskForm):
-    """Logout form -- this form is intentionally blank."""
-
-
-class LikeMessageForm(FlaskForm):
-    """Like Message form -- this form is intentionally blank."""
-
-
-class DeleteUserForm(FlaskForm):
-    """Delete user form -- this form is intentionally blank."""
\ No newline at end of file
@@ -0,0 +1,326 @@
+"""Where users are, for finding people nearby.
+
+`User.location` is free text. The `geocode_users` job looks locations up,
+in batches, in a local gazetteer (gazetteer.csv; no network requests),
+through a cache of the places looked up before (`geocoded_places`, keyed
+by `normalize_place()`), and stores each user's coordinates with their
+geohash.
+
+A geohash names a cell of a grid over the earth: each further character
+splits a cell into 32, so places in one cell share a prefix. Users within
+a radius are found by `readmodels.nearby_cards()` with a range scan of
+ix_users_geohash for each of the (at most four) cells covering the
+radius, from `cells_covering()`, narrowed to the radius's bounding box
+(`bounding_box()`). The database orders what is left by an approximate
+distance and returns the nearest few; only those have their distance
+measured exactly (with geopy).
+
+Places the gazetteer doesn't know are cached too, but looked up again
+after UNKNOWN_PLACE_TTL, as places are added to it.
+
+`flask geo backfill` queues geocoding every user's location; a profile
+update queues the user's own.
+"""
+
+import csv
+import math
+import os
+import re
+import unicodedata
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import click
+from flask.cli import AppGroup
+
+from jobs import job, enqueue
+from models import db, User, GeocodedPlace
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(__file__), 'gazetteer.csv')
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# about 5 m by 5 m; much finer than any radius searched
+GEOHASH_LENGTH = 9
+
+KM_PER_DEGREE = 111.32
+
+# the radius choices of /users/nearby, in km
+RADII = (10, 50, 200, 1000)
+DEFAULT_RADIUS = 50
+
+BACKFILL_BATCH_SIZE = 1000
+
+# how long a place the gazetteer didn't know is taken to be unknown
+UNKNOWN_PLACE_TTL = timedelta(days=30)
+
+# what people write for a country, as the gazetteer names it
+_ALIASES = {
+    'usa': 'us',
+    'u s a': 'us',
+    'u s': 'us',
+    'united states of america': 'united states',
+    'america': 'united states',
+    'uk': 'gb',
+    'u k': 'gb',
+    'great britain': 'united kingdom',
+}
+
+geo_cli = AppGroup('geo', help="Geocode users' locations.")
+
+
+def normalize_place(text):
+    """`text` as the gazetteer and the cache key places: lowercased and
+    without accents, punctuation, postcodes or extra spaces, as
+    comma-separated parts (e.g. "São Paulo,  SP 01000" is "sao paulo,
+    sp"). None if nothing is left."""
+
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+    parts = []
+    for part in text.split(','):
+        words = re.sub(r'[^\w]+', ' ', part).split()
+        part = ' '.join(word for word in words
+                        if not any(c.isdigit() for c in word))
+        if part:
+            parts.append(_ALIASES.get(part, part))
+
+    return ', '.join(parts) or None
+
+
+@lru_cache()
+def gazetteer():
+    """{normalized place: (latitude, longitude)} of every way of naming
+    each gazetteer entry: its name alone or with its region and/or
+    country, by name or code. A name shared by several places is the most
+    populous of them."""
+
+    with open(GAZETTEER_PATH) as f:
+        rows = sorted(csv.DictReader(f),
+                      key=lambda row: int(row['population']),
+                      reverse=True)
+
+    places = {}
+    for row in rows:
+        point = (float(row['latitude']), float(row['longitude']))
+        for region in ('', row['region'], row['region_code']):
+            for country in ('', row['country'], row['country_code']):
+                name = ', '.join(part for part in (row['name'], region,
+                                                   country) if part)
+                places.setdefault(normalize_place(name), point)
+
+    return places
+
+
+def geocode(places, now=None):
+    """{place: (latitude, longitude), or None if unknown} of normalized
+    `places`, from the cache or else the gazetteer. Adds what it looked up
+    to the cache; the caller commits."""
+
+    places = set(places) - {None}
+    if not places:
+        return {}
+
+    now = now or datetime.utcnow()
+    found = {}
+    expired = set()
+    for place, latitude, longitude, geocoded_at in (
+            db.session
+            .query(GeocodedPlace.place,
+                   GeocodedPlace.latitude,
+                   GeocodedPlace.longitude,
+                   GeocodedPlace.geocoded_at)
+            .filter(GeocodedPlace.place.in_(places))):
+        if latitude is not None:
+            found[place] = (latitude, longitude)
+        elif geocoded_at > now - UNKNOWN_PLACE_TTL:
+            found[place] = None
+        else:
+            expired.add(place)
+
+    looked_up = {place: gazetteer().get(place)
+                 for place in places - found.keys()}
+    for rows, save in ((looked_up.keys() - expired,
+                        db.session.bulk_insert_mappings),
+                       (expired, db.session.bulk_update_mappings)):
+        save(GeocodedPlace, [
+            {'place': place,
+             'latitude': looked_up[place] and looked_up[place][0],
+             'longitude': looked_up[place] and looked_up[place][1],
+             'geocoded_at': now}
+            for place in rows])
+
+    return {**found, **looked_up}
+
+
+def encode_geohash(latitude, longitude, length=GEOHASH_LENGTH):
+    """The geohash of (latitude, longitude), `length` characters long."""
+
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+
+    while len(chars) < length:
+        span, point = ((lon_range, longitude) if even
+                       else (lat_range, latitude))
+        middle = (span[0] + span[1]) / 2
+
+        value <<= 1
+        if point >= middle:
+            value |= 1
+            span[0] = middle
+        else:
+            span[1] = middle
+        even = not even
+
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = value = 0
+
+    return ''.join(chars)
+
+
+def _cell_size(length):
+    """(height, width) in degrees of a geohash cell `length` long."""
+
+    lon_bits = math.ceil(5 * length / 2)
+    lat_bits = 5 * length // 2
+    return 180 / 2 ** lat_bits, 360 / 2 ** lon_bits
+
+
+def _half_box(latitude, radius_km):
+    """(height, width) in degrees of half the bounding box of a radius
+    around a point at `latitude`."""
+
+    height = radius_km / KM_PER_DEGREE
+    cos_lat = math.cos(math.radians(latitude))
+    width = 360 if cos_lat < 1e-6 else min(360, height / cos_lat)
+    return height, width
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """(south, north, west, east) in degrees of a box around every point
+    within `radius_km` of (latitude, longitude). West is greater than
+    east when the box crosses the antimeridian; both are None when it
+    goes all the way around."""
+
+    height, width = _half_box(latitude, radius_km)
+    south = max(-90.0, latitude - height)
+    north = min(90.0, latitude + height)
+    if width >= 180 or south == -90 or north == 90:
+        return south, north, None, None
+
+    def wrap(lon):
+        return (lon + 180) % 360 - 180
+
+    return south, north, wrap(longitude - width), wrap(longitude + width)
+
+
+def cells_covering(latitude, longitude, radius_km):
+    """Geohash prefixes of the (at most four) cells that together cover
+    every point within `radius_km` of (latitude, longitude): those of the
+    longest length whose cells are as large as the radius's bounding box,
+    which touches at most two of them each way."""
+
+    height, width = _half_box(latitude, radius_km)
+
+    length = 0
+    while (length < GEOHASH_LENGTH
+           and all(cell >= 2 * half for cell, half in zip(
+               _cell_size(length + 1), (height, width)))):
+        length += 1
+
+    if length == 0:
+        return ['']
+
+    def wrap(lon):
+        return (lon + 180) % 360 - 180
+
+    corners = {(max(-90.0, min(90.0, latitude + dlat)), wrap(longitude + dlon))
+               for dlat in (-height, height)
+               for dlon in (-width, width)}
+
+    return sorted({encode_geohash(lat, lon, length) for lat, lon in corners})
+
+
+def location_changed(user):
+    """Forget where `user` was and queue geocoding their new location. The
+    caller commits."""
+
+    user.latitude = user.longitude = user.geohash = None
+    enqueue('geocode_users', dedup_key=f"geocode_user:{user.id}",
+            after=user.id - 1, through=user.id)
+
+
+@job('geocode_users', concurrency=2)
+def geocode_users(after, through):
+    """Geocode the locations of users with ids above `after`, up to and
+    including `through`."""
+
+    users = (db.session
+             .query(User.id, User.location)
+             .filter(User.id > after, User.id <= through,
+                     User.deleted_at.is_(None))
+             .all())
+
+    places = {id: normalize_place(location) for id, location in users}
+    points = geocode(places.values())
+
+    updates = []
+    for id, place in places.items():
+        point = points.get(place)
+        updates.append({
+            'id': id,
+            'latitude': point and point[0],
+            'longitude': point and point[1],
+            'geohash': point and encode_geohash(*point),
+        })
+
+    db.session.bulk_update_mappings(User, updates)
+    db.session.commit()
+
+
+def queue_backfill(batch_size=BACKFILL_BATCH_SIZE):
+    """Queue a `geocode_users` job for every `batch_size` users. Returns
+    the number of jobs queued."""
+
+    queued = 0
+    after = 0
+
+    while True:
+        # the last id of the next batch, or of what is left
+        through = (db.session
+                   .query(User.id)
+                   .filter(User.id > after)
+                   .order_by(User.id)
+                   .offset(batch_size - 1)
+                   .limit(1)
+                   .scalar()
+                   or db.session
+                   .query(db.func.max(User.id))
+                   .filter(User.id > after)
+                   .scalar())
+        if through is None:
+            break
+
+        enqueue('geocode_users', dedup_key=f"geocode_users:{after}",
+                after=after, through=through)
+        queued += 1
+        after = through
+
+    db.session.commit()
+    return queued
+
+
+@geo_cli.command('backfill')
+@click.option('--batch-size', default=BACKFILL_BATCH_SIZE, show_default=True)
+def backfill_command(batch_size):
+    """Queue geocoding every user's location."""
+
+    queued = queue_backfill(batch_size)
+    click.echo(f"Queued {queued} batches; run `flask jobs work` to geocode "
+               f"them.")
@@ -0,0 +1,289 @@
+"""Resized local copies of users' profile and header images.
+
+`User.image_url` and `User.header_image_url` point anywhere on the web and
+used to be hot-linked at full size on every timeline row and user card.
+The `process_user_images` job (queued on signup and whenever `profile()`
+changes an image URL) fetches each image once, crops and scales it to a
+fixed-size variant and saves it under IMAGE_CACHE_DIR, named after a hash
+of its content. `/images/<filename>` serves those files with a one-year
+cache lifetime: a changed image gets a new name, so a cached copy is
+never stale.
+
+Variants are remembered per (source URL, variant) in `cached_images`, so
+the many users sharing the default images share one file.
+
+The URLs are users' to choose, so `fetch()` only connects to hosts on the
+public internet: each host, including those redirected to, is resolved
+and refused if any of its addresses is loopback, private, link-local
+(e.g. cloud metadata at 169.254.169.254) or otherwise not global. The
+request then goes to the address that was checked, so a host can't
+resolve to another one in between (DNS rebinding).
+IMAGE_FETCH_ALLOWED_HOSTS exempts hostnames from that check, e.g. for a
+local test server. A URL refused, a 4xx response, or an oversized or
+unreadable image fails the job at once; other errors are retried.
+"""
+
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+import click
+import requests
+from flask import current_app
+from flask.cli import AppGroup
+from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
+
+from jobs import job, enqueue, PermanentJobError
+from models import db, User, CachedImage
+
+# (width, height) of each variant
+VARIANTS = {
+    'avatar': (256, 256),
+    'header': (1280, 400),
+}
+
+FETCH_TIMEOUT = 10
+MAX_REDIRECTS = 3
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+MAX_SOURCE_PIXELS = 40 * 1000 * 1000
+JPEG_QUALITY = 85
+
+# a small file can decode to a huge image; Pillow refuses to open those
+# far past this, and resize() past it
+Image.MAX_IMAGE_PIXELS = MAX_SOURCE_PIXELS
+
+URL_PREFIX = '/images/'
+
+images_cli = AppGroup('images', help="Manage resized profile images.")
+
+
+class ImageFetchError(Exception):
+    """A source image could not be fetched or decoded."""
+
+
+class ImageRejected(ImageFetchError, PermanentJobError):
+    """A source image that trying again won't fetch: its URL is refused,
+    the host answered 4xx, or it is too large or unreadable."""
+
+
+def cache_dir():
+    """Directory the resized images are stored in, created if missing."""
+
+    path = current_app.config.get('IMAGE_CACHE_DIR') or os.path.join(
+        current_app.instance_path, 'images')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _refused(address):
+    address = ipaddress.ip_address(address.split('%')[0])
+    return (not address.is_global or address.is_private
+            or address.is_loopback or address.is_link_local
+            or address.is_reserved or address.is_multicast)
+
+
+def check_url(url):
+    """Raise ImageRejected unless `url` is an http(s) URL of a host on the
+    public internet (or in IMAGE_FETCH_ALLOWED_HOSTS).
+
+    Returns the address checked, to connect to, or None for allowed hosts.
+    """
+
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageRejected(f"Not an http(s) URL: {url}")
+
+    if parts.hostname in current_app.config.get(
+            'IMAGE_FETCH_ALLOWED_HOSTS', ()):
+        return None
+
+    try:
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        addresses = socket.getaddrinfo(parts.hostname, port,
+                                       proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, ValueError) as exc:
+        raise ImageFetchError(f"Could not resolve {url}: {exc}") from exc
+
+    if any(_refused(sockaddr[0]) for *_, sockaddr in addresses):
+        raise ImageRejected(f"Not a public host: {url}")
+
+    return addresses[0][4][0]
+
+
+class _PinnedAdapter(HTTPAdapter):
+    """Makes https requests to an address speak TLS as `hostname`: sent
+    in SNI, and the certificate checked against it."""
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.update(server_hostname=self.hostname,
+                      assert_hostname=self.hostname)
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _get(session, url, address):
+    """GET `url` from `address` (or wherever its host resolves, if None),
+    streamed and without following redirects."""
+
+    headers = {}
+
+    if address is not None:
+        parts = urlsplit(url)
+        host = parts.netloc.rpartition('@')[2]
+        netloc = f"[{address}]" if ':' in address else address
+        if parts.port:
+            netloc += f":{parts.port}"
+
+        url = urlunsplit(parts._replace(netloc=netloc))
+        headers['Host'] = host
+        if parts.scheme == 'https':
+            session.mount('https://', _PinnedAdapter(parts.hostname))
+
+    return session.get(url, headers=headers, timeout=FETCH_TIMEOUT,
+                       stream=True, allow_redirects=False)
+
+
+def fetch(url):
+    """Download the image at `url`, following up to MAX_REDIRECTS
+    redirects; returns its bytes."""
+
+    for _ in range(MAX_REDIRECTS + 1):
+        address = check_url(url)
+
+        try:
+            with requests.Session() as session, \
+                    _get(session, url, address) as resp:
+                if resp.is_redirect:
+                    # checked again before it is fetched
+                    url = urljoin(url, resp.headers['Location'])
+                    continue
+
+                if (400 <= resp.status_code < 500
+                        and resp.status_code not in (408, 429)):
+                    raise ImageRejected(
+                        f"{resp.status_code} response for {url}")
+                resp.raise_for_status()
+
+                data = bytearray()
+                for chunk in resp.iter_content(64 * 1024):
+                    data += chunk
+                    if len(data) > MAX_SOURCE_BYTES:
+                        raise ImageRejected(f"Image too large: {url}")
+        except requests.RequestException as exc:
+            raise ImageFetchError(f"Could not fetch {url}: {exc}") from exc
+
+        return bytes(data)
+
+    raise ImageRejected(f"Too many redirects: {url}")
+
+
+def resize(data, variant):
+    """Crop and scale image `data` to `variant`; returns JPEG bytes."""
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > MAX_SOURCE_PIXELS:
+            raise ImageRejected(
+                f"Image too large: {image.width}x{image.height}")
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise ImageRejected(f"Not a readable image: {exc}") from exc
+
+    image = ImageOps.fit(image, VARIANTS[variant], Image.LANCZOS)
+
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def store(data):
+    """Save `data` under its content hash; returns the file name."""
+
+    filename = f"{hashlib.sha256(data).hexdigest()[:32]}.jpg"
+    path = os.path.join(cache_dir(), filename)
+
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    return filename
+
+
+def variant_url(source_url, variant):
+    """URL of the `variant` of the image at `source_url`, making it first
+    if this is the first time it is asked for."""
+
+    cached = CachedImage.query.get((source_url, variant))
+
+    if (cached is None
+            or not os.path.exists(os.path.join(cache_dir(), cached.filename))):
+        filename = store(resize(fetch(source_url), variant))
+
+        if cached is None:
+            cached = CachedImage(source_url=source_url, variant=variant)
+            db.session.add(cached)
+        cached.filename = filename
+
+    return URL_PREFIX + cached.filename
+
+
+@job('process_user_images')
+def process_user_images(user_id):
+    """Make the avatar and header variants of a user's current external
+    images."""
+
+    user = User.query.get(user_id)
+    if user is None or user.deleted_at is not None:
+        return
+
+    for source, target, variant in (
+            ('image_url', 'image_thumb_url', 'avatar'),
+            ('header_image_url', 'header_image_thumb_url', 'header')):
+        url = getattr(user, source)
+
+        # our own static images are served as they are
+        if url and url.startswith(('http://', 'https://')):
+            setattr(user, target, variant_url(url, variant))
+
+    db.session.commit()
+
+
+def refresh_user_images(user):
+    """Forget `user`'s resized images and queue making new ones; call
+    after changing either image URL. The caller commits."""
+
+    user.image_thumb_url = None
+    user.header_image_thumb_url = None
+
+    # not deduplicated: a job already running may have read the old URLs
+    enqueue('process_user_images', user_id=user.id)
+
+
+@images_cli.command('backfill')
+def backfill_command():
+    """Queue resizing for every user without resized images."""
+
+    users = (db.session
+             .query(User.id)
+             .filter(User.deleted_at.is_(None),
+                     db.or_(User.image_thumb_url.is_(None),
+                            User.header_image_thumb_url.is_(None))))
+
+    count = 0
+    for (user_id,) in users:
+        enqueue('process_user_images',
+                dedup_key=f"process_user_images:{user_id}",
+                user_id=user_id)
+        count += 1
+
+    db.session.commit()
+    click.echo(f"Queued {count} users.")
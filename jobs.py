@@ -0,0 +1,336 @@
+"""A small job queue backed by the `jobs` table.
+
+Request handlers call `enqueue()` to defer work and return immediately; a
+worker process (`flask jobs work`, the `worker` entry in the Procfile)
+claims queued jobs with `SELECT ... FOR UPDATE SKIP LOCKED` and runs them.
+
+Handlers are plain functions registered with the `@job` decorator and are
+called with the keyword arguments given to `enqueue()`, which must be JSON
+serializable. A handler that raises is retried with exponential backoff
+until it has been attempted `max_attempts` times, unless it raises
+PermanentJobError, which fails the job at once. While a handler runs, its
+worker keeps renewing the job's lock; a job whose lock runs out is taken
+for lost and queued again.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from models import db, Job, JobLock
+
+# a running job whose worker hasn't renewed its lock in this long is
+# presumed lost (e.g. the worker was killed) and is queued again
+VISIBILITY_TIMEOUT = timedelta(minutes=10)
+
+# how often a worker renews the lock of the job it is running
+HEARTBEAT_INTERVAL = VISIBILITY_TIMEOUT / 4
+
+RETRY_BASE_DELAY = timedelta(seconds=5)
+
+jobs_cli = AppGroup('jobs', help="Run and inspect background jobs.")
+
+_handlers = {}
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler when retrying the job can't help."""
+
+
+class JobHandler:
+    """A registered job: its function and how it may be run."""
+
+    def __init__(self, func, name, queue, concurrency, max_attempts):
+        self.func = func
+        self.name = name
+        self.queue = queue
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+
+
+def job(name, queue='default', concurrency=None, max_attempts=5):
+    """Register the decorated function as the handler for job `name`.
+
+    `concurrency` caps how many jobs of this name may run at once across
+    all workers (None for no cap).
+    """
+
+    def register(func):
+        _handlers[name] = JobHandler(func, name, queue,
+                                     concurrency, max_attempts)
+        return func
+
+    return register
+
+
+def enqueue(name, dedup_key=None, delay=None, **payload):
+    """Queue job `name` to be called with `payload`; returns the Job.
+
+    If an unfinished job with the same `dedup_key` exists, no new job is
+    queued and that job is returned instead. The job is added to the
+    current session; it is queued when the caller commits.
+    """
+
+    handler = _handlers[name]
+
+    if dedup_key is not None:
+        existing = Job.query.filter_by(dedup_key=dedup_key).first()
+        if existing:
+            return existing
+
+    new_job = Job(name=name,
+                  queue=handler.queue,
+                  payload=json.dumps(payload),
+                  dedup_key=dedup_key,
+                  max_attempts=handler.max_attempts,
+                  run_at=datetime.utcnow() + (delay or timedelta()))
+
+    if dedup_key is None:
+        db.session.add(new_job)
+        return new_job
+
+    # another request may have queued the same key since the check above
+    try:
+        with db.session.begin_nested():
+            db.session.add(new_job)
+    except IntegrityError:
+        return Job.query.filter_by(dedup_key=dedup_key).one()
+
+    return new_job
+
+
+def _lock_name(name):
+    """Lock the JobLock row of `name` until the commit, creating it if
+    need be."""
+
+    lock = JobLock.query.with_for_update().get(name)
+    if lock is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(JobLock(name=name))
+        except IntegrityError:
+            # another worker created it since
+            JobLock.query.with_for_update().get(name)
+
+
+def _saturated(name):
+    """Whether jobs of `name` are running at their concurrency limit.
+
+    Workers claiming a job of a limited name take turns, holding its
+    JobLock row until they commit, so two can't both see one place free.
+    """
+
+    limit = _handlers[name].concurrency if name in _handlers else None
+    if limit is None:
+        return False
+
+    _lock_name(name)
+    running = (db.session
+               .query(func.count(Job.id))
+               .filter(Job.name == name, Job.status == 'running')
+               .scalar())
+    return running >= limit
+
+
+def _requeue_lost(now):
+    """Queue again any job whose worker stopped without finishing it, or
+    fail it if that was its last attempt."""
+
+    lost = (Job.status == 'running',
+            Job.locked_at < now - VISIBILITY_TIMEOUT)
+
+    (Job
+     .query
+     .filter(*lost, Job.attempts >= Job.max_attempts)
+     .update({'status': 'failed', 'locked_at': None, 'locked_by': None,
+              'dedup_key': None, 'finished_at': now,
+              'last_error': "Worker lost while running the job"},
+             synchronize_session=False))
+    (Job
+     .query
+     .filter(*lost)
+     .update({'status': 'queued', 'locked_at': None, 'locked_by': None},
+             synchronize_session=False))
+
+
+def claim(queues, worker_id):
+    """Mark the next runnable job as running and return it (or None)."""
+
+    now = datetime.utcnow()
+    _requeue_lost(now)
+
+    query = Job.query.filter(Job.status == 'queued',
+                             Job.queue.in_(queues),
+                             Job.run_at <= now)
+
+    # names at their limit, left for later
+    saturated = []
+    while True:
+        if saturated:
+            query = query.filter(Job.name.notin_(saturated))
+        claimed = (query
+                   .order_by(Job.run_at, Job.id)
+                   .with_for_update(skip_locked=True)
+                   .first())
+        if claimed is None or not _saturated(claimed.name):
+            break
+        saturated.append(claimed.name)
+
+    if claimed:
+        claimed.status = 'running'
+        claimed.locked_at = now
+        claimed.locked_by = worker_id
+        claimed.attempts += 1
+
+    db.session.commit()
+    return claimed
+
+
+@contextmanager
+def _heartbeat(claimed):
+    """Renew the lock on `claimed` every HEARTBEAT_INTERVAL while the
+    block runs, so that jobs running longer than VISIBILITY_TIMEOUT aren't
+    taken for lost and run twice.
+
+    The renewals run in a thread of their own, on a connection of their
+    own, as the job's session may be in the middle of a transaction.
+    """
+
+    engine = db.engine
+    renew = (Job.__table__
+             .update()
+             .where(Job.id == claimed.id)
+             .where(Job.status == 'running')
+             .where(Job.locked_by == claimed.locked_by))
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(HEARTBEAT_INTERVAL.total_seconds()):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(renew.values(locked_at=datetime.utcnow()))
+            except SQLAlchemyError:
+                # tried again at the next beat
+                pass
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def run(claimed):
+    """Run a claimed job and record its outcome."""
+
+    handler = _handlers.get(claimed.name)
+
+    try:
+        if handler is None:
+            raise LookupError(f"No handler registered for job {claimed.name}")
+
+        with _heartbeat(claimed):
+            handler.func(**json.loads(claimed.payload))
+            db.session.commit()
+
+    except Exception as exc:
+        db.session.rollback()
+        claimed.last_error = traceback.format_exc()
+
+        if (handler and not isinstance(exc, PermanentJobError)
+                and claimed.attempts < claimed.max_attempts):
+            claimed.status = 'queued'
+            claimed.run_at = (datetime.utcnow()
+                              + RETRY_BASE_DELAY * 2 ** (claimed.attempts - 1))
+            claimed.locked_at = claimed.locked_by = None
+            db.session.commit()
+            return
+
+        claimed.status = 'failed'
+
+    else:
+        claimed.status = 'done'
+
+    claimed.dedup_key = None
+    claimed.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def work(queues=('default',), burst=False, poll_interval=1.0):
+    """Claim and run jobs until stopped.
+
+    With `burst`, return once no job is runnable. Returns the number of
+    jobs run.
+    """
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    count = 0
+
+    while True:
+        claimed = claim(queues, worker_id)
+
+        if claimed:
+            run(claimed)
+            count += 1
+        elif burst:
+            return count
+        else:
+            time.sleep(poll_interval)
+
+
+def queue_stats():
+    """Return {queue: {status: count, ..., 'oldest_queued_seconds': s}}."""
+
+    stats = {}
+
+    counts = (db.session
+              .query(Job.queue, Job.status, func.count(Job.id))
+              .group_by(Job.queue, Job.status))
+
+    for queue, status, count in counts:
+        stats.setdefault(queue, {})[status] = count
+
+    oldest = (db.session
+              .query(Job.queue, func.min(Job.run_at))
+              .filter(Job.status == 'queued')
+              .group_by(Job.queue))
+
+    now = datetime.utcnow()
+    for queue, run_at in oldest:
+        stats[queue]['oldest_queued_seconds'] = max(
+            0, (now - run_at).total_seconds())
+
+    return stats
+
+
+@jobs_cli.command('work')
+@click.option('--queue', '-q', 'queues', multiple=True, default=['default'],
+              show_default=True, help="Queue to take jobs from (repeatable).")
+@click.option('--burst', is_flag=True, help="Exit when no job is runnable.")
+def work_command(queues, burst):
+    """Run background jobs."""
+
+    count = work(queues, burst=burst)
+    click.echo(f"Ran {count} jobs.")
+
+
+@jobs_cli.command('stats')
+def stats_command():
+    """Show queue depth by queue and status."""
+
+    for queue, counts in sorted(queue_stats().items()):
+        details = ", ".join(f"{key}={value}"
+                            for key, value in sorted(counts.items()))
+        click.echo(f"{queue}: {details}")
@@ -0,0 +1,529 @@
+"""Write-behind buffering of likes.
+
+By default `messages_like_toggle()` writes each like in a transaction of
+its own, which locks the message's trending rows and notification until
+it commits: a viral message turns into a queue of requests waiting on
+each other. With LIKES_WRITE_BEHIND on, the route only records the
+intent, (user, message, liked), in a store and returns. Every
+LIKES_FLUSH_INTERVAL_MS a background thread takes what was recorded
+since the last flush, keeps the last intent for each (user, message), and
+applies them in one transaction: a multi-row insert and a delete of
+`likes` per shard, and one trending and notification update per message
+however many users liked it.
+
+Users see their own likes at once: `readmodels` overlays the viewing
+user's pending intents on the `liked` flag of the messages it shows.
+Other users, the likes page and like counts see a like once it is
+flushed.
+
+Durability
+----------
+MemoryStore (the default) keeps intents in process memory, and appends
+each to a journal file of the process, in LIKES_JOURNAL_DIR, before the
+request returns. A journal is only removed once the flush of its intents
+has committed, and applying an intent twice changes nothing (a like that
+exists isn't inserted or counted again), so:
+
+- a process that crashes loses nothing: its journal is adopted by the
+  next flush of any process using the same LIKES_JOURNAL_DIR, or by
+  `flask likes flush`;
+- a machine that crashes may lose the intents the OS had not yet written
+  to disk, unless LIKES_JOURNAL_FSYNC is set, which syncs every intent
+  before the request returns.
+
+The journal directory must outlive the process: the default, under the
+app's instance folder, is on the dyno's own disk on Heroku, which is
+thrown away when a dyno restarts (at least daily), taking with it any
+intents not yet flushed. Use RedisStore there.
+
+Each process keeps its own intents, so if two processes handle a user
+liking and unliking a message, the later flush wins, whichever intent
+was recorded last. MemoryStore is therefore refused when WEB_CONCURRENCY
+(gunicorn's number of worker processes) is more than 1; with several
+nodes, use RedisStore too. Clients send the state they want
+(static/script.js does), so a process needn't know a user's intents
+pending in another to tell what a click means.
+
+RedisStore (LIKES_BUFFER_URL, needs the `redis` package) keeps intents in
+Redis instead, shared by every process and node: the last toggle wins
+whichever process handles it, and every process sees a user's pending
+likes. Intents are as durable as the Redis server's persistence (with
+`appendfsync everysec`, a crash of Redis loses up to a second of them).
+A batch stays in Redis until its flush commits, so an app process that
+crashes mid-flush loses nothing; another takes the batch over once its
+lock expires.
+"""
+
+import fcntl
+import glob
+import os
+import threading
+import time
+import uuid
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import tuple_
+
+import notifications
+import trending
+from models import db, Message, Like
+from pagecache import page_cache
+from shards import shards, BucketMoving
+
+likes_cli = AppGroup('likes', help="Manage write-behind likes.")
+
+
+def _newest(*sources):
+    """Merge {message id: (liked, recorded at)} dicts, keeping the most
+    recent intent for each message."""
+
+    merged = {}
+    for source in sources:
+        for message_id, (liked, at) in source.items():
+            if message_id not in merged or merged[message_id][1] <= at:
+                merged[message_id] = (liked, at)
+    return merged
+
+
+class MemoryStore:
+    """Intents in process memory, journaled to a file per process in
+    `journal_dir`."""
+
+    def __init__(self, journal_dir, fsync=False):
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._pid = None
+
+        # {user id: {message id: (liked, recorded at)}}, recorded since the
+        # last flush, and being flushed
+        self._pending = {}
+        self._in_flight = {}
+
+    def _open(self):
+        """Start this process's journal, if it hasn't yet (a forked
+        worker needs its own)."""
+
+        if self._pid == os.getpid():
+            return
+
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self._base = os.path.join(self.journal_dir, uuid.uuid4().hex)
+
+        # held while the process lives: a journal whose lock can be taken
+        # is that of a process that is gone. Locked before it gets the
+        # name other processes look for.
+        self._lock_file = open(self._base + '.locking', 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(self._base + '.locking', self._base + '.lock')
+
+        self._journal = open(self._base + '.journal', 'a')
+        self._pid = os.getpid()
+
+    def _write(self, lines, sync=False):
+        self._journal.writelines(lines)
+        self._journal.flush()
+        if sync or self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _merge(self, user_id, message_id, liked, at):
+        intents = self._pending.setdefault(user_id, {})
+        if message_id not in intents or intents[message_id][1] <= at:
+            intents[message_id] = (liked, at)
+
+    def add(self, user_id, message_id, liked, at=None):
+        """Record that `user_id` (un)liked `message_id`."""
+
+        at = time.time() if at is None else at
+
+        with self._lock:
+            self._open()
+            self._write([f"{user_id} {message_id} {int(liked)} {at!r}\n"])
+            self._merge(user_id, message_id, liked, at)
+
+    def pending_for(self, user_id):
+        """{message id: liked} of `user_id`'s intents not yet flushed."""
+
+        with self._lock:
+            intents = _newest(self._in_flight.get(user_id, {}),
+                              self._pending.get(user_id, {}))
+        return {message_id: liked
+                for message_id, (liked, at) in intents.items()}
+
+    def _adopt(self):
+        """Take over the journals of processes that are gone."""
+
+        for lock_path in glob.glob(os.path.join(self.journal_dir, '*.lock')):
+            base = lock_path[:-len('.lock')]
+            if base == self._base:
+                continue
+
+            with open(lock_path) as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+
+                # their batch being flushed, if any, then what followed
+                paths = [base + '.flushing', base + '.journal']
+                lines = []
+                for path in paths:
+                    if os.path.exists(path):
+                        with open(path) as journal:
+                            lines += journal.readlines()
+
+                # a line cut short by the crash was never acknowledged
+                lines = [line for line in lines
+                         if line.endswith('\n') and len(line.split()) == 4]
+
+                # safe in our journal before theirs goes
+                self._write(lines, sync=True)
+                for line in lines:
+                    user_id, message_id, liked, at = line.split()
+                    self._merge(int(user_id), int(message_id),
+                                liked == '1', float(at))
+
+                for path in paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+                os.remove(lock_path)
+
+    def take(self):
+        """Start a flush: {(user id, message id): liked} of every intent
+        recorded since the last successful one. Call `done()` once they
+        are committed."""
+
+        with self._lock:
+            self._open()
+            self._adopt()
+            if not self._pending and not self._in_flight:
+                return {}
+
+            journal = self._base + '.journal'
+            flushing = self._base + '.flushing'
+            self._journal.close()
+
+            if os.path.exists(flushing):
+                # the last flush failed; its intents go again, with the new
+                with open(journal) as src, open(flushing, 'a') as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(journal)
+            else:
+                os.rename(journal, flushing)
+            self._journal = open(journal, 'a')
+
+            for user_id, intents in self._pending.items():
+                in_flight = self._in_flight.setdefault(user_id, {})
+                in_flight.update(_newest(in_flight, intents))
+            self._pending = {}
+
+            return {(user_id, message_id): liked
+                    for user_id, intents in self._in_flight.items()
+                    for message_id, (liked, at) in intents.items()}
+
+    def done(self):
+        """End a flush whose intents are committed."""
+
+        with self._lock:
+            self._in_flight = {}
+            os.remove(self._base + '.flushing')
+
+
+# the batch being flushed; set, with a lock, by one process at a time
+_PENDING = 'likes:pending'
+_FLUSHING = 'likes:flushing'
+_FLUSH_LOCK = 'likes:flush-lock'
+
+# how long a user's pending likes are overlaid on what they read; well
+# beyond any flush
+_OVERLAY_TTL = 300
+
+
+class RedisStore:
+    """Intents in Redis, shared by every process and node using the same
+    server."""
+
+    def __init__(self, url, lock_timeout=30):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(
+                "LIKES_BUFFER_URL needs the 'redis' package installed")
+
+        self._client = redis.Redis.from_url(url)
+        self.lock_timeout = lock_timeout
+        self._token = None
+
+    def add(self, user_id, message_id, liked, at=None):
+        """Record that `user_id` (un)liked `message_id`."""
+
+        overlay = f"likes:user:{user_id}"
+        pipeline = self._client.pipeline()
+        pipeline.hset(_PENDING, f"{user_id}:{message_id}", int(liked))
+        pipeline.hset(overlay, message_id, int(liked))
+        pipeline.expire(overlay, _OVERLAY_TTL)
+        pipeline.execute()
+
+    def pending_for(self, user_id):
+        """{message id: liked} of `user_id`'s recent intents."""
+
+        return {int(message_id): liked == b'1'
+                for message_id, liked in self._client.hgetall(
+                    f"likes:user:{user_id}").items()}
+
+    def take(self):
+        """Start a flush; see MemoryStore.take. Returns {} while another
+        process is flushing."""
+
+        token = uuid.uuid4().hex
+        if not self._client.set(_FLUSH_LOCK, token, nx=True,
+                                ex=self.lock_timeout):
+            return {}
+        self._token = token
+
+        # a batch left by a flush that failed or died goes first
+        if not self._client.exists(_FLUSHING):
+            if not self._client.exists(_PENDING):
+                self._release()
+                return {}
+            self._client.rename(_PENDING, _FLUSHING)
+
+        intents = {}
+        for field, liked in self._client.hgetall(_FLUSHING).items():
+            user_id, message_id = map(int, field.split(b':'))
+            intents[user_id, message_id] = liked == b'1'
+        return intents
+
+    def done(self):
+        """End a flush whose intents are committed."""
+
+        self._client.delete(_FLUSHING)
+        self._release()
+
+    def _release(self):
+        # only our own lock, not one another process took after ours expired
+        if self._client.get(_FLUSH_LOCK) == self._token.encode():
+            self._client.delete(_FLUSH_LOCK)
+        self._token = None
+
+
+def apply(intents):
+    """Bring `likes` in line with `intents`, {(user id, message id):
+    liked}, and count the likes added and removed in trending and
+    notifications, in one transaction per database.
+
+    Intents on messages that are gone are dropped. Returns those on
+    messages whose shard bucket is being moved, to apply later.
+    """
+
+    by_message = {}
+    for (user_id, message_id), liked in intents.items():
+        by_message.setdefault(message_id, {})[user_id] = liked
+
+    retry = {}
+    added_likes = []
+    # users who liked or unliked something
+    likers = set()
+
+    for session in shards.all():
+        messages = []
+        for msg in (session
+                    .query(Message.id, Message.user_id)
+                    .filter(Message.id.in_(list(by_message)))):
+            try:
+                shards.for_user(msg.user_id, write=True)
+                messages.append(msg)
+            except BucketMoving:
+                retry.update({(user_id, msg.id): liked for user_id, liked
+                              in by_message[msg.id].items()})
+        if not messages:
+            continue
+
+        keys = [(user_id, msg.id)
+                for msg in messages for user_id in by_message[msg.id]]
+        # key -> when it was liked
+        existing = {(user_id, message_id): created_at
+                    for user_id, message_id, created_at in (
+                        session
+                        .query(Like.user_id, Like.message_id,
+                               Like.created_at)
+                        .filter(tuple_(Like.user_id,
+                                       Like.message_id).in_(keys)))}
+
+        added = [key for key in keys
+                 if intents[key] and key not in existing]
+        removed = [key for key in keys
+                   if not intents[key] and key in existing]
+
+        session.bulk_insert_mappings(Like, [
+            {'user_id': user_id, 'message_id': message_id}
+            for user_id, message_id in added])
+        if removed:
+            (session
+             .query(Like)
+             .filter(tuple_(Like.user_id, Like.message_id).in_(removed))
+             .delete(synchronize_session=False))
+
+        by_id = {msg.id: msg for msg in messages}
+        added_ids = [message_id for user_id, message_id in added]
+        for msg in messages:
+            if msg.id in added_ids:
+                trending.record_like(msg, count=added_ids.count(msg.id))
+        for key in removed:
+            trending.record_like(by_id[key[1]], liked=False,
+                                 liked_at=existing[key])
+
+        added_likes += [(user_id, by_id[message_id])
+                        for user_id, message_id in added]
+        likers.update(user_id for user_id, message_id in added + removed)
+
+    notifications.notify_likes(added_likes)
+    shards.commit()
+    # the likers' profiles count their likes
+    page_cache.forget_users(*likers)
+
+    return retry
+
+
+class LikeBuffer:
+    """Records likes for write-behind, when turned on for an app."""
+
+    def __init__(self, app=None):
+        self.store = None
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LIKES_WRITE_BEHIND', False)
+        app.config.setdefault('LIKES_FLUSH_INTERVAL_MS', 200)
+        app.config.setdefault('LIKES_JOURNAL_DIR',
+                              os.path.join(app.instance_path,
+                                           'likes-journal'))
+        app.config.setdefault('LIKES_JOURNAL_FSYNC', False)
+        app.config.setdefault('LIKES_BUFFER_URL', None)
+
+        self.app = app
+        app.cli.add_command(likes_cli)
+
+        store = None
+        if app.config['LIKES_WRITE_BEHIND']:
+            url = app.config['LIKES_BUFFER_URL']
+            if url:
+                store = RedisStore(url)
+            elif app.config.get('WEB_CONCURRENCY', 1) > 1:
+                raise RuntimeError(
+                    "LIKES_WRITE_BEHIND with several web processes needs "
+                    "LIKES_BUFFER_URL: each would buffer likes of its own")
+            else:
+                store = MemoryStore(app.config['LIKES_JOURNAL_DIR'],
+                                    app.config['LIKES_JOURNAL_FSYNC'])
+        self.configure(store)
+
+    def configure(self, store):
+        """Buffer likes in `store`; with None, write them through."""
+
+        self.store = store
+
+    @property
+    def enabled(self):
+        return self.store is not None
+
+    def toggle(self, session, msg, user_id, liked=None):
+        """Record that `user_id` toggled their like of `msg`, which was
+        loaded in `session`, or, with `liked`, that they (un)liked it;
+        returns whether they now like it."""
+
+        if liked is None:
+            was_liked = self.store.pending_for(user_id).get(msg.id)
+            if was_liked is None:
+                was_liked = session.query(Like.query
+                                          .filter_by(message_id=msg.id,
+                                                     user_id=user_id)
+                                          .exists()).scalar()
+            liked = not was_liked
+
+        self.store.add(user_id, msg.id, liked)
+        self._start_flusher()
+
+        return liked
+
+    def pending_for(self, user_id):
+        """{message id: liked} of what `user_id` liked or unliked that
+        isn't flushed yet (empty when likes are written through)."""
+
+        return self.store.pending_for(user_id) if self.enabled else {}
+
+    def flush(self):
+        """Apply the intents recorded so far; returns how many."""
+
+        intents = self.store.take()
+        if not intents:
+            return 0
+
+        try:
+            retry = apply(intents)
+        except Exception:
+            for session in shards.all() + [db.session]:
+                session.rollback()
+            raise
+
+        for (user_id, message_id), liked in retry.items():
+            self.store.add(user_id, message_id, liked)
+        self.store.done()
+
+        return len(intents) - len(retry)
+
+    def _start_flusher(self):
+        interval = self.app.config['LIKES_FLUSH_INTERVAL_MS']
+        if not interval or self._flusher_running():
+            return
+
+        with self._flusher_lock:
+            if not self._flusher_running():
+                self._flusher = threading.Thread(
+                    target=self._flush_every,
+                    args=(self.store, interval / 1000),
+                    daemon=True)
+                self._flusher.pid = os.getpid()
+                self._flusher.store = self.store
+                self._flusher.start()
+
+    def _flusher_running(self):
+        # a forked worker doesn't inherit its parent's thread
+        return (self._flusher is not None
+                and self._flusher.pid == os.getpid()
+                and self._flusher.is_alive()
+                and self._flusher.store is self.store)
+
+    def _flush_every(self, store, seconds):
+        while True:
+            time.sleep(seconds)
+            # stop once configured otherwise
+            if self.store is not store:
+                return
+
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    # the intents stay journaled; the next flush retries
+                    self.app.logger.exception("Flushing likes failed")
+
+
+like_buffer = LikeBuffer()
+
+
+@likes_cli.command('flush')
+def flush_command():
+    """Apply buffered likes, including those of processes that are gone."""
+
+    if not like_buffer.enabled:
+        raise click.ClickException("LIKES_WRITE_BEHIND is off")
+
+    click.echo(f"Flushed {like_buffer.flush()} likes.")
@@ -0,0 +1,172 @@
+"""In-process pub/sub that wakes live timeline streams on new messages.
+
+`messages_add()` publishes (author id, message id) after committing; every
+open `/timeline/stream` or `/timeline/poll` request holds a Subscription to
+the authors on its timeline and is woken when one of them posts. Streams
+then read the new messages from the database by id, so a missed event can
+only delay an update, never lose it.
+
+Publishing goes through a backend. LocalBackend delivers within this
+process; RedisBackend (LIVE_BROADCAST_URL, needs the `redis` package)
+fans events out to every process and node subscribed to the channel.
+
+A waiting request holds one of the process's threads (the Procfile runs
+gunicorn's gthread workers), so at most LIVE_MAX_WAITING requests of a
+process wait at once; `Broker.waiting()` hands out those places. Others
+are answered at once and told to come back later, leaving the remaining
+threads to the rest of the site.
+"""
+
+import queue
+import threading
+from contextlib import contextmanager
+
+from flask import current_app, json
+
+CHANNEL = 'warbler:messages'
+
+
+class Subscription:
+    """Message ids posted by a fixed set of authors, as they arrive."""
+
+    def __init__(self, broker, author_ids):
+        self.broker = broker
+        self.author_ids = frozenset(author_ids)
+        self._events = queue.Queue()
+
+    def deliver(self, message_id):
+        self._events.put(message_id)
+
+    def wait(self, timeout):
+        """Return the ids published since the last call.
+
+        Blocks up to `timeout` seconds for the first one; returns [] if
+        none arrived.
+        """
+
+        try:
+            ids = [self._events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while True:
+            try:
+                ids.append(self._events.get_nowait())
+            except queue.Empty:
+                return ids
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LocalBackend:
+    """Delivers published events to this process's subscribers only."""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def send(self, author_id, message_id):
+        self.broker.deliver(author_id, message_id)
+
+
+class RedisBackend:
+    """Broadcasts events through a Redis channel to every subscribed node."""
+
+    def __init__(self, broker, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(
+                "LIVE_BROADCAST_URL needs the 'redis' package installed")
+
+        self.broker = broker
+        self._client = redis.Redis.from_url(url)
+
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CHANNEL)
+        self._listener = threading.Thread(target=self._listen,
+                                          args=(pubsub,),
+                                          daemon=True)
+        self._listener.start()
+
+    def send(self, author_id, message_id):
+        self._client.publish(CHANNEL, json.dumps([author_id, message_id]))
+
+    def _listen(self, pubsub):
+        for event in pubsub.listen():
+            author_id, message_id = json.loads(event['data'])
+            self.broker.deliver(author_id, message_id)
+
+
+class Broker:
+    """Routes published messages to the subscriptions of their authors."""
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self.backend = LocalBackend(self)
+
+    def init_app(self, app):
+        # half of the Procfile's --threads
+        app.config.setdefault('LIVE_MAX_WAITING', 4)
+
+        url = app.config.get('LIVE_BROADCAST_URL')
+        if url:
+            self.backend = RedisBackend(self, url)
+
+    @contextmanager
+    def waiting(self):
+        """Hold one of the LIVE_MAX_WAITING places for requests waiting
+        for new messages. Yields whether a place was free; if not, the
+        request must not wait."""
+
+        with self._lock:
+            allowed = self._waiting < current_app.config['LIVE_MAX_WAITING']
+            if allowed:
+                self._waiting += 1
+
+        try:
+            yield allowed
+        finally:
+            if allowed:
+                with self._lock:
+                    self._waiting -= 1
+
+    def subscribe(self, author_ids):
+        subscription = Subscription(self, author_ids)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, author_id, message_id):
+        """Announce that `author_id` posted `message_id`."""
+
+        self.backend.send(author_id, message_id)
+
+    def deliver(self, author_id, message_id):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+
+        for subscription in subscriptions:
+            if author_id in subscription.author_ids:
+                subscription.deliver(message_id)
+
+
+def format_event(event_id, data):
+    """Format one server-sent event carrying `data` as JSON."""
+
+    return f"id: {event_id}\ndata: {json.dumps(data)}\n\n"
+
+
+broker = Broker()
@@ -0,0 +1,429 @@
+"""One-off schema and data migrations for existing Warbler databases.
+
+New databases get the current schema from `db.create_all()` (see seed.py);
+these bring databases created by older versions up to date. Run them with
+`flask migrate <name>`; `flask migrate schema` first, after every upgrade.
+"""
+
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import MetaData, bindparam, func, inspect
+
+import archive
+import snowflake
+from models import (db, User, Message, Like, ArchivedMessage, ArchivedLike,
+                    RenumberedMessage, TrendingScore, MessageTag,
+                    MessageMention, MessageBucket, Notification)
+from shards import shards, shard_metadata
+
+MICROSECOND = timedelta(microseconds=1)
+
+# ids below this were handed out by the old autoincrementing column
+LEGACY_ID_LIMIT = 1 << 32
+
+# replaced by ix_messages_user_id_id now that ids are time-ordered
+OBSOLETE_MESSAGE_INDEXES = ['ix_messages_user_id_timestamp',
+                            'ix_messages_timestamp']
+
+migrate_cli = AppGroup('migrate', help="Migrate an existing database.")
+
+
+def _create_missing_indexes(table, engine=None):
+    """Create any index declared on `table` that the database lacks."""
+
+    engine = engine or db.engine
+    existing = {ix['name'] for ix in inspect(engine).get_indexes(table.name)}
+
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(engine)
+
+
+def _add_missing_columns(table, engine=None):
+    """Add any column declared on `table` that the database lacks.
+
+    Only nullable columns, or ones with a server default, can be added
+    this way.
+    """
+
+    engine = engine or db.engine
+    existing = {col['name'] for col in inspect(engine).get_columns(table.name)}
+    dialect = engine.dialect
+
+    for column in table.columns:
+        if column.name in existing:
+            continue
+
+        ddl = (f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+               f"{column.type.compile(dialect=dialect)}")
+
+        if column.server_default is not None:
+            default = column.server_default.arg
+            if isinstance(default, str):
+                ddl += f" DEFAULT '{default}'"
+            else:
+                ddl += f" DEFAULT {default.compile(dialect=dialect)}"
+
+        with engine.begin() as conn:
+            conn.execute(ddl)
+
+
+def upgrade_schema():
+    """Create new tables, columns and indexes declared in models.py, in
+    the main database and on every shard, and the message partitions for
+    the coming months where messages are partitioned."""
+
+    db.create_all()
+
+    for table in db.metadata.sorted_tables:
+        _add_missing_columns(table)
+        _create_missing_indexes(table)
+
+    for engine in shards.engines:
+        metadata = shard_metadata()
+        metadata.create_all(engine)
+
+        for table in metadata.sorted_tables:
+            _add_missing_columns(table, engine)
+            _create_missing_indexes(table, engine)
+
+    archive.maintain_partitions()
+
+
+# Postgres spreads timestamps in one statement: with rows numbered in
+# (timestamp, id) order, each row moves to the latest of "its own
+# timestamp, or that of any row before it plus one microsecond per row
+# between them", which keeps every row at or after its own time, in
+# order and a microsecond or more from the next.
+_SPREAD_TIMESTAMPS = """
+UPDATE messages SET timestamp = spread.timestamp
+FROM (
+    SELECT id,
+           max(timestamp - position * interval '1 microsecond')
+               OVER (ORDER BY position)
+           + position * interval '1 microsecond' AS timestamp
+    FROM (
+        SELECT id, timestamp,
+               row_number() OVER (ORDER BY timestamp, id) AS position
+        FROM messages
+    ) numbered
+) spread
+WHERE messages.id = spread.id AND messages.timestamp <> spread.timestamp
+"""
+
+
+def repair_message_timestamps(batch_size=1000):
+    """Give every message a distinct, insertion-ordered timestamp.
+
+    Messages used to be stamped with the time their worker process started,
+    so many rows share one timestamp. The true times are lost; the best
+    ordering left is insertion order, so rows sharing a timestamp are
+    spread a microsecond apart in id order, pushing on later rows they
+    would run into. Returns the number of rows changed.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        # now() is the server's local time, and messages are stamped in UTC
+        db.session.execute(
+            "ALTER TABLE messages ALTER COLUMN timestamp DROP DEFAULT")
+
+    _create_missing_indexes(Message.__table__)
+
+    if db.engine.dialect.name == 'postgresql':
+        changed = db.session.execute(_SPREAD_TIMESTAMPS).rowcount
+        db.session.commit()
+        return changed
+
+    # elsewhere the same, numbering rows in SQL and spreading them here
+    position = (func.row_number()
+                .over(order_by=(Message.timestamp, Message.id))
+                .label('position'))
+    rows = (db.session
+            .query(Message.id, Message.timestamp, position)
+            .order_by(position)
+            .yield_per(batch_size))
+
+    update = (Message.__table__
+              .update()
+              .where(Message.id == bindparam('message_id'))
+              .values(timestamp=bindparam('new_timestamp')))
+
+    changes = []
+    start = None
+    for row in rows:
+        base = row.timestamp - row.position * MICROSECOND
+        start = base if start is None else max(start, base)
+        timestamp = start + row.position * MICROSECOND
+        if timestamp != row.timestamp:
+            changes.append({'message_id': row.id, 'new_timestamp': timestamp})
+
+    changed = len(changes)
+    for i in range(0, changed, batch_size):
+        db.session.execute(update, changes[i:i + batch_size])
+
+    db.session.commit()
+    return changed
+
+
+def widen_message_ids(engine):
+    """Make message id columns 64-bit and index messages by (user_id, id)
+    instead of by timestamp. SQLite integers are 64-bit already."""
+
+    tables = inspect(engine).get_table_names()
+
+    with engine.begin() as conn:
+        if engine.dialect.name == 'postgresql':
+            conn.execute("ALTER TABLE messages ALTER COLUMN id DROP DEFAULT")
+            conn.execute("ALTER TABLE messages ALTER COLUMN id TYPE BIGINT")
+            conn.execute(
+                "ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT")
+            if 'trending_scores' in tables:
+                conn.execute("ALTER TABLE trending_scores "
+                             "ALTER COLUMN target_id TYPE BIGINT")
+
+        for name in OBSOLETE_MESSAGE_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+    _create_missing_indexes(Message.__table__, engine)
+
+
+def renumber_messages(session, worker_id=0, batch_size=1000):
+    """Give messages with old autoincrement ids snowflake ids made from
+    their timestamps, oldest first, so they sort by id like new messages.
+
+    Likes, tags and mentions (in the same database) follow the new ids, as
+    do the main database's trending scores, message buckets and like
+    notifications; `renumbered_messages` keeps the old ids for links to
+    them. Pass each database a different `worker_id` so their new ids
+    can't collide. Returns the number of messages renumbered.
+    """
+
+    # kept with the messages
+    updates = [(model.__table__
+                .update()
+                .where(model.message_id == bindparam('old_id'))
+                .values(message_id=bindparam('new_id')))
+               for model in (Like, MessageTag, MessageMention)]
+
+    # kept in the main database
+    update_scores = (TrendingScore.__table__
+                     .update()
+                     .where(TrendingScore.kind == 'message')
+                     .where(TrendingScore.target_id == bindparam('old_id'))
+                     .values(target_id=bindparam('new_id')))
+    update_buckets = (MessageBucket.__table__
+                      .update()
+                      .where(MessageBucket.message_id == bindparam('old_id'))
+                      .values(message_id=bindparam('new_id')))
+    update_notifications = (
+        Notification.__table__
+        .update()
+        .where(Notification.kind == 'like')
+        .where(Notification.target_id == bindparam('old_id'))
+        .values(target_id=bindparam('new_id')))
+
+    renumbered = 0
+    last_id = None
+
+    while True:
+        rows = (session
+                .query(Message.id, Message.text,
+                       Message.timestamp, Message.user_id)
+                .filter(Message.id < LEGACY_ID_LIMIT)
+                .order_by(Message.timestamp, Message.id)
+                .limit(batch_size)
+                .all())
+        if not rows:
+            return renumbered
+
+        new_rows, changes = [], []
+        for row in rows:
+            new_id = snowflake.from_datetime(row.timestamp, worker_id)
+            if last_id is not None and new_id <= last_id:
+                # same millisecond as the previous message
+                new_id = last_id + 1
+                if new_id & snowflake.MAX_SEQUENCE == 0:
+                    # the sequence ran out and would carry into the
+                    # worker id: on to the next millisecond
+                    new_id = snowflake.make_id(
+                        (last_id >> snowflake.TIMESTAMP_SHIFT) + 1,
+                        worker_id)
+            last_id = new_id
+
+            new_rows.append(dict(row._asdict(), id=new_id))
+            changes.append({'old_id': row.id, 'new_id': new_id})
+
+        session.bulk_insert_mappings(Message, new_rows)
+        for update in updates:
+            session.execute(update, changes)
+        (session
+         .query(Message)
+         .filter(Message.id.in_([change['old_id'] for change in changes]))
+         .delete(synchronize_session=False))
+        session.commit()
+
+        for update in (update_scores, update_buckets, update_notifications):
+            db.session.execute(update, changes)
+        db.session.bulk_insert_mappings(RenumberedMessage, changes)
+        db.session.commit()
+
+        renumbered += len(rows)
+
+
+def migrate_to_snowflake_ids(batch_size=1000):
+    """Widen message id columns and renumber old messages, in the main
+    database and every shard. Returns the number of messages renumbered."""
+
+    widen_message_ids(db.engine)
+    renumbered = renumber_messages(db.session, 0, batch_size)
+
+    for index, (engine, session) in enumerate(zip(shards.engines,
+                                                  shards.sessions),
+                                              start=1):
+        widen_message_ids(engine)
+        renumbered += renumber_messages(session, index, batch_size)
+
+    return renumbered
+
+
+def _partitioned_metadata(shard):
+    """Copies of the message, like and archive tables, partitioned by
+    message id as `archive.PARTITION_KEYS` says."""
+
+    if shard:
+        metadata = shard_metadata()
+    else:
+        metadata = MetaData()
+        for table in (User.__table__, Message.__table__, Like.__table__,
+                      ArchivedMessage.__table__, ArchivedLike.__table__):
+            table.tometadata(metadata)
+
+    for name, key in archive.PARTITION_KEYS.items():
+        metadata.tables[name].dialect_kwargs['postgresql_partition_by'] = (
+            f"RANGE ({key})")
+
+    return metadata
+
+
+def _id_span(conn, tables):
+    """(lowest, highest) message id in `tables`, or None if they're empty."""
+
+    spans = [conn.execute(f"SELECT min({key}), max({key}) FROM {table}").first()
+             for table, key in tables]
+    spans = [span for span in spans if span[0] is not None]
+    if not spans:
+        return None
+
+    return min(low for low, high in spans), max(high for low, high in spans)
+
+
+def partition_tables(engine, metadata):
+    """Replace the message, like and archive tables of the Postgres
+    database at `engine` with ones partitioned by month, and copy their
+    rows over, in one transaction.
+
+    Returns False if they are partitioned already.
+    """
+
+    tables = [metadata.tables[name] for name in archive.PARTITION_KEYS]
+
+    with engine.begin() as conn:
+        if archive.is_partitioned(conn):
+            return False
+
+        span = _id_span(conn, archive.PARTITION_KEYS.items())
+        if span and span[0] < LEGACY_ID_LIMIT:
+            raise RuntimeError(
+                "Messages need snowflake ids first: "
+                "run `flask migrate snowflake-ids`")
+
+        # index names are unique per schema, not per table
+        inspector = inspect(conn)
+        for table in tables:
+            indexes = ([ix['name'] for ix in inspector.get_indexes(table.name)]
+                       + [inspector.get_pk_constraint(table.name)['name']])
+            conn.execute(f"ALTER TABLE {table.name} "
+                         f"RENAME TO {table.name}_unpartitioned")
+            for index in indexes:
+                conn.execute(f'ALTER INDEX "{index}" '
+                             f'RENAME TO "{index}_unpartitioned"')
+
+        metadata.create_all(conn, tables=tables)
+
+        now = datetime.utcnow()
+        hot = _id_span(conn, [('messages_unpartitioned', 'id')])
+        first = snowflake.to_datetime(hot[0]) if hot else now
+        for month in archive.months(first, now):
+            for table in ('messages', 'likes'):
+                archive.create_partition(conn, table, month)
+
+        cold = _id_span(conn, [('archived_messages_unpartitioned', 'id')])
+        if cold:
+            for month in archive.months(snowflake.to_datetime(cold[0]),
+                                        snowflake.to_datetime(cold[1])):
+                for table in ('archived_messages', 'archived_likes'):
+                    archive.create_partition(conn, table, month)
+
+        for table in tables:
+            columns = ', '.join(column.name for column in table.c)
+            conn.execute(f"INSERT INTO {table.name} ({columns}) "
+                         f"SELECT {columns} FROM {table.name}_unpartitioned")
+
+        for table in reversed(tables):
+            conn.execute(f"DROP TABLE {table.name}_unpartitioned")
+
+    return True
+
+
+def partition_messages():
+    """Partition the message, like and archive tables by month in every
+    Postgres database holding them, and create the partitions for the
+    coming months. Returns the number of databases partitioned."""
+
+    partitioned = 0
+    for engine, shard in ([(db.engine, False)]
+                          + [(engine, True) for engine in shards.engines]):
+        if (engine.dialect.name == 'postgresql'
+                and partition_tables(engine, _partitioned_metadata(shard))):
+            partitioned += 1
+
+    archive.maintain_partitions()
+    return partitioned
+
+
+@migrate_cli.command('schema')
+def upgrade_schema_command():
+    """Add tables, columns and indexes missing from the database."""
+
+    upgrade_schema()
+    click.echo("Schema is up to date.")
+
+
+@migrate_cli.command('message-timestamps')
+def repair_message_timestamps_command():
+    """Spread out duplicated message timestamps and add ordering indexes."""
+
+    changed = repair_message_timestamps()
+    click.echo(f"Repaired {changed} message timestamps.")
+
+
+@migrate_cli.command('snowflake-ids')
+def migrate_to_snowflake_ids_command():
+    """Switch messages to time-ordered 64-bit ids."""
+
+    renumbered = migrate_to_snowflake_ids()
+    click.echo(f"Renumbered {renumbered} messages.")
+
+
+@migrate_cli.command('partition-messages')
+def partition_messages_command():
+    """Partition messages and likes by month (Postgres 12 or later)."""
+
+    try:
+        partitioned = partition_messages()
+    except RuntimeError as exc:
+        raise click.ClickException(str(exc))
+
+    click.echo(f"Partitioned {partitioned} databases.")
@@ -5,6 +5,8 @@ from datetime import datetime
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
+import snowflake
+
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
@@ -29,6 +31,59 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # unknown for follows made before it was recorded
+    created_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_follows_created_at', 'created_at'),
+    )
+
+
+class Blocks(db.Model):
+    """A user blocking another: neither sees the other's messages or
+    profile, and they can't follow each other (see blocks.py)."""
+
+    __tablename__ = 'blocks'
+
+    user_being_blocked_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    user_blocking_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    __table_args__ = (
+        db.Index('ix_blocks_user_blocking_id', 'user_blocking_id',
+                 'user_being_blocked_id'),
+    )
+
+
+class Mutes(db.Model):
+    """A user muting another, whose messages they then don't see in
+    timelines (see blocks.py)."""
+
+    __tablename__ = 'mutes'
+
+    user_muting_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    user_being_muted_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -62,6 +117,16 @@ class User(db.Model):
         default=DEFAULT_HEADER_IMAGE_URL,
     )
 
+    # resized local copies of image_url and header_image_url, made by the
+    # images.process_user_images job; None until then
+    image_thumb_url = db.Column(
+        db.Text,
+    )
+
+    header_image_thumb_url = db.Column(
+        db.Text,
+    )
+
     bio = db.Column(
         db.Text,
     )
@@ -70,35 +135,104 @@ class User(db.Model):
         db.Text,
     )
 
+    # where `location` is, as found in the gazetteer, and its geohash for
+    # nearby-user searches (see geo.py); None until geocoded, or if the
+    # place isn't known
+    latitude = db.Column(
+        db.Float,
+    )
+
+    longitude = db.Column(
+        db.Float,
+    )
+
+    geohash = db.Column(
+        db.String(12),
+        index=True,
+    )
+
     password = db.Column(
         db.Text,
         nullable=False,
     )
 
-    messages = db.relationship('Message', order_by='Message.timestamp.desc()')
+    # set when the account is deleted; the rows are reclaimed later by
+    # purge.purge_deleted_users()
+    deleted_at = db.Column(
+        db.DateTime,
+        index=True,
+    )
+
+    # when username or email were set; other processes look for changes
+    # newer than their last look (see usernames.py)
+    names_changed_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+        index=True,
+    )
+
+    # notifications not yet seen, kept up to date as they are written
+    # (see notifications.py)
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # passive_deletes: the FKs cascade in the database, so deleting a user
+    # must not load these collections first
+
+    messages = db.relationship(
+        'Message',
+        order_by='Message.id.desc()',
+        passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=db.and_(Follows.user_following_id == id,
+                              deleted_at.is_(None)),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=db.and_(Follows.user_being_followed_id == id,
+                              deleted_at.is_(None)),
+        passive_deletes=True,
     )
 
     messages_liked = db.relationship(
         "Message", 
         secondary="likes",
-        backref="message_likers",)
+        backref=db.backref("message_likers", passive_deletes=True),
+        passive_deletes=True,)
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @property
+    def avatar(self):
+        """URL to show this user's profile image at."""
+
+        return self.image_thumb_url or self.image_url
+
+    @property
+    def header(self):
+        """URL to show this user's header image at."""
+
+        return self.header_image_thumb_url or self.header_image_url
+
+    @classmethod
+    def active(cls):
+        """Query of users whose accounts have not been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
@@ -141,7 +275,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -156,9 +290,12 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # time-ordered (see snowflake.py): newest first is id descending
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=snowflake.next_id,
     )
 
     text = db.Column(
@@ -169,7 +306,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -180,6 +317,10 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
+
 
 class Like(db.Model):
     """Connection of a user <-> liked message"""
@@ -187,7 +328,7 @@ class Like(db.Model):
     __tablename__ = 'likes'
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete="cascade"),
         primary_key=True,
     )
@@ -196,7 +337,617 @@ class Like(db.Model):
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
         primary_key=True,
-    ) 
+    )
+
+    # unknown for likes made before it was recorded
+    created_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_likes_created_at', 'created_at'),
+    )
+
+
+class MessageTag(db.Model):
+    """A hashtag used in a message (see tags.py)."""
+
+    __tablename__ = 'message_tags'
+
+    # lowercased, without the '#'
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # no foreign key to messages, which would keep them from being
+    # partitioned and archived (see archive.py); rows are deleted with
+    # their message by tags.forget_messages()
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_message_tags_message_id', 'message_id'),
+    )
+
+
+class MessageMention(db.Model):
+    """An @mention of a user in a message (see tags.py)."""
+
+    __tablename__ = 'message_mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # not a foreign key; see MessageTag.message_id
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_message_mentions_message_id', 'message_id'),
+    )
+
+
+class RenumberedMessage(db.Model):
+    """The snowflake id a message with an old autoincrement id was given
+    (see migrations.renumber_messages), so links to it keep working."""
+
+    __tablename__ = 'renumbered_messages'
+
+    old_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    new_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+
+class ArchivedMessage(db.Model):
+    """A message moved out of `messages` once it got old (see archive.py).
+
+    Only read by id, by `messages_show()`.
+    """
+
+    __tablename__ = 'archived_messages'
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_archived_messages_user_id_id', 'user_id', 'id'),
+    )
+
+
+class ArchivedLike(db.Model):
+    """A like on an archived message."""
+
+    __tablename__ = 'archived_likes'
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('archived_messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+    )
+
+
+class TrendingScore(db.Model):
+    """Time-decayed activity score of a message or user for one window.
+
+    `score` is the log of the decayed activity weight measured against a
+    fixed epoch, so it only ever changes when new activity is recorded and
+    ordering by it ranks targets by their current decayed weight.
+    """
+
+    __tablename__ = 'trending_scores'
+
+    kind = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # a message or user id
+    target_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    window = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_trending_scores_rank', 'kind', 'window', 'score'),
+    )
+
+
+class Notification(db.Model):
+    """Likes of a user's message, or new followers of a user, within one
+    time bucket, coalesced into one row (see notifications.py)."""
+
+    __tablename__ = 'notifications'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recipient_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    # 'like' or 'follow'
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # the message liked or the user followed; not a foreign key, as
+    # messages may be on another shard
+    target_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    # hours since notifications.EPOCH
+    bucket = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # the latest user to like or follow; None once they are purged
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="set null"),
+    )
+
+    # how many users liked or followed; each is in notification_actors
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    unread = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.UniqueConstraint('recipient_id', 'kind', 'target_id', 'bucket',
+                            name='uq_notifications_bucket'),
+        db.Index('ix_notifications_recipient_id_id', 'recipient_id', 'id'),
+        # for purging actors
+        db.Index('ix_notifications_actor_id', 'actor_id'),
+    )
+
+
+class NotificationActor(db.Model):
+    """A user counted in a notification, so that liking or following
+    again (after taking it back) isn't counted twice."""
+
+    __tablename__ = 'notification_actors'
+
+    notification_id = db.Column(
+        db.Integer,
+        db.ForeignKey('notifications.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    __table_args__ = (
+        # for purging actors
+        db.Index('ix_notification_actors_actor_id', 'actor_id'),
+    )
+
+
+class CachedImage(db.Model):
+    """A resized variant of an external image, stored on local disk."""
+
+    __tablename__ = 'cached_images'
+
+    source_url = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # 'avatar' or 'header'
+    variant = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # file name under IMAGE_CACHE_DIR: a hash of the file's content
+    filename = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class GeocodedPlace(db.Model):
+    """Where a place, as users write it in their location, is: the cache
+    of geo.geocode(). Places the gazetteer doesn't know are kept too,
+    without coordinates, so they are looked up only once."""
+
+    __tablename__ = 'geocoded_places'
+
+    # the location as normalized by geo.normalize_place()
+    place = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    latitude = db.Column(
+        db.Float,
+    )
+
+    longitude = db.Column(
+        db.Float,
+    )
+
+    geocoded_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class ShardBucket(db.Model):
+    """Which shard holds the messages of the users in one bucket.
+
+    Buckets without a row are on shard `bucket % number of shards`; see
+    shards.py.
+    """
+
+    __tablename__ = 'shard_buckets'
+
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # set while the bucket's rows are copied to another shard; writes to
+    # the bucket are refused until the move is done
+    moving = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+
+class MessageBucket(db.Model):
+    """The shard bucket of a message's author, so that a message can be
+    found by id on its shard alone (see shards.py). Only kept with
+    sharding on; rows of deleted messages are left behind."""
+
+    __tablename__ = 'message_buckets'
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    bucket = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class SnowflakeWorker(db.Model):
+    """A worker id leased by a process making message ids."""
+
+    __tablename__ = 'snowflake_workers'
+
+    worker_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    # host:pid of the process holding the lease
+    holder = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    expires_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class Job(db.Model):
+    """A unit of deferred work, run by a `flask jobs work` process."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    queue = db.Column(
+        db.Text,
+        nullable=False,
+        default='default',
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # JSON-encoded keyword arguments for the job's handler
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # at most one unfinished job per key; cleared when the job finishes
+    dedup_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    # queued, running, done or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    locked_by = db.Column(
+        db.Text,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_claim', 'status', 'queue', 'run_at'),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name} ({self.status})>"
+
+
+class JobLock(db.Model):
+    """A row per job name with a concurrency limit, locked by workers
+    while they count and claim jobs of that name (see jobs.py)."""
+
+    __tablename__ = 'job_locks'
+
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+
+class DailyStats(db.Model):
+    """Activity on one (UTC) day, rolled up from messages, likes and
+    follows once the day is over (see rollups.py)."""
+
+    __tablename__ = 'daily_stats'
+
+    day = db.Column(
+        db.Date,
+        primary_key=True,
+    )
+
+    messages = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # users who posted a message
+    posters = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    follows = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class UserDailyStats(db.Model):
+    """One user's activity on one day (see rollups.py); only days with
+    some activity have a row. Kept after the user is deleted, as the
+    day's totals are."""
+
+    __tablename__ = 'user_daily_stats'
+
+    day = db.Column(
+        db.Date,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    messages = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes_given = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes_received = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    follows_made = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    followers_gained = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    __table_args__ = (
+        db.Index('ix_user_daily_stats_user_id_day', 'user_id', 'day'),
+    )
+
+
+class RollupWatermark(db.Model):
+    """How far a rollup has got (see rollups.py)."""
+
+    __tablename__ = 'rollup_watermarks'
+
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # the first day not yet rolled up
+    day = db.Column(
+        db.Date,
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
 
 
 def connect_db(app):
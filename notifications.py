@@ -0,0 +1,240 @@
+"""Notifications of likes and new followers, coalesced as they are written.
+
+Rather than a row per like or follow, the events of one kind on one target
+(a message, or the user followed) within one BUCKET for one recipient add
+up in a single `notifications` row: its count goes up and its actor
+becomes the latest user, shown as "user5 and 41 others liked your
+warble". The first event of a bucket inserts the row; the rest update it
+in place, under a row lock.
+
+The count is of distinct users: each one counted is kept in
+`notification_actors`, so a user who unlikes and likes again (or
+unfollows and follows again) within the bucket changes nothing.
+
+Each user's unread count is kept on `User.unread_notifications`: it goes
+up when a row is created or a read one gets new users, and back to 0 when
+they open /notifications. The navbar shows it for free with the logged-in
+user, and a page of notifications is one read of the (recipient, id)
+index.
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, tuple_
+from sqlalchemy.exc import IntegrityError
+
+from dtos import DTO
+from models import db, User, Notification, NotificationActor
+
+EPOCH = datetime(2021, 1, 1)
+
+BUCKET = timedelta(hours=1)
+
+PAGE_SIZE = 20
+
+
+class NotificationItem(DTO):
+    """A notification as shown on /notifications, with the name and image
+    of its latest actor (None if they are gone)."""
+
+    __slots__ = ('id', 'kind', 'target_id', 'count', 'updated_at', 'unread',
+                 'actor_id', 'actor_username', 'actor_image_url')
+
+
+def bucket_of(when):
+    """The bucket of events at `when`."""
+
+    return int((when - EPOCH) / BUCKET)
+
+
+def notify_many(kind, actor_id, targets, now=None):
+    """Record that `actor_id` did `kind` ('like' or 'follow') to each of
+    `targets`, a list of (recipient id, target id). Events of a user on
+    themselves are left out. The caller commits.
+    """
+
+    _notify(kind,
+            {(recipient_id, target_id): [actor_id]
+             for recipient_id, target_id in targets
+             if recipient_id != actor_id},
+            now or datetime.utcnow())
+
+
+def _locked(kind, bucket, keys):
+    """The notifications of `kind` in `bucket` for `keys`, (recipient id,
+    target id), locked until the commit."""
+
+    return (Notification
+            .query
+            .filter(Notification.kind == kind,
+                    Notification.bucket == bucket,
+                    tuple_(Notification.recipient_id,
+                           Notification.target_id).in_(list(keys)))
+            .with_for_update()
+            .all())
+
+
+def _start(kind, bucket, events, now):
+    """Insert the notifications of `kind` in `bucket` for `events` (as
+    for `_notify`) that don't exist yet. Returns the keys inserted."""
+
+    try:
+        with db.session.begin_nested():
+            db.session.bulk_insert_mappings(Notification, [
+                {'recipient_id': recipient_id, 'kind': kind,
+                 'target_id': target_id, 'bucket': bucket,
+                 'actor_id': actor_ids[-1], 'count': len(actor_ids),
+                 'unread': True, 'updated_at': now}
+                for (recipient_id, target_id), actor_ids
+                in sorted(events.items())])
+    except IntegrityError:
+        # another request started some of these since
+        started = {(row.recipient_id, row.target_id)
+                   for row in _locked(kind, bucket, events)}
+        return _start(kind, bucket,
+                      {key: events[key] for key in events.keys() - started},
+                      now)
+
+    return events.keys()
+
+
+def _notify(kind, events, now):
+    """Add `events`, {(recipient id, target id): [actor ids, oldest
+    first]}, to their notifications of `kind` in the bucket of `now`."""
+
+    if not events:
+        return
+
+    bucket = bucket_of(now)
+    events = {key: list(dict.fromkeys(actor_ids))
+              for key, actor_ids in events.items()}
+
+    rows = _locked(kind, bucket, events)
+    missing = events.keys() - {(row.recipient_id, row.target_id)
+                               for row in rows}
+    inserted = set()
+    if missing:
+        inserted = _start(kind, bucket,
+                          {key: events[key] for key in missing}, now)
+        rows += _locked(kind, bucket, missing)
+
+    counted = set()
+    if len(rows) > len(inserted):
+        counted = set(db.session
+                      .query(NotificationActor.notification_id,
+                             NotificationActor.actor_id)
+                      .filter(NotificationActor.notification_id.in_(
+                          [row.id for row in rows])))
+
+    # recipients with a new unread notification
+    unread = Counter()
+    # one update for the rows getting the same actor and count
+    updates = {}
+    actors = []
+    for row in rows:
+        key = row.recipient_id, row.target_id
+        added = [actor_id for actor_id in events[key]
+                 if (row.id, actor_id) not in counted]
+
+        actors += [{'notification_id': row.id, 'actor_id': actor_id}
+                   for actor_id in added]
+        if key in inserted:
+            unread[row.recipient_id] += 1
+        elif added:
+            updates.setdefault((added[-1], len(added)), []).append(row.id)
+            if not row.unread:
+                unread[row.recipient_id] += 1
+
+    db.session.bulk_insert_mappings(NotificationActor, actors)
+
+    for (actor_id, count), ids in updates.items():
+        (Notification
+         .query
+         .filter(Notification.id.in_(ids))
+         .update({Notification.count: Notification.count + count,
+                  Notification.actor_id: actor_id,
+                  Notification.unread: True,
+                  Notification.updated_at: now},
+                 synchronize_session=False))
+
+    by_increment = {}
+    for recipient_id, increment in unread.items():
+        by_increment.setdefault(increment, []).append(recipient_id)
+
+    for increment, recipient_ids in by_increment.items():
+        (User
+         .query
+         .filter(User.id.in_(recipient_ids))
+         .update({User.unread_notifications:
+                  User.unread_notifications + increment},
+                 synchronize_session=False))
+
+
+def notify_like(msg, user_id):
+    """Record that `user_id` liked message `msg`. The caller commits."""
+
+    notify_many('like', user_id, [(msg.user_id, msg.id)])
+
+
+def notify_likes(likes, now=None):
+    """Record many likes at once, as a write-behind flush applies them
+    (see likebuffer.py): `likes` is a list of (user id, message). Each
+    message's notification goes up by its number of new likers, with the
+    last of them as the actor. The caller commits."""
+
+    events = {}
+    for user_id, msg in likes:
+        if user_id != msg.user_id:
+            events.setdefault((msg.user_id, msg.id), []).append(user_id)
+
+    _notify('like', events, now or datetime.utcnow())
+
+
+def notify_follows(user_id, followed_ids):
+    """Record that `user_id` followed each of `followed_ids`. The caller
+    commits."""
+
+    notify_many('follow', user_id,
+                [(followed_id, followed_id) for followed_id in followed_ids])
+
+
+def page(user_id, before=None, limit=PAGE_SIZE):
+    """`user_id`'s notifications, newest first, with ids below `before`,
+    and the `before` of the next page (None on the last)."""
+
+    query = (db.session
+             .query(Notification.id,
+                    Notification.kind,
+                    Notification.target_id,
+                    Notification.count,
+                    Notification.updated_at,
+                    Notification.unread,
+                    Notification.actor_id,
+                    User.username,
+                    func.coalesce(User.image_thumb_url, User.image_url))
+             .outerjoin(User, db.and_(User.id == Notification.actor_id,
+                                      User.deleted_at.is_(None)))
+             .filter(Notification.recipient_id == user_id))
+    if before is not None:
+        query = query.filter(Notification.id < before)
+
+    items = [NotificationItem(*row)
+             for row in query.order_by(Notification.id.desc()).limit(limit)]
+    next_before = items[-1].id if len(items) == limit else None
+
+    return items, next_before
+
+
+def mark_read(user):
+    """Mark all of `user`'s notifications read. The caller commits."""
+
+    if not user.unread_notifications:
+        return
+
+    (Notification
+     .query
+     .filter(Notification.recipient_id == user.id,
+             Notification.unread.is_(True))
+     .update({Notification.unread: False}, synchronize_session=False))
+    user.unread_notifications = 0
@@ -0,0 +1,335 @@
+"""Caching of what profile and message pages show, loaded once at a time.
+
+`users_show()` and `messages_show()` read the parts of their pages that
+are the same for every viewer through `page_cache.get(key, load)`. An
+entry is fresh for PAGE_CACHE_TTL seconds. When it is missing or stale,
+the first request for it in a process loads it (single flight); requests
+for it meanwhile wait for that load and share its result instead of all
+reading the database at once. For PAGE_CACHE_STALE seconds past its TTL
+an entry is still served to those requests, so that only the one
+reloading it waits at all.
+
+Entries live in process memory by default, up to PAGE_CACHE_MAX_KEYS
+of them: at that many, expired entries are dropped, or else the least
+recently used one. Set PAGE_CACHE_URL to a redis:// URL to share them
+between processes and nodes (needs the `redis` package); a lock per key
+in Redis then has one node at a time load it, while the others serve the
+stale entry or poll for the new one.
+
+Writes that change a page call `forget()`, which reaches this process's
+memory and Redis only. Other processes' memory, and pages showing a
+user's name on their messages, catch up within the TTL: with several
+gunicorn workers (WEB_CONCURRENCY above 1) and no PAGE_CACHE_URL, a user
+whose next request goes to another worker may see their page as it was
+before their change. Set PAGE_CACHE_URL there.
+
+Caching is on unless PAGE_CACHE_ENABLED is false, or, by default, while
+the app is TESTING (see test_pagecache.py for turning it on in tests).
+
+`stats` counts, per process, the requests served a fresh entry ('hit'),
+a stale one ('stale'), the result of another's load ('coalesced') or
+their own ('load'). Responses say which in an X-Page-Cache header, so
+the access logs count them over all processes.
+"""
+
+import pickle
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, namedtuple
+
+from flask import current_app, g
+
+# how often a node waiting on another's load looks for its result
+REMOTE_POLL_SECONDS = 0.05
+
+
+class Entry(namedtuple('Entry', 'value fresh_until stale_until')):
+    """A cached value, fresh until `fresh_until` and served while it is
+    reloaded until `stale_until` (in seconds since the epoch)."""
+
+    __slots__ = ()
+
+
+class MemoryStore:
+    """Entries in a dict; shared by the threads of one process.
+
+    At `max_keys` entries, expired ones are dropped, or else the least
+    recently used one.
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        # least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, now=None):
+        now = time.time() if now is None else now
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._evict(now)
+            self._entries[key] = entry
+
+    def _evict(self, now):
+        """Make room for one more entry."""
+
+        if len(self._entries) < self.max_keys:
+            return
+
+        evicted = False
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.stale_until > now:
+                break
+            del self._entries[key]
+            evicted = True
+
+        if not evicted:
+            self._entries.popitem(last=False)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def acquire(self, key, seconds):
+        """Always True: a process's loads are already one per key."""
+
+        return True
+
+    def release(self, key):
+        pass
+
+    def reset(self):
+        """Forget all entries."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+# Run atomically inside Redis: delete lock KEYS[1] if still held by ARGV[1].
+_REDIS_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisStore:
+    """Entries in Redis, shared by every node using the same server, with
+    a lock per key so one node at a time loads it."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(
+                "PAGE_CACHE_URL needs the 'redis' package installed")
+
+        self._client = redis.Redis.from_url(url)
+        self._release = self._client.register_script(_REDIS_RELEASE)
+        # a process loads a key once at a time, so it can hold its lock
+        # under one token
+        self._token = uuid.uuid4().hex
+
+    def get(self, key):
+        data = self._client.get(f"pagecache:{key}")
+        return None if data is None else Entry(*pickle.loads(data))
+
+    def set(self, key, entry):
+        expires_ms = max(1, int((entry.stale_until - time.time()) * 1000))
+        self._client.set(f"pagecache:{key}", pickle.dumps(tuple(entry)),
+                         px=expires_ms)
+
+    def delete(self, keys):
+        if keys:
+            self._client.delete(*(f"pagecache:{key}" for key in keys))
+
+    def acquire(self, key, seconds):
+        """Take the lock on loading `key` for at most `seconds`; False if
+        another node holds it."""
+
+        return bool(self._client.set(f"pagecache-lock:{key}", self._token,
+                                     nx=True, px=int(seconds * 1000)))
+
+    def release(self, key):
+        self._release(keys=[f"pagecache-lock:{key}"], args=[self._token])
+
+    def reset(self):
+        """Forget all entries."""
+
+        for key in self._client.scan_iter("pagecache:*"):
+            self._client.delete(key)
+
+
+class _Flight:
+    """A load in progress, which requests for the same key wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        # a write changed the key during the load, so its result is
+        # not cached
+        self.forgotten = False
+
+
+class PageCache:
+    """Caches page data by key, loading each key once at a time however
+    many requests want it."""
+
+    def __init__(self, app=None):
+        self.store = MemoryStore()
+        self.stats = Counter()
+        self._flights = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # None: on, but while TESTING
+        app.config.setdefault('PAGE_CACHE_ENABLED', None)
+        app.config.setdefault('PAGE_CACHE_MAX_KEYS', 10000)
+        app.config.setdefault('PAGE_CACHE_TTL', 10)
+        app.config.setdefault('PAGE_CACHE_STALE', 5)
+        # how long a request waits on another's load before its own
+        app.config.setdefault('PAGE_CACHE_WAIT', 5)
+        app.config.setdefault('PAGE_CACHE_URL', None)
+
+        url = app.config['PAGE_CACHE_URL']
+        self.store = (RedisStore(url) if url
+                      else MemoryStore(app.config['PAGE_CACHE_MAX_KEYS']))
+
+        app.after_request(self._add_header)
+
+    def get(self, key, load):
+        """The value cached under `key`, or else what `load()` returns,
+        which is then cached."""
+
+        config = current_app.config
+        enabled = config['PAGE_CACHE_ENABLED']
+        if enabled is None:
+            enabled = not current_app.testing
+
+        if not enabled:
+            return load()
+
+        now = time.time()
+        entry = self.store.get(key)
+        if entry is not None and now < entry.fresh_until:
+            self._served('hit')
+            return entry.value
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self._flights[key] = _Flight()
+
+        if not leading:
+            if entry is not None and now < entry.stale_until:
+                self._served('stale')
+                return entry.value
+
+            if flight.done.wait(config['PAGE_CACHE_WAIT']):
+                self._served('coalesced')
+                if flight.error is not None:
+                    raise flight.error
+                return flight.value
+
+            # the load is taking too long to keep waiting on
+            self._served('load')
+            return load()
+
+        try:
+            flight.value = self._lead(key, load, entry, now, flight)
+            return flight.value
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _lead(self, key, load, entry, now, flight):
+        """Load `key` for this process, unless another node is."""
+
+        config = current_app.config
+        locked = self.store.acquire(key, config['PAGE_CACHE_WAIT'])
+
+        if not locked:
+            if entry is not None and now < entry.stale_until:
+                self._served('stale')
+                return entry.value
+
+            deadline = now + config['PAGE_CACHE_WAIT']
+            while time.time() < deadline:
+                time.sleep(REMOTE_POLL_SECONDS)
+                entry = self.store.get(key)
+                if entry is not None and time.time() < entry.fresh_until:
+                    self._served('coalesced')
+                    return entry.value
+
+        try:
+            self._served('load')
+            value = load()
+
+            if not flight.forgotten:
+                loaded = time.time()
+                fresh_until = loaded + config['PAGE_CACHE_TTL']
+                self.store.set(key, Entry(
+                    value, fresh_until,
+                    fresh_until + config['PAGE_CACHE_STALE']))
+
+            return value
+        finally:
+            if locked:
+                self.store.release(key)
+
+    def forget(self, *keys):
+        """Drop the entries of `keys`, after a write changed them."""
+
+        with self._lock:
+            for key in keys:
+                if key in self._flights:
+                    self._flights[key].forgotten = True
+
+        self.store.delete(keys)
+
+    def forget_users(self, *user_ids):
+        """Drop the profile pages of `user_ids`."""
+
+        self.forget(*(f"user:{user_id}" for user_id in user_ids))
+
+    def reset(self):
+        """Forget all entries and counts."""
+
+        self.store.reset()
+        with self._lock:
+            self.stats.clear()
+
+    def _served(self, how):
+        with self._lock:
+            self.stats[how] += 1
+        g.page_cache = how
+
+    @staticmethod
+    def _add_header(response):
+        how = g.get('page_cache')
+        if how is not None:
+            response.headers['X-Page-Cache'] = how
+        return response
+
+
+page_cache = PageCache()
@@ -0,0 +1,174 @@
+"""Reclaim the rows of deleted accounts in small batches.
+
+Deleting a user only sets `User.deleted_at`, which hides the account from
+every query at once, and queues a `purge_user` job. The user's messages,
+likes, follows, blocks and mutes are removed by that job, a bounded batch
+per transaction, so no single statement holds locks on `likes` or
+`follows` for long. Messages (and the likes on them) are deleted from their
+author's shard, and archived messages and the user's own likes from every
+shard.
+"""
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import tuple_
+
+from jobs import job
+from models import (db, User, Message, Like, ArchivedMessage, ArchivedLike,
+                    Follows, Blocks, Mutes, MessageMention, Notification,
+                    NotificationActor, TrendingScore)
+from shards import shards
+from tags import forget_messages
+from usernames import username_filter
+
+BATCH_SIZE = 500
+
+
+def _delete_in_batches(model, criteria, batch_size, session=db.session):
+    """Delete rows of `model` matching `criteria`, `batch_size` at a time,
+    from the database of `session`.
+
+    Returns the number of rows deleted.
+    """
+
+    key = model.__mapper__.primary_key
+    deleted = 0
+
+    while True:
+        batch = (session
+                 .query(*key)
+                 .filter(criteria)
+                 .limit(batch_size)
+                 .subquery())
+
+        count = (session
+                 .query(model)
+                 .filter(tuple_(*key).in_(batch))
+                 .delete(synchronize_session=False))
+        session.commit()
+
+        deleted += count
+        if count == 0:
+            return deleted
+
+
+@job('purge_user', concurrency=2)
+def purge_user(user_id, batch_size=BATCH_SIZE):
+    """Remove a deleted user and everything that references them."""
+
+    messages = shards.for_user(user_id, write=True)
+
+    while True:
+        message_ids = [id for (id,) in (messages
+                                        .query(Message.id)
+                                        .filter(Message.user_id == user_id)
+                                        .limit(batch_size))]
+        if not message_ids:
+            break
+
+        # likes on these messages would cascade anyway; deleting them
+        # first keeps each transaction bounded for heavily liked messages
+        _delete_in_batches(Like, Like.message_id.in_(message_ids),
+                           batch_size, messages)
+        forget_messages(messages, message_ids)
+        (messages
+         .query(Message)
+         .filter(Message.id.in_(message_ids))
+         .delete(synchronize_session=False))
+        messages.commit()
+
+        (TrendingScore
+         .query
+         .filter(TrendingScore.kind == 'message',
+                 TrendingScore.target_id.in_(message_ids))
+         .delete(synchronize_session=False))
+        db.session.commit()
+
+    for session in shards.all():
+        archived = (session
+                    .query(ArchivedMessage.id)
+                    .filter(ArchivedMessage.user_id == user_id))
+        _delete_in_batches(ArchivedLike, ArchivedLike.message_id.in_(archived),
+                           batch_size, session)
+        _delete_in_batches(ArchivedMessage,
+                           ArchivedMessage.user_id == user_id,
+                           batch_size, session)
+
+        _delete_in_batches(Like, Like.user_id == user_id, batch_size, session)
+        _delete_in_batches(ArchivedLike, ArchivedLike.user_id == user_id,
+                           batch_size, session)
+        _delete_in_batches(MessageMention, MessageMention.user_id == user_id,
+                           batch_size, session)
+    _delete_in_batches(Follows,
+                       Follows.user_following_id == user_id,
+                       batch_size)
+    _delete_in_batches(Follows,
+                       Follows.user_being_followed_id == user_id,
+                       batch_size)
+    for column in (Blocks.user_blocking_id, Blocks.user_being_blocked_id):
+        _delete_in_batches(Blocks, column == user_id, batch_size)
+    for column in (Mutes.user_muting_id, Mutes.user_being_muted_id):
+        _delete_in_batches(Mutes, column == user_id, batch_size)
+    _delete_in_batches(NotificationActor,
+                       NotificationActor.notification_id.in_(
+                           db.session
+                           .query(Notification.id)
+                           .filter_by(recipient_id=user_id)
+                           .subquery()),
+                       batch_size)
+    _delete_in_batches(NotificationActor,
+                       NotificationActor.actor_id == user_id,
+                       batch_size)
+    _delete_in_batches(Notification,
+                       Notification.recipient_id == user_id,
+                       batch_size)
+    # others' notifications they were the latest actor of remain
+    (Notification
+     .query
+     .filter_by(actor_id=user_id)
+     .update({Notification.actor_id: None}, synchronize_session=False))
+
+    user = (db.session
+            .query(User.username, User.email, User.names_changed_at)
+            .filter_by(id=user_id)
+            .first())
+    if user:
+        # their names are free again
+        username_filter.forget_on_commit(db.session,
+                                         [user.username, user.email],
+                                         user.names_changed_at)
+
+    # nothing references the user any more: with passive_deletes the ORM
+    # won't load any collections for this
+    (TrendingScore
+     .query
+     .filter_by(kind='user', target_id=user_id)
+     .delete(synchronize_session=False))
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def purge_deleted_users(batch_size=BATCH_SIZE):
+    """Purge every account marked deleted. Returns how many were purged.
+
+    Catches up on accounts whose `purge_user` job failed or was never run.
+    """
+
+    user_ids = [id for (id,) in (db.session
+                                 .query(User.id)
+                                 .filter(User.deleted_at.isnot(None)))]
+
+    for user_id in user_ids:
+        purge_user(user_id, batch_size)
+
+    return len(user_ids)
+
+
+@click.command('purge-deleted-users')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True)
+@with_appcontext
+def purge_deleted_users_command(batch_size):
+    """Reclaim the rows of deleted accounts."""
+
+    purged = purge_deleted_users(batch_size)
+    click.echo(f"Purged {purged} deleted users.")
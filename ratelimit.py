@@ -0,0 +1,214 @@
+"""Token-bucket rate limiting for write routes.
+
+Each limited route gets a bucket per key (the logged-in user's id, or the
+client IP for anonymous routes like signup and login). A bucket holds up
+to `capacity` tokens and refills at a steady rate; a request spends one
+token, or gets a 429 with a Retry-After header when the bucket is empty.
+
+Buckets live in process memory by default, which is right for a single
+node. Set RATELIMIT_STORAGE_URL to a redis:// URL to share them between
+nodes (needs the `redis` package).
+
+Limits are given as "<count>/<period>", e.g. "30/minute", and can be
+overridden per view with the RATELIMITS config dict, keyed by endpoint.
+Limits apply unless RATELIMIT_ENABLED is false, or, by default, while
+the app is TESTING.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache, wraps
+
+from flask import current_app, g, request
+from werkzeug.exceptions import TooManyRequests
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+}
+
+
+@lru_cache()
+def parse_rate(rate):
+    """Parse "<count>/<period>" into (capacity, tokens per second)."""
+
+    count, period = rate.split('/')
+    count = int(count)
+
+    return count, count / PERIODS[period.strip().rstrip('s')]
+
+
+class MemoryStore:
+    """Buckets in a dict; shared by the threads of one process.
+
+    At `max_keys` buckets, buckets that have refilled (and so are as good
+    as new) are dropped, or else the least recently used one, so that
+    clients making up new keys can't reset everyone else's limits.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        # key -> (tokens, updated, time it is full again), least recently
+        # used first
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, refill_rate, now=None):
+        """Spend a token from bucket `key`.
+
+        Returns 0 if a token was available, else the seconds until one is.
+        """
+
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            tokens, updated, _ = self._buckets.pop(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * refill_rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / refill_rate
+
+            self._evict(now)
+            self._buckets[key] = (tokens, now,
+                                  now + (capacity - tokens) / refill_rate)
+            return wait
+
+    def _evict(self, now):
+        """Make room for one more bucket."""
+
+        if len(self._buckets) < self.max_keys:
+            return
+
+        evicted = False
+        while self._buckets:
+            key, (tokens, updated, full_at) = next(iter(self._buckets.items()))
+            if full_at > now:
+                break
+            del self._buckets[key]
+            evicted = True
+
+        if not evicted:
+            self._buckets.popitem(last=False)
+
+    def reset(self):
+        """Forget all buckets."""
+
+        with self._lock:
+            self._buckets.clear()
+
+
+# Run atomically inside Redis: KEYS[1] is the bucket, ARGV is capacity,
+# refill rate and the current time in seconds.
+_REDIS_TAKE = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisStore:
+    """Buckets in Redis, shared by every node using the same server."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(
+                "RATELIMIT_STORAGE_URL needs the 'redis' package installed")
+
+        self._client = redis.Redis.from_url(url)
+        self._take = self._client.register_script(_REDIS_TAKE)
+
+    def take(self, key, capacity, refill_rate, now=None):
+        """Spend a token from bucket `key`; see MemoryStore.take."""
+
+        now = time.time() if now is None else now
+        return float(self._take(keys=[f"ratelimit:{key}"],
+                                args=[capacity, refill_rate, now]))
+
+    def reset(self):
+        """Forget all buckets."""
+
+        for key in self._client.scan_iter("ratelimit:*"):
+            self._client.delete(key)
+
+
+def by_user():
+    """Bucket per logged-in user, falling back to the client IP."""
+
+    return f"user:{g.user.id}" if g.get('user') else by_ip()
+
+
+def by_ip():
+    """Bucket per client IP: behind a proxy, the one it forwarded the
+    request for (see PROXY_COUNT in app.py)."""
+
+    return f"ip:{request.remote_addr}"
+
+
+class RateLimiter:
+    """Applies per-route token-bucket limits to a Flask app."""
+
+    def __init__(self, app=None):
+        self.store = MemoryStore()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # None: on, but while TESTING
+        app.config.setdefault('RATELIMIT_ENABLED', None)
+        app.config.setdefault('RATELIMIT_STORAGE_URL', None)
+        app.config.setdefault('RATELIMITS', {})
+
+        url = app.config['RATELIMIT_STORAGE_URL']
+        if url:
+            self.store = RedisStore(url)
+
+    def limit(self, rate, key=by_user, methods=('POST',)):
+        """Limit the decorated view to `rate` requests per key.
+
+        Only requests using one of `methods` spend tokens.
+        """
+
+        def decorator(view):
+            @wraps(view)
+            def limited(*args, **kwargs):
+                config = current_app.config
+                enabled = config['RATELIMIT_ENABLED']
+                if enabled is None:
+                    enabled = not current_app.testing
+
+                if enabled and request.method in methods:
+                    capacity, refill_rate = parse_rate(
+                        config['RATELIMITS'].get(request.endpoint, rate))
+                    wait = self.store.take(f"{request.endpoint}:{key()}",
+                                           capacity,
+                                           refill_rate)
+                    if wait:
+                        raise TooManyRequests(retry_after=math.ceil(wait))
+
+                return view(*args, **kwargs)
+
+            return limited
+
+        return decorator
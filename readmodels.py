@@ -0,0 +1,612 @@
+"""Column-only reads for pages that list many users or messages.
+
+Listing pages used to load full `User`/`Message` instances, each tracked
+in the session's identity map with lazy relationships that templates
+would then walk (`msg.user.username`, `user.followers | length`). These
+functions select just the columns a page shows into `__slots__` records
+(see dtos.py) that the session never tracks.
+
+Messages and likes may be spread over several databases (see shards.py),
+so message rows are read from each shard that may hold some, merged by
+id (ids are time-ordered; see snowflake.py), and then given their
+authors' names and images from the main database in one more query.
+
+Users a viewer muted or blocked, or who blocked them, are left out inside
+the queries (see `_Hidden`), never by filtering rows afterwards, so pages
+stay full and no rows are read to be thrown away.
+"""
+
+import heapq
+import math
+from datetime import datetime, timedelta
+from itertools import islice
+
+from sqlalchemy import (func, exists, literal, true, and_, union,
+                        bindparam)
+from geopy.distance import great_circle
+from sqlalchemy.orm import aliased
+
+import geo
+import likebuffer
+import snowflake
+from dtos import DTO
+from models import (db, User, Message, Like, Follows, Blocks, Mutes,
+                    MessageTag, MessageMention)
+from shards import shards
+
+TIMELINE_LIMIT = 100
+
+# messages per page of a profile, likes, tag or mentions timeline
+PAGE_SIZE = 50
+
+# users shown on /users/nearby
+NEARBY_LIMIT = 60
+
+# how many times NEARBY_LIMIT users are measured exactly, so that those
+# an approximate distance puts a little too far still make the cut
+NEARBY_CANDIDATES = 2
+
+# how far back timelines look before reading older messages
+RECENT_WINDOW = timedelta(days=30)
+
+
+class TimelineItem(DTO):
+    """A message as shown in a timeline, with its author's name and image
+    (the resized copy, if there is one) and whether the viewing user has
+    liked it."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id', 'username',
+                 'image_url', 'liked')
+    id_fields = ('id',)
+
+
+class UserCard(DTO):
+    """A user as shown in a card on the user listing pages, with resized
+    images where there are some."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
+
+class NearbyCard(DTO):
+    """A user card on /users/nearby, with how far away the user is."""
+
+    __slots__ = UserCard.__slots__ + ('distance_km',)
+
+
+class UserCounts(DTO):
+    """The stats shown on a user's profile and home page."""
+
+    __slots__ = ('messages', 'following', 'followers', 'likes')
+
+
+class Profile(DTO):
+    """A user as shown atop their profile pages, with resized images where
+    there are some."""
+
+    __slots__ = ('id', 'username', 'avatar', 'header', 'bio', 'location')
+
+
+class ProfilePage(DTO):
+    """What a user's profile shows whoever looks at it: the user, their
+    counts, the first page of their messages (not marked liked; see
+    `as_seen_by()`) and the `before` of the next page."""
+
+    __slots__ = ('user', 'counts', 'messages', 'before')
+
+
+class MessagePage(DTO):
+    """A message as its page shows it, and its author's `Profile`."""
+
+    __slots__ = ('message', 'user')
+
+
+class Relation(DTO):
+    """How a viewer and the user whose profile they look at stand: whether
+    the viewer muted or blocked them, and whether they blocked the viewer.
+    """
+
+    __slots__ = ('muted', 'blocked', 'blocked_by')
+
+
+class _Hidden:
+    """The users `viewer_id` doesn't see: those they muted or blocked, and
+    those who blocked them.
+
+    In the main database `excluding()` is a set of NOT EXISTS anti-joins
+    against `mutes` and `blocks`, which their primary keys and
+    ix_blocks_user_blocking_id answer with one index probe per row
+    however many users are muted. Shards have no `mutes` or `blocks`; for
+    them the hidden ids are read once, on first use, and excluded with
+    NOT IN.
+    """
+
+    def __init__(self, viewer_id):
+        self.viewer_id = viewer_id
+        self._ids = None
+
+    def excluding(self, session, column):
+        """A criterion leaving out hidden users' ids in `column`, for a
+        query in `session`."""
+
+        if self.viewer_id is None:
+            return true()
+
+        if session is db.session:
+            return and_(
+                ~exists()
+                .where(Mutes.user_muting_id == self.viewer_id)
+                .where(Mutes.user_being_muted_id == column),
+                ~exists()
+                .where(Blocks.user_blocking_id == self.viewer_id)
+                .where(Blocks.user_being_blocked_id == column),
+                ~exists()
+                .where(Blocks.user_blocking_id == column)
+                .where(Blocks.user_being_blocked_id == self.viewer_id))
+
+        if self._ids is None:
+            self._ids = hidden_user_ids(self.viewer_id)
+
+        if not self._ids:
+            return true()
+
+        # one expanding parameter, not a bound parameter object per id
+        return column.notin_(bindparam('hidden_user_ids', sorted(self._ids),
+                                       expanding=True))
+
+
+def hidden_user_ids(viewer_id):
+    """Ids of the users `viewer_id` muted or blocked or was blocked by."""
+
+    rows = db.session.execute(union(
+        db.select([Mutes.user_being_muted_id])
+        .where(Mutes.user_muting_id == viewer_id),
+        db.select([Blocks.user_being_blocked_id])
+        .where(Blocks.user_blocking_id == viewer_id),
+        db.select([Blocks.user_blocking_id])
+        .where(Blocks.user_being_blocked_id == viewer_id)))
+
+    return {user_id for (user_id,) in rows}
+
+
+def relation(viewer_id, user_id):
+    """The `Relation` of `viewer_id` to `user_id`, in one query."""
+
+    def where(model, criteria):
+        return exists().where(and_(*(getattr(model, name) == value
+                                     for name, value in criteria.items())))
+
+    return Relation(*db.session.query(
+        where(Mutes, {'user_muting_id': viewer_id,
+                      'user_being_muted_id': user_id}),
+        where(Blocks, {'user_blocking_id': viewer_id,
+                       'user_being_blocked_id': user_id}),
+        where(Blocks, {'user_blocking_id': user_id,
+                       'user_being_blocked_id': viewer_id})).one())
+
+
+def _message_query(session, viewer_id):
+    if viewer_id is None:
+        liked = literal(False)
+    else:
+        viewer_like = aliased(Like)
+        liked = (exists()
+                 .where(viewer_like.message_id == Message.id)
+                 .where(viewer_like.user_id == viewer_id)
+                 .correlate(Message))
+
+    return session.query(Message.id,
+                         Message.text,
+                         Message.timestamp,
+                         Message.user_id,
+                         liked.label('liked'))
+
+
+def _with_authors(rows, viewer_id=None):
+    """Timeline items of message `rows`, in order, with their authors'
+    names and images. Messages by deleted users are left out.
+
+    Likes and unlikes by `viewer_id` still in the write-behind buffer (see
+    likebuffer.py) show as made.
+    """
+
+    author_ids = {row.user_id for row in rows}
+    if not author_ids:
+        return []
+
+    authors = {id: (username, image_url) for id, username, image_url in (
+        db.session
+        .query(User.id,
+               User.username,
+               func.coalesce(User.image_thumb_url, User.image_url))
+        .filter(User.id.in_(author_ids), User.deleted_at.is_(None)))}
+
+    pending = (likebuffer.like_buffer.pending_for(viewer_id) if viewer_id
+               else {})
+
+    return [TimelineItem(row.id, row.text, row.timestamp, row.user_id,
+                         *authors[row.user_id],
+                         pending.get(row.id, row.liked))
+            for row in rows if row.user_id in authors]
+
+
+def _merge(per_shard, newest_first=False, limit=None):
+    """Merge rows from each shard, each already sorted by id."""
+
+    if len(per_shard) == 1:
+        return per_shard[0]
+
+    merged = heapq.merge(*per_shard,
+                         key=lambda row: row.id,
+                         reverse=newest_first)
+    return list(islice(merged, limit))
+
+
+def _card_query():
+    return (db.session
+            .query(User.id,
+                   User.username,
+                   func.coalesce(User.image_thumb_url, User.image_url),
+                   func.coalesce(User.header_image_thumb_url,
+                                 User.header_image_url),
+                   User.bio)
+            .filter(User.deleted_at.is_(None)))
+
+
+def _latest(user_ids, viewer_id, limit, *criteria):
+    per_shard = [(_message_query(session, viewer_id)
+                  .filter(Message.user_id.in_(ids), *criteria)
+                  .order_by(Message.id.desc())
+                  .limit(limit)
+                  .all())
+                 for session, ids in shards.by_shard(user_ids)]
+
+    return _merge(per_shard, True, limit)
+
+
+def timeline(user_ids, viewer_id=None, limit=TIMELINE_LIMIT):
+    """The latest messages by `user_ids`, newest first, as seen by
+    `viewer_id`.
+
+    Messages of the last RECENT_WINDOW are read first: with a lower bound
+    on id, a partitioned `messages` (see archive.py) is only read in its
+    newest partitions. Older ones are only read if that comes up short.
+    """
+
+    recent = snowflake.from_datetime(datetime.utcnow() - RECENT_WINDOW)
+    rows = list(_latest(user_ids, viewer_id, limit, Message.id >= recent))
+
+    if len(rows) < limit:
+        rows += _latest(user_ids, viewer_id, limit - len(rows),
+                        Message.id < recent)
+
+    return _with_authors(rows, viewer_id)
+
+
+def as_seen_by(items, viewer_id):
+    """Timeline `items` read without a viewer, marked liked where
+    `viewer_id` liked them, in one query per shard."""
+
+    if viewer_id is None or not items:
+        return items
+
+    # likes are kept with the message they are on
+    liked = set()
+    for session, user_ids in shards.by_shard({item.user_id
+                                              for item in items}):
+        message_ids = [item.id for item in items if item.user_id in user_ids]
+        liked.update(message_id for (message_id,) in (
+            session
+            .query(Like.message_id)
+            .filter(Like.user_id == viewer_id,
+                    Like.message_id.in_(message_ids))))
+
+    pending = likebuffer.like_buffer.pending_for(viewer_id)
+
+    return [TimelineItem(*(getattr(item, name)
+                           for name in TimelineItem.__slots__[:-1]),
+                         pending.get(item.id, item.id in liked))
+            for item in items]
+
+
+def timeline_since(user_ids, after, viewer_id=None, limit=TIMELINE_LIMIT):
+    """Messages by `user_ids` with an id above `after`, oldest first, as
+    seen by `viewer_id`."""
+
+    per_shard = [(_message_query(session, viewer_id)
+                  .filter(Message.user_id.in_(ids), Message.id > after)
+                  .order_by(Message.id)
+                  .limit(limit)
+                  .all())
+                 for session, ids in shards.by_shard(user_ids)]
+
+    return _with_authors(_merge(per_shard, limit=limit), viewer_id)
+
+
+def user_timeline(user_id, viewer_id=None, before=None, limit=PAGE_SIZE):
+    """Messages by `user_id`, newest first, with ids below `before`, as
+    seen by `viewer_id`; and the `before` of the next page (None on the
+    last)."""
+
+    criteria = [] if before is None else [Message.id < before]
+    rows = _latest([user_id], viewer_id, limit, *criteria)
+    next_before = rows[-1].id if len(rows) == limit else None
+
+    return _with_authors(rows, viewer_id), next_before
+
+
+def liked_timeline(user_id, viewer_id=None, before=None, limit=PAGE_SIZE):
+    """Messages liked by `user_id`, newest first, with ids below `before`,
+    as seen by `viewer_id` (so without those of users hidden from them);
+    and the `before` of the next page (None on the last)."""
+
+    hidden = _Hidden(viewer_id)
+
+    # the user's likes are on messages on any shard
+    per_shard = []
+    for session in shards.all():
+        query = (_message_query(session, viewer_id)
+                 .join(Like, Like.message_id == Message.id)
+                 .filter(Like.user_id == user_id,
+                         hidden.excluding(session, Message.user_id)))
+        if before is not None:
+            query = query.filter(Like.message_id < before)
+
+        per_shard.append(query
+                         .order_by(Like.message_id.desc())
+                         .limit(limit)
+                         .all())
+
+    rows = _merge(per_shard, True, limit)
+    next_before = rows[-1].id if len(rows) == limit else None
+
+    return _with_authors(rows, viewer_id), next_before
+
+
+def _indexed_page(model, criterion, viewer_id, before, limit):
+    """A page of messages found through index `model` (see tags.py),
+    newest first, and the `before` of the next page (None on the last).
+
+    Each shard reads the page from its index by (key, message id), so
+    deep pages cost no more than the first. Messages of users hidden from
+    `viewer_id` are left out.
+    """
+
+    hidden = _Hidden(viewer_id)
+
+    per_shard = []
+    for session in shards.all():
+        query = (_message_query(session, viewer_id)
+                 .join(model, model.message_id == Message.id)
+                 .filter(criterion,
+                         hidden.excluding(session, Message.user_id)))
+        if before is not None:
+            query = query.filter(model.message_id < before)
+
+        per_shard.append(query
+                         .order_by(model.message_id.desc())
+                         .limit(limit)
+                         .all())
+
+    rows = _merge(per_shard, True, limit)
+    next_before = rows[-1].id if len(rows) == limit else None
+
+    return _with_authors(rows, viewer_id), next_before
+
+
+def tag_timeline(tag, viewer_id=None, before=None, limit=PAGE_SIZE):
+    """Messages using #`tag`, newest first, with ids below `before`; see
+    `_indexed_page()`."""
+
+    return _indexed_page(MessageTag, MessageTag.tag == tag,
+                         viewer_id, before, limit)
+
+
+def mentions_timeline(user_id, viewer_id=None, before=None,
+                      limit=PAGE_SIZE):
+    """Messages mentioning `user_id`, newest first, with ids below
+    `before`; see `_indexed_page()`."""
+
+    return _indexed_page(MessageMention, MessageMention.user_id == user_id,
+                         viewer_id, before, limit)
+
+
+def messages_by_id(message_ids, viewer_id=None):
+    """Timeline items of `message_ids`, in that order, as seen by
+    `viewer_id`. Missing messages are left out."""
+
+    if not message_ids:
+        return []
+
+    rows = []
+    for session in shards.all():
+        rows += (_message_query(session, viewer_id)
+                 .filter(Message.id.in_(message_ids))
+                 .all())
+
+    items = {item.id: item for item in _with_authors(rows, viewer_id)}
+    return [items[id] for id in message_ids if id in items]
+
+
+def user_cards(search=None, viewer_id=None):
+    """Cards of all users, or of those whose username contains `search`,
+    but for those `viewer_id` blocked or was blocked by. (Muted users can
+    still be found, to unmute them.)"""
+
+    query = _card_query()
+    if viewer_id is not None:
+        query = query.filter(*_not_blocked(viewer_id))
+    if search:
+        query = query.filter(User.username.like(f"%{search}%"))
+
+    return [UserCard(*row) for row in query]
+
+
+def _not_blocked(viewer_id):
+    """Criteria leaving out users `viewer_id` blocked or was blocked by."""
+
+    return (~exists()
+            .where(Blocks.user_blocking_id == viewer_id)
+            .where(Blocks.user_being_blocked_id == User.id),
+            ~exists()
+            .where(Blocks.user_blocking_id == User.id)
+            .where(Blocks.user_being_blocked_id == viewer_id))
+
+
+def nearby_cards(user_id, latitude, longitude, radius_km,
+                 limit=NEARBY_LIMIT):
+    """Cards of the users within `radius_km` of (latitude, longitude),
+    nearest first, with their distance; but for `user_id` and those they
+    blocked or were blocked by.
+
+    Candidates are read with a range scan of ix_users_geohash per cell
+    covering the radius (see geo.py), inside the radius's bounding box;
+    the database returns the NEARBY_CANDIDATES * `limit` nearest of them
+    by an approximate (flat-earth) distance, and only those are measured.
+    """
+
+    cells = geo.cells_covering(latitude, longitude, radius_km)
+    south, north, west, east = geo.bounding_box(latitude, longitude,
+                                                radius_km)
+    in_box = [User.latitude.between(south, north)]
+    if west is not None:
+        in_box.append(User.longitude.between(west, east) if west <= east
+                      else db.or_(User.longitude >= west,
+                                  User.longitude <= east))
+
+    # in degrees of latitude; longitude the shorter way round
+    dlat = User.latitude - latitude
+    dlon = User.longitude - longitude
+    dlon = db.case([(dlon > 180, dlon - 360), (dlon < -180, dlon + 360)],
+                   else_=dlon) * math.cos(math.radians(latitude))
+
+    rows = (_card_query()
+            .add_columns(User.latitude, User.longitude)
+            .filter(db.or_(*(db.and_(User.geohash >= cell,
+                                     User.geohash < cell + '~')
+                             for cell in cells)),
+                    *in_box,
+                    User.id != user_id,
+                    *_not_blocked(user_id))
+            .order_by(dlat * dlat + dlon * dlon, User.id)
+            .limit(NEARBY_CANDIDATES * limit))
+
+    cards = []
+    for *card, card_latitude, card_longitude in rows:
+        distance = great_circle((latitude, longitude),
+                                (card_latitude, card_longitude)).km
+        if distance <= radius_km:
+            cards.append(NearbyCard(*card, distance))
+
+    cards.sort(key=lambda card: card.distance_km)
+    return cards[:limit]
+
+
+def following_cards(user_id):
+    """Cards of the users `user_id` follows."""
+
+    rows = (_card_query()
+            .join(Follows, Follows.user_being_followed_id == User.id)
+            .filter(Follows.user_following_id == user_id))
+
+    return [UserCard(*row) for row in rows]
+
+
+def follower_cards(user_id):
+    """Cards of the users following `user_id`."""
+
+    rows = (_card_query()
+            .join(Follows, Follows.user_following_id == User.id)
+            .filter(Follows.user_being_followed_id == user_id))
+
+    return [UserCard(*row) for row in rows]
+
+
+def following_ids(user_id):
+    """Ids of the (active) users `user_id` follows."""
+
+    rows = (db.session
+            .query(Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    User.deleted_at.is_(None)))
+
+    return {followed_id for (followed_id,) in rows}
+
+
+def timeline_author_ids(user_id):
+    """Ids of the users whose messages are in `user_id`'s home timeline:
+    themselves and the (active) users they follow, but for those hidden
+    from them."""
+
+    rows = (db.session
+            .query(Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    User.deleted_at.is_(None),
+                    _Hidden(user_id).excluding(
+                        db.session, Follows.user_being_followed_id)))
+
+    return {followed_id for (followed_id,) in rows} | {user_id}
+
+
+def profile(user_id):
+    """The `Profile` of active user `user_id`, or None."""
+
+    row = (db.session
+           .query(User.id,
+                  User.username,
+                  func.coalesce(User.image_thumb_url, User.image_url),
+                  func.coalesce(User.header_image_thumb_url,
+                                User.header_image_url),
+                  User.bio,
+                  User.location)
+           .filter(User.id == user_id, User.deleted_at.is_(None))
+           .first())
+
+    return None if row is None else Profile(*row)
+
+
+def profile_page(user_id):
+    """The `ProfilePage` of active user `user_id`, or None."""
+
+    user = profile(user_id)
+    if user is None:
+        return None
+
+    return ProfilePage(user, user_counts(user_id), *user_timeline(user_id))
+
+
+def user_counts(user_id):
+    """Message, following, follower and like counts of `user_id`, in one
+    query per database."""
+
+    def count(column, criterion):
+        return (db.session
+                .query(func.count(column))
+                .filter(criterion)
+                .as_scalar())
+
+    # (session, field, count) for every count; likes are summed over shards
+    wanted = [
+        (shards.for_user(user_id), 'messages',
+         count(Message.id, Message.user_id == user_id)),
+        (db.session, 'following',
+         count(Follows.user_being_followed_id,
+               Follows.user_following_id == user_id)),
+        (db.session, 'followers',
+         count(Follows.user_following_id,
+               Follows.user_being_followed_id == user_id)),
+    ] + [(session, 'likes', count(Like.message_id, Like.user_id == user_id))
+         for session in shards.all()]
+
+    by_session = {}
+    for session, field, subquery in wanted:
+        by_session.setdefault(session, []).append((field, subquery))
+
+    totals = dict.fromkeys(UserCounts.__slots__, 0)
+    for session, counts in by_session.items():
+        row = session.query(*(subquery for field, subquery in counts)).one()
+        for (field, subquery), value in zip(counts, row):
+            totals[field] += value
+
+    return UserCounts(**totals)
@@ -0,0 +1,279 @@
+"""Daily activity rollups, for analytics.
+
+Questions like "messages per day" or "who gained the most followers"
+would otherwise scan messages, likes and follows, the tables every page
+reads. Instead `roll_up()` counts each (UTC) day's activity once, after
+the day is over, into `daily_stats` (per day) and `user_daily_stats` (per
+user and day); `/api/stats` and `flask rollups show` read only those.
+
+`rollup_watermarks` holds the first day not yet rolled up, and a run
+reads only rows from that day on, with range scans: messages (and their
+archived copies) by id, as snowflake ids are time-ordered, and likes and
+follows by `created_at`. A day is rolled up LAG after it ends, so rows
+stamped before midnight but committed after it are counted. Up to
+CHUNK_DAYS days are counted at a time, with one GROUP BY per table and
+shard rather than row by row, and written together with the watermark in
+one transaction, so a run that fails is simply run again.
+
+The counts are of activity: a message deleted, a like taken back or a
+user unfollowed later still counts on the day it happened. Likes and
+follows made before `created_at` was recorded aren't counted at all.
+
+Run `flask rollups run` daily (it does nothing until a day is over);
+`flask rollups backfill --since DATE` counts the days from DATE again.
+"""
+
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, literal_column
+
+import snowflake
+from dtos import DailyStatsDTO, UserActivityDTO
+from models import (db, Message, Like, ArchivedMessage, ArchivedLike,
+                    Follows, DailyStats, UserDailyStats, RollupWatermark)
+from shards import shards
+
+DAY = timedelta(days=1)
+
+LAG = timedelta(minutes=10)
+
+CHUNK_DAYS = 31
+
+WATERMARK = 'daily'
+
+# the columns of UserDailyStats that are counted
+USER_COUNTS = ('messages', 'likes_given', 'likes_received', 'follows_made',
+               'followers_gained')
+
+# the snowflake ids made on one day share `id // DAY_SPAN`, the number of
+# days since the snowflake epoch (a midnight)
+DAY_SPAN = snowflake.make_id(DAY // timedelta(milliseconds=1))
+
+TOP_USERS = 10
+
+rollups_cli = AppGroup('rollups', help="Roll up daily activity for analytics.")
+
+
+def _midnight(day):
+    return datetime(day.year, day.month, day.day)
+
+
+def _day(value):
+    """A day as grouped by: a count of days since the snowflake epoch, or
+    a date (which SQLite returns as text)."""
+
+    if isinstance(value, int):
+        return snowflake.EPOCH.date() + value * DAY
+    if isinstance(value, str):
+        return date.fromisoformat(value)
+    return value
+
+
+def _add(counts, name, rows):
+    for day, user_id, count in rows:
+        counts[_day(day), user_id][name] += count
+
+
+def count_activity(start, end):
+    """Activity on the days from `start` up to (not including) `end`:
+    {(day, user id): Counter of USER_COUNTS}."""
+
+    counts = defaultdict(Counter)
+    since, until = _midnight(start), _midnight(end)
+
+    for session in shards.all():
+        for message, like in ((Message, Like),
+                              (ArchivedMessage, ArchivedLike)):
+            # inlined, so that Postgres sees the same expression in the
+            # GROUP BY as in the select list
+            day = message.id / literal_column(str(DAY_SPAN))
+            _add(counts, 'messages', session
+                 .query(day, message.user_id, func.count())
+                 .filter(message.id >= snowflake.from_datetime(since),
+                         message.id < snowflake.from_datetime(until))
+                 .group_by(day, message.user_id))
+
+            day = func.date(like.created_at)
+            liked = (like.created_at >= since, like.created_at < until)
+            _add(counts, 'likes_given', session
+                 .query(day, like.user_id, func.count())
+                 .filter(*liked)
+                 .group_by(day, like.user_id))
+            _add(counts, 'likes_received', session
+                 .query(day, message.user_id, func.count())
+                 .select_from(like)
+                 .join(message, message.id == like.message_id)
+                 .filter(*liked)
+                 .group_by(day, message.user_id))
+
+    day = func.date(Follows.created_at)
+    followed = (Follows.created_at >= since, Follows.created_at < until)
+    _add(counts, 'follows_made', db.session
+         .query(day, Follows.user_following_id, func.count())
+         .filter(*followed)
+         .group_by(day, Follows.user_following_id))
+    _add(counts, 'followers_gained', db.session
+         .query(day, Follows.user_being_followed_id, func.count())
+         .filter(*followed)
+         .group_by(day, Follows.user_being_followed_id))
+
+    return counts
+
+
+def _write(start, end, counts):
+    """Replace the rollups of the days from `start` up to `end`."""
+
+    for model in (DailyStats, UserDailyStats):
+        (db.session
+         .query(model)
+         .filter(model.day >= start, model.day < end)
+         .delete(synchronize_session=False))
+
+    days = {start + i * DAY: Counter() for i in range((end - start).days)}
+    for (day, user_id), user_counts in counts.items():
+        days[day].update(messages=user_counts['messages'],
+                         posters=1 if user_counts['messages'] else 0,
+                         likes=user_counts['likes_given'],
+                         follows=user_counts['follows_made'])
+
+    db.session.bulk_insert_mappings(DailyStats, [
+        {'day': day, 'messages': totals['messages'],
+         'posters': totals['posters'], 'likes': totals['likes'],
+         'follows': totals['follows']}
+        for day, totals in days.items()])
+    db.session.bulk_insert_mappings(UserDailyStats, [
+        {'day': day, 'user_id': user_id,
+         **{name: user_counts[name] for name in USER_COUNTS}}
+        for (day, user_id), user_counts in counts.items()])
+
+
+def _first_day():
+    """The first day with any activity recorded, or None."""
+
+    ids = [session.query(func.min(model.id)).scalar()
+           for session in shards.all()
+           for model in (Message, ArchivedMessage)]
+    times = ([snowflake.to_datetime(id) for id in ids if id is not None]
+             + [session.query(func.min(Like.created_at)).scalar()
+                for session in shards.all()]
+             + [db.session.query(func.min(Follows.created_at)).scalar()])
+    times = [time for time in times if time is not None]
+
+    return min(times).date() if times else None
+
+
+def roll_up(now=None, chunk_days=CHUNK_DAYS):
+    """Roll up every day not rolled up yet that ended at least LAG before
+    `now` (default: now). Returns the number of days rolled up."""
+
+    # days before this one are over
+    until = ((now or datetime.utcnow()) - LAG).date()
+    rolled_up = 0
+
+    while True:
+        # held until the commit, so runs take turns
+        watermark = (db.session
+                     .query(RollupWatermark)
+                     .with_for_update()
+                     .get(WATERMARK))
+        start = watermark.day if watermark else _first_day()
+
+        if start is None or start >= until:
+            db.session.commit()
+            return rolled_up
+
+        end = min(start + chunk_days * DAY, until)
+        _write(start, end, count_activity(start, end))
+
+        if watermark is None:
+            watermark = RollupWatermark(name=WATERMARK)
+            db.session.add(watermark)
+        watermark.day = end
+        watermark.updated_at = datetime.utcnow()
+        db.session.commit()
+
+        rolled_up += (end - start).days
+
+
+def rewind(since):
+    """Have the next run roll up the days from `since` again (or from the
+    first day with activity, if that is later)."""
+
+    watermark = RollupWatermark.query.get(WATERMARK)
+    if watermark is not None and watermark.day > since:
+        watermark.day = max(since, _first_day() or since)
+        watermark.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+def last_day():
+    """The last day rolled up, or None."""
+
+    watermark = RollupWatermark.query.get(WATERMARK)
+    return watermark.day - DAY if watermark else None
+
+
+def daily_stats(days, through):
+    """The rollups of the `days` days up to and including `through`, oldest
+    first, as DailyStatsDTOs."""
+
+    rows = (DailyStats.query
+            .filter(DailyStats.day > through - days * DAY,
+                    DailyStats.day <= through)
+            .order_by(DailyStats.day))
+    return [DailyStatsDTO.from_model(row) for row in rows]
+
+
+def top_users(days, through, by='followers_gained', limit=TOP_USERS):
+    """The `limit` users with the highest total `by` (one of USER_COUNTS)
+    over the `days` days up to and including `through`, as
+    UserActivityDTOs of their totals."""
+
+    totals = [func.sum(getattr(UserDailyStats, name))
+              for name in USER_COUNTS]
+    rows = (db.session
+            .query(UserDailyStats.user_id, *totals)
+            .filter(UserDailyStats.day > through - days * DAY,
+                    UserDailyStats.day <= through)
+            .group_by(UserDailyStats.user_id)
+            .order_by(func.sum(getattr(UserDailyStats, by)).desc(),
+                      UserDailyStats.user_id)
+            .limit(limit))
+    return [UserActivityDTO(*row) for row in rows]
+
+
+@rollups_cli.command('run')
+def run_command():
+    """Roll up the days that are over."""
+
+    click.echo(f"Rolled up {roll_up()} days.")
+
+
+@rollups_cli.command('backfill')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']),
+              required=True, help="First day to count again (YYYY-MM-DD).")
+def backfill_command(since):
+    """Count the days from --since again, then roll up the rest."""
+
+    rewind(since.date())
+    click.echo(f"Rolled up {roll_up()} days.")
+
+
+@rollups_cli.command('show')
+@click.option('--days', default=7, show_default=True)
+def show_command(days):
+    """Print the last days rolled up."""
+
+    through = last_day()
+    if through is None:
+        click.echo("Nothing rolled up yet: run `flask rollups run`.")
+        return
+
+    click.echo(f"{'day':<12}{'messages':>10}{'posters':>10}"
+               f"{'likes':>10}{'follows':>10}")
+    for row in daily_stats(days, through):
+        click.echo(f"{row.day.isoformat():<12}{row.messages:>10}"
+                   f"{row.posters:>10}{row.likes:>10}{row.follows:>10}")
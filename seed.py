@@ -1,8 +1,10 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
+from datetime import datetime
 from app import db
 from models import User, Message, Follows
+import snowflake
 
 db.drop_all()
 db.create_all()
@@ -11,7 +13,12 @@ with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    rows = list(DictReader(messages))
+    for sequence, row in enumerate(rows):
+        # ids are time-ordered, so make them from the seed timestamps
+        timestamp = datetime.strptime(row['timestamp'], '%Y-%m-%d %H:%M:%S.%f')
+        row['id'] = snowflake.from_datetime(timestamp, sequence=sequence % (snowflake.MAX_SEQUENCE + 1))
+    db.session.bulk_insert_mappings(Message, rows)
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
@@ -0,0 +1,492 @@
+"""Horizontal sharding of messages and likes.
+
+Sharding is opt-in. Without SHARD_DATABASE_URIS (the default) messages and
+likes stay in the main database and everything here works on `db.session`,
+so callers need not care whether sharding is on.
+
+With SHARD_DATABASE_URIS set to a comma-separated list of database URIs,
+`messages` and `likes` rows (and their archived copies; see archive.py),
+and the hashtag and mention index of messages (see tags.py), live in
+those databases instead; users,
+follows, trending scores and jobs stay in the main one. A message is
+stored on its author's shard: user id -> bucket (`user_id % NUM_BUCKETS`)
+-> shard, as listed in the main database's `shard_buckets` table. A like is stored with
+the message it is on, so timelines learn which messages the viewer liked
+without leaving the shard, and moving an author's bucket moves their
+messages together with every like on them.
+
+Message ids are time-ordered snowflake ids (see snowflake.py), unique
+across shards, so rows from several shards merge by id alone. The main
+database's `message_buckets` maps each message id to its bucket, so
+`find_message()` reads one shard; messages it doesn't know (none should
+be missing after `flask shards import`) are looked for on every shard.
+
+Each process caches the bucket map for SHARD_MAP_TTL seconds, which is
+enough to route reads. Writes read their bucket's row again, under a
+share lock held until the main database commits: a bucket can't be
+marked moving, or pointed at another shard, while a write to it is under
+way.
+
+`flask shards init` creates the tables on the shards and assigns each
+bucket to shard `bucket % number of shards`, `flask shards import` copies messages and likes from the main database, `flask shards
+rebalance` moves buckets to the shard they belong on after shards are
+added, and `flask shards status` shows how rows are spread.
+"""
+
+import time
+
+import click
+from flask import _app_ctx_stack
+from flask.cli import AppGroup
+from sqlalchemy import MetaData, create_engine, func
+from sqlalchemy.orm import scoped_session, sessionmaker
+from werkzeug.exceptions import ServiceUnavailable
+
+from models import (db, Message, Like, ArchivedMessage, ArchivedLike,
+                    MessageTag, MessageMention, ShardBucket, MessageBucket)
+
+NUM_BUCKETS = 1024
+
+COPY_BATCH_SIZE = 1000
+
+shards_cli = AppGroup('shards', help="Manage message and like shards.")
+
+
+class BucketMoving(ServiceUnavailable):
+    """A write to a bucket that is being moved to another shard."""
+
+    description = "This account is being moved. Please try again shortly."
+
+
+def bucket_of(user_id):
+    """The bucket `user_id`'s messages are kept in."""
+
+    return user_id % NUM_BUCKETS
+
+
+def shard_metadata():
+    """The tables kept on every shard.
+
+    Foreign keys to tables that only exist in the main database (users)
+    are left out; those from likes to messages are kept.
+    """
+
+    metadata = MetaData()
+    for table in (Message.__table__, Like.__table__,
+                  ArchivedMessage.__table__, ArchivedLike.__table__,
+                  MessageTag.__table__, MessageMention.__table__):
+        table.tometadata(metadata)
+
+    for table in metadata.tables.values():
+        for constraint in list(table.foreign_key_constraints):
+            referred = constraint.elements[0].target_fullname.split('.')[0]
+            if referred in metadata.tables:
+                continue
+
+            table.constraints.discard(constraint)
+            for fk in constraint.elements:
+                table.foreign_keys.discard(fk)
+                fk.parent.foreign_keys.discard(fk)
+
+    return metadata
+
+
+class Shards:
+    """Routes messages and likes to the shard databases."""
+
+    def __init__(self, app=None):
+        self.engines = []
+        self.sessions = []
+        self._buckets = {}
+        self._moving = set()
+        self._loaded_at = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SHARD_DATABASE_URIS', None)
+        # how long a process may go on using an outdated bucket map
+        app.config.setdefault('SHARD_MAP_TTL', 30)
+
+        self.app = app
+        self.configure(app.config['SHARD_DATABASE_URIS'])
+        app.teardown_appcontext(self.remove)
+        app.cli.add_command(shards_cli)
+
+    def configure(self, uris):
+        """Use the databases at `uris` (a list, or a comma-separated
+        string) as shards; with none, turn sharding off."""
+
+        if isinstance(uris, str):
+            uris = [uri.strip() for uri in uris.split(',') if uri.strip()]
+
+        self.remove()
+        for engine in self.engines:
+            engine.dispose()
+
+        self.engines = [create_engine(uri) for uri in uris or []]
+        self.sessions = [
+            scoped_session(sessionmaker(bind=engine),
+                           scopefunc=_app_ctx_stack.__ident_func__)
+            for engine in self.engines]
+        self.reload()
+
+    @property
+    def enabled(self):
+        return bool(self.sessions)
+
+    def remove(self, exc=None):
+        """End the shard sessions, returning their connections."""
+
+        for session in self.sessions:
+            session.remove()
+
+    def reload(self):
+        """Read the bucket map again on next use."""
+
+        self._loaded_at = None
+
+    def _load_buckets(self):
+        ttl = self.app.config['SHARD_MAP_TTL']
+        if (self._loaded_at is not None
+                and time.monotonic() - self._loaded_at < ttl):
+            return
+
+        rows = db.session.query(ShardBucket.bucket,
+                                ShardBucket.shard,
+                                ShardBucket.moving).all()
+
+        self._buckets = {bucket: shard for bucket, shard, moving in rows}
+        self._moving = {bucket for bucket, shard, moving in rows if moving}
+        self._loaded_at = time.monotonic()
+
+    def shard_of_bucket(self, bucket):
+        """Index of the shard holding `bucket`.
+
+        Buckets are assigned by `init_shards()`; until then, they are on
+        shard `bucket % number of shards`.
+        """
+
+        self._load_buckets()
+        return self._buckets.get(bucket, bucket % len(self.sessions))
+
+    def all(self):
+        """Sessions of every shard."""
+
+        return list(self.sessions) or [db.session]
+
+    def for_user(self, user_id, write=False):
+        """Session of the shard holding `user_id`'s messages and the
+        likes on them.
+
+        With `write`, raise BucketMoving while the user's bucket is being
+        moved to another shard; otherwise keep the bucket where it is
+        until the main database commits (see `commit()`).
+        """
+
+        if not self.enabled:
+            return db.session
+
+        bucket = bucket_of(user_id)
+        shard = self.shard_of_bucket(bucket)
+        moving = bucket in self._moving
+
+        if write:
+            # the map may be SHARD_MAP_TTL old
+            row = (db.session
+                   .query(ShardBucket.shard, ShardBucket.moving)
+                   .filter_by(bucket=bucket)
+                   .with_for_update(read=True)
+                   .first())
+            if row is not None:
+                shard, moving = row
+
+            if moving:
+                raise BucketMoving(
+                    retry_after=self.app.config['SHARD_MAP_TTL'])
+
+        return self.sessions[shard]
+
+    def by_shard(self, user_ids):
+        """Split `user_ids` by shard: a list of (session, user ids)."""
+
+        if not self.enabled:
+            return [(db.session, list(user_ids))]
+
+        groups = {}
+        for user_id in user_ids:
+            shard = self.shard_of_bucket(bucket_of(user_id))
+            groups.setdefault(shard, []).append(user_id)
+
+        return [(self.sessions[shard], ids) for shard, ids in groups.items()]
+
+    def find_message(self, message_id, write=False):
+        """The message with `message_id` and the session it was loaded
+        in, as (session, message), or (None, None).
+
+        With `write`, raise BucketMoving while the message's bucket is
+        being moved to another shard, and load it from the shard writes
+        go to.
+        """
+
+        sessions = self.all()
+        if self.enabled:
+            bucket = (db.session
+                      .query(MessageBucket.bucket)
+                      .filter_by(message_id=message_id)
+                      .scalar())
+            if bucket is not None:
+                sessions = [self.sessions[self.shard_of_bucket(bucket)]]
+
+        for session in sessions:
+            msg = session.query(Message).get(message_id)
+            if msg is not None:
+                if write:
+                    session = self.for_user(msg.user_id, write=True)
+                    msg = session.query(Message).get(message_id)
+                return session, msg
+
+        return None, None
+
+    def add_message(self, msg):
+        """Add a new message to its author's shard and flush it; returns
+        the shard's session. Commit with `commit()`."""
+
+        session = self.for_user(msg.user_id, write=True)
+        session.add(msg)
+        session.flush()
+        if self.enabled:
+            db.session.add(MessageBucket(message_id=msg.id,
+                                         bucket=bucket_of(msg.user_id)))
+        return session
+
+    def last_message_id(self):
+        """The highest message id on any shard (0 if there are none)."""
+
+        return max(session.query(func.max(Message.id)).scalar() or 0
+                   for session in self.all())
+
+    def commit(self):
+        """Commit the shards, then the main database.
+
+        The databases commit one after another, not atomically: if the
+        main database fails to commit after the shards did, a message or
+        like is saved while what the main database keeps about it (its
+        MessageBucket, trending scores, notifications) is lost. The main
+        database goes last because it holds the locks on `shard_buckets`
+        taken by writes (see `for_user()`), which must outlast the writes
+        to the shards.
+        """
+
+        for session in self.sessions:
+            session.commit()
+        db.session.commit()
+
+
+shards = Shards()
+
+
+##############################################################################
+# Moving rows between databases
+
+
+def _bucket_messages(session, bucket):
+    return (session
+            .query(Message.id)
+            .filter(Message.user_id % NUM_BUCKETS == bucket))
+
+
+def copy_messages(source, target, criterion, batch_size=COPY_BATCH_SIZE):
+    """Copy the messages matching `criterion`, and the likes on them and
+    their tags and mentions, from session `source` to session `target`.
+    Returns how many messages were copied."""
+
+    copied = 0
+    after = 0
+
+    while True:
+        messages = (source
+                    .query(Message.id, Message.text,
+                           Message.timestamp, Message.user_id)
+                    .filter(criterion, Message.id > after)
+                    .order_by(Message.id)
+                    .limit(batch_size)
+                    .all())
+        if not messages:
+            return copied
+
+        ids = [msg.id for msg in messages]
+        target.bulk_insert_mappings(Message, [msg._asdict() for msg in messages])
+        for model in (Like, MessageTag, MessageMention):
+            rows = (source
+                    .query(*model.__table__.c)
+                    .filter(model.message_id.in_(ids)))
+            target.bulk_insert_mappings(model, [row._asdict() for row in rows])
+        target.commit()
+
+        copied += len(ids)
+        after = ids[-1]
+
+
+def delete_bucket(session, bucket, batch_size=COPY_BATCH_SIZE):
+    """Delete the messages of users in `bucket`, and the likes on them and
+    their tags and mentions, from the database of `session`."""
+
+    while True:
+        ids = [id for (id,) in _bucket_messages(session, bucket).limit(batch_size)]
+        if not ids:
+            return
+
+        for model in (Like, MessageTag, MessageMention):
+            (session
+             .query(model)
+             .filter(model.message_id.in_(ids))
+             .delete(synchronize_session=False))
+        (session
+         .query(Message)
+         .filter(Message.id.in_(ids))
+         .delete(synchronize_session=False))
+        session.commit()
+
+
+def _set_buckets(assignments, moving):
+    for bucket, shard in assignments.items():
+        db.session.merge(ShardBucket(bucket=bucket, shard=shard, moving=moving))
+    db.session.commit()
+    shards.reload()
+
+
+def move_buckets(moves, wait=None):
+    """Move buckets to other shards; `moves` maps bucket to shard index.
+
+    The buckets are first marked as moving, which makes writes to them
+    fail with BucketMoving, and their rows are copied once every process
+    has seen that (SHARD_MAP_TTL seconds, or `wait`). The map is then
+    pointed at the new shards, and the old copies deleted once every
+    process has stopped reading them. Returns how many messages moved.
+    """
+
+    if wait is None:
+        wait = shards.app.config['SHARD_MAP_TTL']
+
+    sources = {bucket: shards.shard_of_bucket(bucket) for bucket in moves}
+    moves = {bucket: shard for bucket, shard in moves.items()
+             if sources[bucket] != shard}
+    if not moves:
+        return 0
+
+    _set_buckets({bucket: sources[bucket] for bucket in moves}, moving=True)
+    time.sleep(wait)
+
+    copied = 0
+    for bucket, shard in moves.items():
+        source = shards.sessions[sources[bucket]]
+        target = shards.sessions[shard]
+
+        # left over from an earlier, interrupted move
+        delete_bucket(target, bucket)
+        copied += copy_messages(source, target,
+                                Message.user_id % NUM_BUCKETS == bucket)
+
+    _set_buckets(moves, moving=False)
+    time.sleep(wait)
+
+    for bucket in moves:
+        delete_bucket(shards.sessions[sources[bucket]], bucket)
+
+    return copied
+
+
+def rebalance(wait=None):
+    """Move every bucket to shard `bucket % number of shards`, e.g. after
+    adding shards. Returns how many messages moved."""
+
+    count = len(shards.sessions)
+    return move_buckets({bucket: bucket % count
+                         for bucket in range(NUM_BUCKETS)}, wait)
+
+
+def import_from_main(batch_size=COPY_BATCH_SIZE):
+    """Copy every message and like in the main database to the shards.
+
+    The main database's copies are left in place. Returns how many
+    messages were copied.
+    """
+
+    copied = 0
+    for shard, session in enumerate(shards.sessions):
+        buckets = [bucket for bucket in range(NUM_BUCKETS)
+                   if shards.shard_of_bucket(bucket) == shard]
+        copied += copy_messages(
+            db.session, session,
+            (Message.user_id % NUM_BUCKETS).in_(buckets), batch_size)
+
+    # where to find them by id
+    known = db.session.query(MessageBucket.message_id)
+    db.session.execute(MessageBucket.__table__.insert().from_select(
+        ['message_id', 'bucket'],
+        db.session
+        .query(Message.id, Message.user_id % NUM_BUCKETS)
+        .filter(Message.id.notin_(known))))
+    db.session.commit()
+
+    return copied
+
+
+def init_shards():
+    """Create the message and like tables on every shard, and assign each
+    unassigned bucket to shard `bucket % number of shards`.
+
+    Buckets keep their shard when shards are added later, until they are
+    moved with `rebalance()`.
+    """
+
+    metadata = shard_metadata()
+    for engine in shards.engines:
+        metadata.create_all(engine)
+
+    assigned = {bucket for (bucket,) in db.session.query(ShardBucket.bucket)}
+    db.session.bulk_insert_mappings(ShardBucket, [
+        {'bucket': bucket, 'shard': bucket % len(shards.engines),
+         'moving': False}
+        for bucket in range(NUM_BUCKETS) if bucket not in assigned])
+    db.session.commit()
+    shards.reload()
+
+
+@shards_cli.command('init')
+def init_command():
+    """Create the shard tables and assign buckets to shards."""
+
+    init_shards()
+    click.echo(f"Created tables on {len(shards.engines)} shards.")
+
+
+@shards_cli.command('import')
+def import_command():
+    """Copy messages and likes from the main database to the shards."""
+
+    copied = import_from_main()
+    click.echo(f"Copied {copied} messages.")
+
+
+@shards_cli.command('rebalance')
+@click.option('--wait', type=float, default=None,
+              help="Seconds for other processes to see map changes "
+                   "(default: SHARD_MAP_TTL).")
+def rebalance_command(wait):
+    """Spread buckets evenly over the configured shards."""
+
+    moved = rebalance(wait)
+    click.echo(f"Moved {moved} messages.")
+
+
+@shards_cli.command('status')
+def status_command():
+    """Show how many messages and likes each shard holds."""
+
+    for index, session in enumerate(shards.sessions):
+        messages = session.query(func.count(Message.id)).scalar()
+        likes = session.query(func.count(Like.message_id)).scalar()
+        click.echo(f"shard {index}: {messages} messages, {likes} likes")
@@ -0,0 +1,239 @@
+"""Time-ordered 64-bit ids for messages.
+
+An id packs, from the high bits down:
+
+    41 bits  milliseconds since EPOCH (good until 2079)
+    10 bits  worker id
+    12 bits  sequence number within the millisecond
+
+so ids sort by creation time, need no database sequence, and can be made
+by many processes at once as long as each has its own worker id.
+Timelines order and page by `Message.id` alone.
+
+Each process leases a worker id from the `snowflake_workers` table (again
+after a fork), and renews the lease as it goes; requests do so before
+they start, outside any transaction. SNOWFLAKE_WORKER_ID fixes the worker id instead; only use it
+when every process gets a different value.
+
+A process keeps handing out increasing ids even if the clock steps back;
+they just run ahead of the clock until it catches up.
+"""
+
+import atexit
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+# early enough for the generator's seed messages
+EPOCH = datetime(2010, 1, 1)
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+# a lease is renewed once less than half of it is left
+LEASE_DURATION = timedelta(minutes=10)
+
+
+class WorkerIdsExhausted(RuntimeError):
+    """Every worker id is leased to a live process."""
+
+
+def make_id(ms, worker_id=0, sequence=0):
+    """The id for millisecond `ms` (since EPOCH), worker and sequence."""
+
+    return (ms << TIMESTAMP_SHIFT) | (worker_id << SEQUENCE_BITS) | sequence
+
+
+def from_datetime(dt, worker_id=0, sequence=0):
+    """The id for a (naive UTC) datetime, e.g. to give existing rows ids
+    in time order. With the defaults, the smallest id at `dt`."""
+
+    if dt < EPOCH:
+        raise ValueError(f"{dt} is before the snowflake epoch")
+
+    ms = (dt - EPOCH) // timedelta(milliseconds=1)
+    return make_id(ms, worker_id, sequence)
+
+
+def to_datetime(snowflake_id):
+    """The (naive UTC) time at which `snowflake_id` was made."""
+
+    return EPOCH + timedelta(milliseconds=snowflake_id >> TIMESTAMP_SHIFT)
+
+
+def lease_worker_id(holder, renew=None):
+    """Lease a worker id to `holder` for LEASE_DURATION.
+
+    With `renew`, extend the lease on that id if `holder` still has it.
+    Returns (worker id, lease expiry). Each attempt runs in its own
+    transaction, apart from the caller's.
+    """
+
+    from models import db, SnowflakeWorker
+
+    workers = SnowflakeWorker.__table__
+    now = datetime.utcnow()
+    lease = {'holder': holder, 'expires_at': now + LEASE_DURATION}
+
+    if renew is not None:
+        with db.engine.begin() as conn:
+            renewed = conn.execute(
+                workers.update()
+                .where(workers.c.worker_id == renew)
+                .where(workers.c.holder == holder)
+                .values(**lease)).rowcount
+        if renewed:
+            return renew, lease['expires_at']
+
+    with db.engine.connect() as conn:
+        leases = dict(conn.execute(
+            select([workers.c.worker_id, workers.c.expires_at])).fetchall())
+
+    for worker_id in range(MAX_WORKER_ID + 1):
+        if worker_id in leases and leases[worker_id] >= now:
+            continue
+
+        try:
+            with db.engine.begin() as conn:
+                if worker_id in leases:
+                    # expired; take it unless someone else just did
+                    taken = conn.execute(
+                        workers.update()
+                        .where(workers.c.worker_id == worker_id)
+                        .where(workers.c.expires_at < now)
+                        .values(**lease)).rowcount
+                else:
+                    conn.execute(workers.insert().values(worker_id=worker_id,
+                                                         **lease))
+                    taken = 1
+        except IntegrityError:
+            taken = 0
+
+        if taken:
+            return worker_id, lease['expires_at']
+
+    raise WorkerIdsExhausted("No free snowflake worker id")
+
+
+def release_worker_id(holder, worker_id):
+    """End `holder`'s lease on `worker_id`."""
+
+    from models import db, SnowflakeWorker
+
+    workers = SnowflakeWorker.__table__
+    with db.engine.begin() as conn:
+        conn.execute(workers.delete()
+                     .where(workers.c.worker_id == worker_id)
+                     .where(workers.c.holder == holder))
+
+
+class Generator:
+    """Makes increasing ids; safe to share between threads."""
+
+    def __init__(self, worker_id=None, lease=lease_worker_id,
+                 release=release_worker_id):
+        self._lease = lease
+        self._release = release
+        self._lock = threading.Lock()
+        self.configure(worker_id)
+
+        # a forked child must not reuse its parent's worker id
+        os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.release)
+
+    def configure(self, worker_id=None):
+        """Always use `worker_id`; with None, lease worker ids."""
+
+        if worker_id is not None and not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"Worker id must be 0-{MAX_WORKER_ID}")
+
+        self.fixed_worker_id = worker_id
+        self.worker_id = worker_id
+        self._expires_at = None
+        self._last_ms = -1
+        self._sequence = 0
+
+    def init_app(self, app):
+        worker_id = app.config.get('SNOWFLAKE_WORKER_ID')
+        self.configure(None if worker_id in (None, '') else int(worker_id))
+        app.before_request(self.check_lease)
+
+    @property
+    def holder(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        if self.fixed_worker_id is None:
+            self.worker_id = self._expires_at = None
+
+    def check_lease(self):
+        """Lease a worker id, or renew the lease, if it is time to."""
+
+        with self._lock:
+            self._check_lease()
+
+    def _check_lease(self):
+        if self.fixed_worker_id is not None:
+            return
+
+        now = datetime.utcnow()
+
+        if self.worker_id is None or self._expires_at <= now:
+            self.worker_id, self._expires_at = self._lease(self.holder)
+
+        elif self._expires_at - now < LEASE_DURATION / 2:
+            try:
+                self.worker_id, self._expires_at = self._lease(
+                    self.holder, self.worker_id)
+            except SQLAlchemyError:
+                # still ours for a while; try again on the next id
+                pass
+
+    def release(self):
+        """Give up this process's leased worker id, if it has one."""
+
+        if self.fixed_worker_id is None and self.worker_id is not None:
+            try:
+                self._release(self.holder, self.worker_id)
+            except Exception:
+                # the lease just runs out
+                pass
+            self.worker_id = self._expires_at = None
+
+    def next_id(self):
+        with self._lock:
+            self._check_lease()
+            now_ms = int(time.time() * 1000) - EPOCH_MS
+
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            elif self._sequence < MAX_SEQUENCE:
+                self._sequence += 1
+            else:
+                # this millisecond is used up: borrow the next one
+                self._last_ms += 1
+                self._sequence = 0
+
+            return make_id(self._last_ms, self.worker_id, self._sequence)
+
+
+generator = Generator()
+
+
+def next_id():
+    """A new id from this process's generator."""
+
+    return generator.next_id()
@@ -1,15 +1,20 @@
 "use strict";
 
-const $likeBtns = $(".like-button");
-const BASE_URL = "https://seankim-warbler.herokuapp.com";
+/* Sends the page's CSRF token (see base.html) with every POST axios
+makes; the server rejects POSTs without it. */
+
+axios.defaults.headers.post["X-CSRFToken"] =
+  $('meta[name="csrf-token"]').attr("content");
 
 /* Function makes a post request to /messages/{id}/like 
--adds like or deletes like from likes table */
+-adds like or deletes like from likes table. Sends the state wanted rather
+than asking for a toggle, so a repeated click can't undo itself. */
 
-async function addOrRemoveLike(id) {
+async function addOrRemoveLike(id, liked) {
   await axios({
-    url: `${BASE_URL}/messages/${id}/like`,
-    method: "POST"
+    url: `/messages/${id}/like`,
+    method: "POST",
+    data: { liked }
   });
 }
 
@@ -20,19 +25,64 @@ async function handleBtnClick(evt) {
   let $btn = $likeIcon.closest('button');
   let id = $btn.attr('data-id');
 
-  await addOrRemoveLike(id);
+  await addOrRemoveLike(id, !$likeIcon.hasClass('liked-message'));
   
   $likeIcon.toggleClass('liked-message unliked-message');
   $likeIcon.toggleClass('fas far');
 }
 
-/* Add event listener on like buttons */
+/* Adds a timeline item ({id, html}) pushed by the server to the top of the
+timeline, unless it is already shown. Message ids and cursors are strings
+and must stay strings: they are too large for a number to hold exactly. */
 
-function start() {
-  for (let btn of $likeBtns) {
-    let $btn = $(btn);
-    $btn.on('click', handleBtnClick);
+function prependTimelineItem($timeline, item) {
+  if ($timeline.find(`[data-message-id="${item.id}"]`).length) return;
+  $timeline.prepend(item.html);
+  $timeline.attr('data-live-cursor', item.id);
+}
+
+/* Long-polls /timeline/poll for new messages, for browsers without
+EventSource. */
+
+async function pollTimeline($timeline) {
+  while (true) {
+    try {
+      let resp = await axios.get("/timeline/poll", {
+        params: { after: $timeline.attr('data-live-cursor') }
+      });
+      resp.data.messages.forEach(item => prependTimelineItem($timeline, item));
+      // the server had no thread to spare for waiting
+      if (resp.data.retry_after) {
+        await new Promise(
+          resolve => setTimeout(resolve, resp.data.retry_after * 1000));
+      }
+    } catch (err) {
+      await new Promise(resolve => setTimeout(resolve, 5000));
+    }
   }
 }
 
-start();
\ No newline at end of file
+/* Keeps the homepage timeline up to date without reloading the page. */
+
+function startLiveTimeline() {
+  let $timeline = $("#messages[data-live-cursor]");
+  if (!$timeline.length) return;
+
+  if (!window.EventSource) {
+    pollTimeline($timeline);
+    return;
+  }
+
+  let source = new EventSource(
+    `/timeline/stream?after=${$timeline.attr('data-live-cursor')}`);
+  source.onmessage = evt => prependTimelineItem($timeline, JSON.parse(evt.data));
+}
+
+/* Add event listener on like buttons (including ones added later) */
+
+function start() {
+  $(document).on('click', '.like-button', handleBtnClick);
+  startLiveTimeline();
+}
+
+start();
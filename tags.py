@@ -0,0 +1,178 @@
+"""Hashtags and @mentions, indexed so a topic or a user's mentions can be
+read without scanning `messages`.
+
+`index_message()` puts the #tags of a new message and the users it
+@mentions into `message_tags` and `message_mentions`, on the message's
+shard. `readmodels.tag_timeline()` and `mentions_timeline()` read them
+newest first by (tag or user, message id), and a page continues from the
+last message shown (`?before=<id>`), which the index finds directly
+however deep the page is.
+
+Index rows have no foreign key to their message; code that deletes
+messages calls `forget_messages()` as well.
+
+`flask tags backfill` indexes the messages posted before the index
+existed. It splits each shard's messages into batches of consecutive ids
+and queues an `index_messages` job for each, which any number of
+`flask jobs work` processes run side by side. A batch is reindexed from
+scratch, so the backfill can be rerun, e.g. after a rebalance.
+"""
+
+import re
+
+import click
+from flask.cli import AppGroup
+from markupsafe import Markup, escape
+
+from jobs import job, enqueue
+from models import db, User, Message, MessageTag, MessageMention
+from shards import shards
+from usernames import username_filter
+
+# not after a word character, so "a#b" and e-mail addresses don't count;
+# nor after '&', which starts an escaped character like "&#39;"
+TAG_RE = re.compile(r'(?<![\w#&])#(\w+)')
+MENTION_RE = re.compile(r'(?<![\w@])@(\w(?:[\w.-]*\w)?)')
+
+BACKFILL_BATCH_SIZE = 1000
+
+tags_cli = AppGroup('tags', help="Manage the hashtag and mention index.")
+
+
+def extract_tags(text):
+    """The hashtags in `text`, lowercased and without the '#'."""
+
+    return {tag.lower() for tag in TAG_RE.findall(text)}
+
+
+def extract_mentions(text):
+    """The usernames `text` mentions."""
+
+    return set(MENTION_RE.findall(text))
+
+
+def _index_rows(messages):
+    """Rows of `message_tags` and `message_mentions` for `messages`, a
+    list of (id, text)."""
+
+    tag_rows = [{'tag': tag, 'message_id': id}
+                for id, text in messages
+                for tag in extract_tags(text)]
+
+    mentions = {id: extract_mentions(text) for id, text in messages}
+    usernames = {name
+                 for names in mentions.values()
+                 for name in names
+                 if username_filter.might_exist(name)}
+
+    user_ids = {}
+    if usernames:
+        user_ids = dict(db.session
+                        .query(User.username, User.id)
+                        .filter(User.username.in_(usernames),
+                                User.deleted_at.is_(None)))
+
+    mention_rows = [{'user_id': user_ids[name], 'message_id': id}
+                    for id, names in mentions.items()
+                    for name in names if name in user_ids]
+
+    return tag_rows, mention_rows
+
+
+def index_message(session, msg):
+    """Index the tags and mentions of new message `msg` in `session`, the
+    session of its shard (as `shards.add_message()` returns). The caller
+    commits."""
+
+    tag_rows, mention_rows = _index_rows([(msg.id, msg.text)])
+    session.bulk_insert_mappings(MessageTag, tag_rows)
+    session.bulk_insert_mappings(MessageMention, mention_rows)
+
+
+def forget_messages(session, message_ids):
+    """Remove the index rows of `message_ids` (a list or a query of ids)
+    from the database of `session`."""
+
+    for model in (MessageTag, MessageMention):
+        (session
+         .query(model)
+         .filter(model.message_id.in_(message_ids))
+         .delete(synchronize_session=False))
+
+
+def link_tags(text):
+    """`text`, escaped, with each hashtag linked to its page; a template
+    filter."""
+
+    return Markup(TAG_RE.sub(
+        lambda match: f'<a href="/tags/{match[1].lower()}">#{match[1]}</a>',
+        str(escape(text))))
+
+
+@job('index_messages', concurrency=4)
+def index_messages(shard, after, through):
+    """Reindex the messages on shard number `shard` (in `shards.all()`)
+    with ids above `after`, up to and including `through`."""
+
+    session = shards.all()[shard]
+
+    messages = (session
+                .query(Message.id, Message.text)
+                .filter(Message.id > after, Message.id <= through)
+                .all())
+
+    for model in (MessageTag, MessageMention):
+        (session
+         .query(model)
+         .filter(model.message_id > after, model.message_id <= through)
+         .delete(synchronize_session=False))
+
+    tag_rows, mention_rows = _index_rows(messages)
+    session.bulk_insert_mappings(MessageTag, tag_rows)
+    session.bulk_insert_mappings(MessageMention, mention_rows)
+    session.commit()
+
+
+def queue_backfill(batch_size=BACKFILL_BATCH_SIZE):
+    """Queue an `index_messages` job for every `batch_size` messages on
+    each shard. Returns the number of jobs queued."""
+
+    queued = 0
+
+    for shard, session in enumerate(shards.all()):
+        after = 0
+
+        while True:
+            # the last id of the next batch, or of what is left
+            through = (session
+                       .query(Message.id)
+                       .filter(Message.id > after)
+                       .order_by(Message.id)
+                       .offset(batch_size - 1)
+                       .limit(1)
+                       .scalar()
+                       or session
+                       .query(db.func.max(Message.id))
+                       .filter(Message.id > after)
+                       .scalar())
+            if through is None:
+                break
+
+            enqueue('index_messages',
+                    dedup_key=f"index_messages:{shard}:{after}",
+                    shard=shard, after=after, through=through)
+            queued += 1
+            after = through
+
+    db.session.commit()
+    return queued
+
+
+@tags_cli.command('backfill')
+@click.option('--batch-size', default=BACKFILL_BATCH_SIZE, show_default=True)
+def backfill_command(batch_size):
+    """Queue indexing the tags and mentions of every message."""
+
+    queued = queue_backfill(batch_size)
+    click.echo(f"Queued {queued} batches; run `flask jobs work` to index "
+               f"them.")
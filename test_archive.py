@@ -0,0 +1,167 @@
+"""Message archive tests.
+
+Partitioning needs Postgres; these cover archiving row by row, which every
+database uses until its tables are partitioned.
+"""
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+from app import app, CURR_USER_KEY
+from models import (User, Message, Like, ArchivedMessage, ArchivedLike,
+                    Job, db)
+import archive
+import purge
+import readmodels
+import snowflake
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class ArchiveTestCase(TestCase):
+    """Tests moving old messages to the archive and reading them back."""
+
+    def setUp(self):
+        """Adds two users; user1 posts an old and a new message, both
+        liked by user0."""
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User.signup(f"user{i}", f"user{i}@user{i}.com",
+                             "password", None)
+                 for i in range(2)]
+        db.session.commit()
+        self.user0, self.user1 = [user.id for user in users]
+
+        self.old = self.post("From long ago", days_ago=400)
+        self.new = self.post("From today")
+
+        db.session.add_all([Like(message_id=self.old, user_id=self.user0),
+                            Like(message_id=self.new, user_id=self.user0)])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        db.session.rollback()
+
+    def post(self, text, days_ago=0):
+        timestamp = datetime.utcnow() - timedelta(days=days_ago)
+        msg = Message(id=snowflake.from_datetime(timestamp), text=text,
+                      timestamp=timestamp, user_id=self.user1)
+        db.session.add(msg)
+        db.session.commit()
+        return msg.id
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_months(self):
+        self.assertEqual(list(archive.months(datetime(2020, 11, 15),
+                                             datetime(2021, 2, 1))),
+                         [datetime(2020, 11, 1), datetime(2020, 12, 1),
+                          datetime(2021, 1, 1), datetime(2021, 2, 1)])
+
+        start, end = archive.id_range(datetime(2020, 12, 1))
+        self.assertEqual(snowflake.to_datetime(start), datetime(2020, 12, 1))
+        self.assertEqual(snowflake.to_datetime(end), datetime(2021, 1, 1))
+        self.assertEqual(archive.partition_name('messages',
+                                                datetime(2020, 12, 1)),
+                         'messages_2020_12')
+
+    def test_archive_messages(self):
+        self.assertEqual(archive.archive_messages(batch_size=1), 1)
+
+        self.assertEqual([msg.id for msg in Message.query], [self.new])
+        self.assertEqual([like.message_id for like in Like.query], [self.new])
+        self.assertEqual([msg.id for msg in ArchivedMessage.query], [self.old])
+        self.assertEqual(
+            [(like.message_id, like.user_id) for like in ArchivedLike.query],
+            [(self.old, self.user0)])
+
+        # nothing left to archive
+        self.assertEqual(archive.archive_messages(), 0)
+
+    def test_cutoff_setting(self):
+        app.config['ARCHIVE_AFTER_DAYS'] = 500
+        try:
+            self.assertEqual(archive.archive_messages(), 0)
+        finally:
+            del app.config['ARCHIVE_AFTER_DAYS']
+
+    def test_show_archived_message(self):
+        archive.archive_messages()
+
+        resp = self.client.get(f"/messages/{self.old}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("From long ago", resp.get_data(as_text=True))
+
+        self.assertEqual(self.client.get("/messages/12345").status_code, 404)
+
+    def test_delete_archived_message(self):
+        archive.archive_messages()
+        self.login(self.user1)
+
+        resp = self.client.post(f"/messages/{self.old}/delete")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(ArchivedMessage.query.count(), 0)
+
+    def test_timeline_reads_past_recent_window(self):
+        items = readmodels.timeline([self.user1])
+        self.assertEqual([item.id for item in items], [self.new, self.old])
+
+        self.assertEqual(
+            [item.id for item in readmodels.timeline([self.user1], limit=1)],
+            [self.new])
+
+        archive.archive_messages()
+        self.assertEqual([item.id for item in readmodels.timeline([self.user1])],
+                         [self.new])
+
+    def test_purge_removes_archive(self):
+        archive.archive_messages()
+
+        purge.purge_user(self.user1)
+
+        self.assertEqual(ArchivedMessage.query.count(), 0)
+        self.assertEqual(ArchivedLike.query.count(), 0)
+
+    def test_commands(self):
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=["archive", "run"])
+        self.assertIn("Archived 1 messages.", result.output)
+
+        # nothing to do outside Postgres
+        result = runner.invoke(args=["archive", "partitions"])
+        self.assertIn("ready in 0 databases", result.output)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_partitions_kept_ahead(self):
+        """ where messages are partitioned, a daily job keeps creating the
+        coming months' partitions """
+
+        with patch.object(archive, 'ensure_partitions', return_value=1):
+            archive.maintain_partitions()
+            archive.maintain_partitions()
+
+        queued = Job.query.one()
+        self.assertEqual(queued.name, 'archive_partitions')
+        self.assertGreater(queued.run_at, datetime.utcnow())
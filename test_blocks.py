@@ -0,0 +1,196 @@
+"""Block and mute tests."""
+
+from unittest import TestCase
+from app import app, CURR_USER_KEY
+from models import User, Message, Like, Follows, Blocks, Mutes, db
+import blocks
+import follows
+import purge
+import readmodels
+import snowflake
+from usernames import username_filter
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class BlocksTestCase(TestCase):
+    """Tests muting and blocking, and that reads leave hidden users out."""
+
+    def setUp(self):
+        """Adds user0, who follows user1 and user2; each posts a message
+        tagged #hello mentioning user0, which user0 likes."""
+
+        db.drop_all()
+        db.create_all()
+
+        # no worker id leases in the middle of a request
+        snowflake.generator.configure(worker_id=1)
+
+        users = [User.signup(f"user{i}", f"user{i}@user{i}.com",
+                             "password", None)
+                 for i in range(3)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+        self.user0, self.user1, self.user2 = self.ids
+
+        db.session.add_all([
+            Follows(user_following_id=self.user0,
+                    user_being_followed_id=self.user1),
+            Follows(user_following_id=self.user0,
+                    user_being_followed_id=self.user2)])
+        db.session.commit()
+
+        self.context = app.app_context()
+        self.context.push()
+        username_filter.rebuild()
+
+        self.client = app.test_client()
+        self.message_ids = {}
+        for user_id in self.ids[1:]:
+            self.login(user_id)
+            self.client.post("/messages/new",
+                             data={"text": "#hello @user0"})
+            self.message_ids[user_id] = (db.session
+                                         .query(Message.id)
+                                         .filter_by(user_id=user_id)
+                                         .scalar())
+
+        db.session.add_all([Like(user_id=self.user0, message_id=message_id)
+                            for message_id in self.message_ids.values()])
+        db.session.commit()
+
+        self.login(self.user0)
+
+    def tearDown(self):
+        self.context.pop()
+        db.session.rollback()
+        snowflake.generator.configure()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def author_ids(self, items):
+        return {item.user_id for item in items}
+
+    def test_mute_hides_messages(self):
+        resp = self.client.post(f"/users/mute/{self.user1}",
+                                headers={"Referer": "/"})
+        self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(readmodels.timeline_author_ids(self.user0),
+                         {self.user0, self.user2})
+        items, before = readmodels.liked_timeline(self.user0, self.user0)
+        self.assertEqual(self.author_ids(items), {self.user2})
+        items, before = readmodels.tag_timeline("hello", self.user0)
+        self.assertEqual(self.author_ids(items), {self.user2})
+        items, before = readmodels.mentions_timeline(self.user0, self.user0)
+        self.assertEqual(self.author_ids(items), {self.user2})
+
+        # others still see them, and a mute doesn't end the follow
+        items, before = readmodels.tag_timeline("hello", self.user2)
+        self.assertEqual(self.author_ids(items), {self.user1, self.user2})
+        self.assertIn(self.user1, readmodels.following_ids(self.user0))
+
+        # a muted user's profile still shows, with an Unmute button
+        html = self.client.get(f"/users/{self.user1}").get_data(as_text=True)
+        self.assertIn("Unmute", html)
+
+        self.client.post(f"/users/unmute/{self.user1}",
+                         headers={"Referer": "/"})
+        self.assertEqual(Mutes.query.count(), 0)
+
+    def test_block_hides_both_ways(self):
+        self.client.post(f"/users/block/{self.user1}",
+                         headers={"Referer": "/"})
+
+        self.assertEqual(Follows.query.filter_by(
+            user_following_id=self.user0,
+            user_being_followed_id=self.user1).count(), 0)
+        self.assertEqual(readmodels.hidden_user_ids(self.user0), {self.user1})
+        self.assertEqual(readmodels.hidden_user_ids(self.user1), {self.user0})
+
+        items, before = readmodels.tag_timeline("hello", self.user0)
+        self.assertEqual(self.author_ids(items), {self.user2})
+        self.assertNotIn(
+            self.user0,
+            {card.id for card in readmodels.user_cards("user", self.user1)})
+
+        relation = readmodels.relation(self.user0, self.user1)
+        self.assertEqual((relation.muted, relation.blocked,
+                          relation.blocked_by), (False, True, False))
+
+    def test_blocked_profile_404(self):
+        blocks.block(self.user1, self.user0)
+
+        self.assertEqual(self.client.get(f"/users/{self.user1}").status_code,
+                         404)
+        self.assertEqual(
+            self.client.get(f"/users/{self.user1}/likes").status_code, 404)
+
+        # but the user who blocked sees the profile, with an Unblock button
+        self.login(self.user1)
+        html = self.client.get(f"/users/{self.user0}").get_data(as_text=True)
+        self.assertIn("Unblock", html)
+
+    def test_blocked_cant_follow_or_like(self):
+        blocks.block(self.user1, self.user0)
+
+        resp = self.client.post(f"/users/follow/{self.user1}",
+                                headers={"Referer": "/"},
+                                follow_redirects=True)
+        self.assertIn("You can&#39;t follow this user.",
+                      resp.get_data(as_text=True))
+        self.assertEqual(Follows.query.filter_by(
+            user_following_id=self.user0,
+            user_being_followed_id=self.user1).count(), 0)
+
+        resp = self.client.post(
+            f"/messages/{self.message_ids[self.user1]}/like",
+            headers={"Referer": "/"})
+        self.assertEqual(resp.status_code, 404)
+
+        results = follows.follow_many(self.user0, [self.user1, "user2"])
+        self.assertEqual([result['status'] for result in results],
+                         ['blocked', 'already_following'])
+
+    def test_unblock(self):
+        self.client.post(f"/users/block/{self.user1}",
+                         headers={"Referer": "/"})
+        self.client.post(f"/users/unblock/{self.user1}",
+                         headers={"Referer": "/"})
+
+        self.assertEqual(Blocks.query.count(), 0)
+        self.assertFalse(blocks.between(self.user0, self.user1))
+
+    def test_exclusion_set(self):
+        """Shards have no mutes or blocks to anti-join; there the hidden
+        ids are excluded as a set."""
+
+        blocks.mute(self.user0, self.user1)
+        hidden = readmodels._Hidden(self.user0)
+
+        rows = (db.session
+                .query(Message.user_id)
+                .filter(hidden.excluding(None, Message.user_id)))
+        self.assertEqual({user_id for (user_id,) in rows}, {self.user2})
+
+    def test_purge(self):
+        blocks.mute(self.user0, self.user1)
+        blocks.block(self.user2, self.user0)
+
+        purge.purge_user(self.user0)
+
+        self.assertEqual(Mutes.query.count(), 0)
+        self.assertEqual(Blocks.query.count(), 0)
@@ -0,0 +1,163 @@
+"""Response compression and JSON serialization tests."""
+
+import gzip
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+from flask import json
+from app import app, CURR_USER_KEY
+from compression import compress_static_files
+from dtos import MessageDTO, UserDTO
+from models import User, Message, db
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class CompressionTestCase(TestCase):
+    """Tests compressed responses."""
+
+    def setUp(self):
+        """Adds a user with a message."""
+
+        db.drop_all()
+        db.create_all()
+
+        user1 = User.signup("user1", "user1@user1.com", "password", None)
+        db.session.commit()
+        msg = Message(text="hello", user_id=user1.id,
+                      timestamp=datetime(2021, 3, 1, 12, 30))
+        db.session.add(msg)
+        db.session.commit()
+
+        self.user1_id = user1.id
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        """Rollback the data."""
+
+        db.session.rollback()
+
+    def test_html_gzipped_when_accepted(self):
+        """ large HTML responses are gzipped for clients accepting it """
+
+        with app.test_client() as client:
+            resp = client.get("/signup", headers={"Accept-Encoding": "gzip"})
+
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+            html = gzip.decompress(resp.data).decode()
+            self.assertIn("<!-- Signup View Function Test Comment -->", html)
+
+    def test_logged_in_html_not_compressed(self):
+        """ pages holding a logged-in user's CSRF token are sent as is """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            resp = client.get("/users/profile",
+                              headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_not_compressed_without_accept_encoding(self):
+        """ clients that don't accept gzip get plain responses """
+
+        with app.test_client() as client:
+            resp = client.get("/signup")
+
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_small_responses_not_compressed(self):
+        """ responses under the size threshold are sent as is """
+
+        with app.test_client() as client:
+            resp = client.get(f"/api/users/{self.user1_id}",
+                              headers={"Accept-Encoding": "gzip"})
+
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_api_serializes_dtos_compactly(self):
+        """ API responses are compact JSON built from DTOs """
+
+        with app.test_client() as client:
+            resp = client.get(f"/api/messages/{self.msg_id}")
+            body = resp.get_data(as_text=True).strip()
+
+            self.assertNotIn(", ", body)
+            self.assertNotIn("\n", body)
+            self.assertEqual(resp.get_json()["message"], {
+                "id": str(self.msg_id),
+                "text": "hello",
+                "timestamp": "2021-03-01T12:30:00",
+                "user_id": self.user1_id,
+            })
+            self.assertEqual(resp.get_json()["user"]["username"], "user1")
+
+    def test_dto_from_model(self):
+        """ DTOs copy their fields and are independent of the session """
+
+        user = User.query.get(self.user1_id)
+        dto = UserDTO.from_model(user)
+        db.session.expunge_all()
+
+        self.assertEqual(dto.username, "user1")
+        self.assertFalse(hasattr(dto, "__dict__"))
+        with app.app_context():
+            encoded = json.dumps(MessageDTO(1, "hi"))
+        self.assertEqual(json.loads(encoded)["text"], "hi")
+
+
+class StaticCompressionTestCase(TestCase):
+    """Tests precompressed static files."""
+
+    def setUp(self):
+        """Points the app at a copy of the static folder."""
+
+        self.folder = tempfile.mkdtemp()
+        shutil.copytree(app.static_folder, self.folder, dirs_exist_ok=True)
+        self.original_folder = app.static_folder
+        app.static_folder = self.folder
+
+    def tearDown(self):
+        app.static_folder = self.original_folder
+        shutil.rmtree(self.folder)
+
+    def test_precompressed_static_served(self):
+        """ static files are served from their precompressed copies """
+
+        written = compress_static_files(self.folder)
+        self.assertIn(os.path.join(self.folder, "script.js.gz"), written)
+
+        with app.test_client() as client:
+            resp = client.get("/static/script.js",
+                              headers={"Accept-Encoding": "gzip"})
+
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("javascript", resp.mimetype)
+            with open(os.path.join(self.folder, "script.js"), 'rb') as f:
+                self.assertEqual(gzip.decompress(resp.data), f.read())
+            resp.close()
+
+    def test_uncompressed_static_fallback(self):
+        """ static files without copies are served as usual """
+
+        with app.test_client() as client:
+            resp = client.get("/static/script.js",
+                              headers={"Accept-Encoding": "gzip"})
+
+            self.assertNotIn("Content-Encoding", resp.headers)
+            resp.close()
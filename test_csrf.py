@@ -0,0 +1,109 @@
+"""CSRF protection tests."""
+
+import re
+from unittest import TestCase
+from app import app, CURR_USER_KEY
+from models import User, Message, Like, Follows, db
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work; CSRFTestCase turns it back on
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+TOKEN_META = re.compile(r'<meta name="csrf-token" content="([^"]+)"')
+
+
+class CSRFTestCase(TestCase):
+    """Tests that state-changing requests need the page's CSRF token."""
+
+    def setUp(self):
+        """Adds two users, user1 with two messages, and logs in user0."""
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User.signup(f"user{i}", f"user{i}@user{i}.com",
+                             "password", None)
+                 for i in range(2)]
+        db.session.commit()
+        self.user0, self.user1 = [user.id for user in users]
+
+        db.session.add(Follows(user_following_id=self.user0,
+                               user_being_followed_id=self.user1))
+        messages = [Message(text=f"Message {i}", user_id=self.user1)
+                    for i in range(2)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.message_id = messages[0].id
+
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user0
+
+    def tearDown(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        db.session.rollback()
+
+    def page_token(self):
+        html = self.client.get("/").get_data(as_text=True)
+        return TOKEN_META.search(html).group(1)
+
+    def test_one_token_per_page(self):
+        html = self.client.get("/").get_data(as_text=True)
+
+        self.assertEqual(len(TOKEN_META.findall(html)), 1)
+        self.assertEqual(html.count("Message "), 2)
+        # only the logout form carries it; like buttons send the meta tag's
+        self.assertEqual(html.count('name="csrf_token"'), 1)
+
+    def test_like_needs_header(self):
+        resp = self.client.post(f"/messages/{self.message_id}/like",
+                                headers={"Referer": "/"})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(Like.query.count(), 0)
+
+        resp = self.client.post(f"/messages/{self.message_id}/like",
+                                headers={"Referer": "/",
+                                         "X-CSRFToken": self.page_token()})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Like.query.count(), 1)
+
+    def test_follow_needs_token(self):
+        resp = self.client.post(f"/users/stop-following/{self.user1}")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(Follows.query.count(), 1)
+
+        resp = self.client.post(f"/users/stop-following/{self.user1}",
+                                data={"csrf_token": self.page_token()})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Follows.query.count(), 0)
+
+    def test_logout_needs_token(self):
+        resp = self.client.post("/logout")
+        self.assertEqual(resp.status_code, 400)
+        with self.client.session_transaction() as sess:
+            self.assertEqual(sess[CURR_USER_KEY], self.user0)
+
+        self.client.post("/logout", data={"csrf_token": self.page_token()})
+        with self.client.session_transaction() as sess:
+            self.assertNotIn(CURR_USER_KEY, sess)
+
+    def test_delete_user_needs_token(self):
+        resp = self.client.post("/users/delete")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIsNone(User.query.get(self.user0).deleted_at)
+
+        resp = self.client.post("/users/delete",
+                                data={"csrf_token": self.page_token()})
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNotNone(User.query.get(self.user0).deleted_at)
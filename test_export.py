@@ -0,0 +1,157 @@
+"""Data export tests."""
+
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from sqlalchemy import event
+from app import app
+from models import User, Message, Like, Follows, db
+import export
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class ExportTestCase(TestCase):
+    """Tests exporting users' messages, likes and follows."""
+
+    def setUp(self):
+        """Adds three users; user0 and user1 follow each other, user0
+        posts twice and likes user1's message."""
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User.signup(f"user{i}", f"user{i}@user{i}.com",
+                             "password", None)
+                 for i in range(3)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+        user0, user1, user2 = self.ids
+
+        db.session.add_all([
+            Message(text="first, with a comma", user_id=user0),
+            Message(text="second", user_id=user0),
+            Message(text="theirs", user_id=user1),
+        ])
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_following_id=user0, user_being_followed_id=user1),
+            Follows(user_following_id=user1, user_being_followed_id=user0),
+        ])
+        db.session.commit()
+
+        self.liked = Message.query.filter_by(user_id=user1).one().id
+        db.session.add(Like(message_id=self.liked, user_id=user0))
+        db.session.commit()
+
+        self.directory = tempfile.mkdtemp()
+
+        # export_all hands the current app to its worker processes
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        db.session.rollback()
+        shutil.rmtree(self.directory)
+
+    def read(self, user_id, section, fmt='csv'):
+        path = os.path.join(self.directory, str(user_id),
+                            f"{section}.{fmt}.gz")
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as file:
+            if fmt == 'csv':
+                return list(csv.reader(file))
+            return [json.loads(line) for line in file]
+
+    def test_export_user_csv(self):
+        user0, user1, user2 = self.ids
+
+        counts = export.export_user(user0, self.directory)
+
+        self.assertEqual(counts, {'messages': 2, 'likes': 1,
+                                  'following': 1, 'followers': 1})
+
+        messages = self.read(user0, 'messages')
+        self.assertEqual(messages[0], ['id', 'timestamp', 'text'])
+        self.assertEqual([row[2] for row in messages[1:]],
+                         ["first, with a comma", "second"])
+
+        self.assertEqual(self.read(user0, 'likes')[1][:2],
+                         [str(self.liked), str(user1)])
+        self.assertEqual(self.read(user0, 'following')[1:],
+                         [[str(user1), "user1"]])
+        self.assertEqual(self.read(user0, 'followers')[1:],
+                         [[str(user1), "user1"]])
+        self.assertEqual(
+            [name for name in os.listdir(os.path.join(self.directory,
+                                                      str(user0)))
+             if name.endswith('.part')],
+            [])
+
+    def test_export_user_ndjson(self):
+        user0 = self.ids[0]
+
+        export.export_user(user0, self.directory, 'ndjson')
+
+        messages = self.read(user0, 'messages', 'ndjson')
+        self.assertEqual([msg['text'] for msg in messages],
+                         ["first, with a comma", "second"])
+        self.assertEqual(set(messages[0]), {'id', 'timestamp', 'text'})
+
+    def test_rows_are_streamed(self):
+        options = []
+
+        def record(conn, cursor, statement, parameters, context, many):
+            if statement.lstrip().upper().startswith('SELECT'):
+                options.append(context.execution_options.get('stream_results'))
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            export.export_user(self.ids[0], self.directory)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(len(options), 6)
+        self.assertTrue(all(options))
+
+    def test_export_all_in_processes(self):
+        User.query.get(self.ids[2]).deleted_at = db.func.now()
+        db.session.commit()
+
+        exported = dict(export.export_all(self.directory, processes=2))
+
+        self.assertEqual(sorted(exported), self.ids[:2])
+        self.assertEqual(exported[self.ids[1]]['messages'], 1)
+        self.assertEqual(len(self.read(self.ids[1], 'messages')), 2)
+
+    def test_commands(self):
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=["export", "user", "user1",
+                                     self.directory, "--format", "ndjson"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("1 messages", result.output)
+
+        result = runner.invoke(args=["export", "user", "nobody",
+                                     self.directory])
+        self.assertNotEqual(result.exit_code, 0)
+
+        result = runner.invoke(args=["export", "all", self.directory,
+                                     "-p", "1"])
+        self.assertIn("Exported 3 users.", result.output)
@@ -0,0 +1,155 @@
+"""Bulk follow tests."""
+
+from unittest import TestCase
+from sqlalchemy import event
+from app import app, CURR_USER_KEY
+from models import User, Follows, db
+import follows
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class BulkFollowTestCase(TestCase):
+    """Tests following and unfollowing many users at once."""
+
+    def setUp(self):
+        """Adds four users; user0 already follows user1."""
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User.signup(f"user{i}", f"user{i}@user{i}.com",
+                             "password", None)
+                 for i in range(4)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+
+        db.session.add(Follows(user_following_id=self.ids[0],
+                               user_being_followed_id=self.ids[1]))
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[0]
+
+    def followed(self):
+        return sorted(id for (id,) in (
+            db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == self.ids[0])))
+
+    def test_follow_many(self):
+        user0, user1, user2, user3 = self.ids
+
+        results = follows.follow_many(
+            user0, [user1, "user2", user3, "nobody", user0, "user3"])
+
+        self.assertEqual([(r['user_id'], r['status']) for r in results], [
+            (user1, 'already_following'),
+            (user2, 'followed'),
+            (user3, 'followed'),
+            (None, 'not_found'),
+            (user0, 'self'),
+            (user3, 'duplicate'),
+        ])
+        self.assertEqual(self.followed(), [user1, user2, user3])
+
+    def test_one_resolve_query_and_one_insert(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            # notifying the followed users is tested in test_notifications
+            if 'notification' not in statement:
+                statements.append(statement.split()[0].upper())
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            follows.follow_many(self.ids[0], ["user2", self.ids[3]])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(statements.count('INSERT'), 1)
+        self.assertEqual(statements.count('SELECT'), 2)
+
+    def test_unfollow_many(self):
+        user0, user1, user2, user3 = self.ids
+
+        results = follows.unfollow_many(user0, ["user1", user2])
+
+        self.assertEqual([r['status'] for r in results],
+                         ['unfollowed', 'not_following'])
+        self.assertEqual(self.followed(), [])
+
+    def test_deleted_users_not_found(self):
+        User.query.get(self.ids[2]).deleted_at = db.func.now()
+        db.session.commit()
+
+        results = follows.follow_many(self.ids[0], ["user2"])
+        self.assertEqual(results[0]['status'], 'not_found')
+
+    def test_batch_cap(self):
+        with self.assertRaises(follows.BatchTooLarge):
+            follows.follow_many(self.ids[0],
+                                list(range(follows.MAX_BATCH + 1)))
+
+        resp = self.client.post(
+            "/api/following",
+            json={"users": list(range(follows.MAX_BATCH + 1))})
+        self.assertEqual(resp.status_code, 413)
+
+    def test_api(self):
+        user0, user1, user2, user3 = self.ids
+
+        resp = self.client.post("/api/following",
+                                json={"users": ["user2", user3]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([r['status'] for r in resp.json['results']],
+                         ['followed', 'followed'])
+        self.assertEqual(self.followed(), [user1, user2, user3])
+
+        resp = self.client.delete("/api/following",
+                                  json={"users": [user1, "user2"]})
+        self.assertEqual([r['status'] for r in resp.json['results']],
+                         ['unfollowed', 'unfollowed'])
+        self.assertEqual(self.followed(), [user3])
+
+    def test_api_rejects_bad_input(self):
+        for body in ({"users": "user2"}, {"users": [True]}, ["user2"], {}):
+            resp = self.client.post("/api/following", json=body)
+            self.assertEqual(resp.status_code, 400)
+
+        # form posts are not accepted
+        resp = self.client.post("/api/following", data={"users": "user2"})
+        self.assertEqual(resp.status_code, 400)
+
+        anon = app.test_client()
+        resp = anon.post("/api/following", json={"users": ["user2"]})
+        self.assertEqual(resp.status_code, 401)
+
+    def test_import_command(self):
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=["follows", "import", "user0", "-"],
+                               input=f"@user2\n{self.ids[3]}\n\nghost\n")
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Not found: ghost", result.output)
+        self.assertIn("2 followed", result.output)
+        self.assertEqual(self.followed(), self.ids[1:])
+
+        result = runner.invoke(args=["follows", "import", "--unfollow",
+                                     "user0", "-"],
+                               input="user1\nuser2\n")
+        self.assertIn("2 unfollowed", result.output)
+        self.assertEqual(self.followed(), [self.ids[3]])
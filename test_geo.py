@@ -0,0 +1,193 @@
+"""Geocoding and nearby-user tests."""
+
+from datetime import datetime
+from unittest import TestCase
+from app import app, CURR_USER_KEY
+from models import User, GeocodedPlace, db
+import blocks
+import geo
+import jobs
+import readmodels
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+LOCATIONS = ["San Francisco, CA", "oakland, california", "Berkeley",
+             "Palo Alto, CA 94301", "Los Angeles, USA", "Gotham City", None]
+
+
+class GeoTestCase(TestCase):
+    """Tests geocoding users' locations and finding users near them."""
+
+    def setUp(self):
+        """Adds a user for each of LOCATIONS."""
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User.signup(f"user{i}", f"user{i}@user{i}.com",
+                             "password", None)
+                 for i in range(len(LOCATIONS))]
+        for user, location in zip(users, LOCATIONS):
+            user.location = location
+        db.session.commit()
+        self.ids = [user.id for user in users]
+
+        self.context = app.app_context()
+        self.context.push()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.context.pop()
+        db.session.rollback()
+
+    def geocode_all(self):
+        geo.queue_backfill(batch_size=3)
+        jobs.work(burst=True)
+
+    def test_normalize_place(self):
+        self.assertEqual(geo.normalize_place("  São Paulo,  SP 01000 "),
+                         "sao paulo, sp")
+        self.assertEqual(geo.normalize_place("St. Louis, U.S.A."),
+                         "st louis, us")
+        self.assertIsNone(geo.normalize_place(" , 12345"))
+
+    def test_gazetteer(self):
+        places = geo.gazetteer()
+
+        self.assertEqual(places["portland, me"], (43.6591, -70.2568))
+        # a name alone is the most populous place of that name
+        self.assertEqual(places["portland"], places["portland, oregon, us"])
+        self.assertNotIn("paris, texas", places)
+
+    def test_geohash(self):
+        self.assertEqual(geo.encode_geohash(42.605, -5.603, 5), "ezs42")
+        self.assertEqual(geo.encode_geohash(37.7749, -122.4194), "9q8yyk8yt")
+
+    def test_cells_cover_radius(self):
+        cells = geo.cells_covering(37.7749, -122.4194, 50)
+
+        self.assertLessEqual(len(cells), 4)
+        for lat, lon in [(37.8044, -122.2712), (37.4419, -122.1430),
+                         (38.2, -122.4194), (37.7749, -121.9)]:
+            self.assertTrue(
+                any(geo.encode_geohash(lat, lon).startswith(cell)
+                    for cell in cells),
+                (lat, lon))
+
+        # across the antimeridian
+        cells = geo.cells_covering(0, 179.9, 50)
+        self.assertTrue(any(geo.encode_geohash(0, -179.9).startswith(cell)
+                            for cell in cells))
+
+    def test_backfill(self):
+        self.assertEqual(geo.queue_backfill(batch_size=3), 3)
+        self.assertEqual(jobs.work(burst=True), 3)
+
+        users = {user.id: user for user in User.query}
+        sf = users[self.ids[0]]
+        self.assertEqual((sf.latitude, sf.longitude), (37.7749, -122.4194))
+        self.assertEqual(sf.geohash, "9q8yyk8yt")
+        self.assertIsNotNone(users[self.ids[4]].geohash)
+        self.assertIsNone(users[self.ids[5]].geohash)
+        self.assertIsNone(users[self.ids[6]].geohash)
+
+        # unknown places are cached too
+        self.assertEqual(
+            GeocodedPlace.query.filter_by(place="gotham city").one().latitude,
+            None)
+
+    def test_cache(self):
+        geo.geocode(["berkeley"])
+        db.session.commit()
+
+        GeocodedPlace.query.filter_by(place="berkeley").update(
+            {GeocodedPlace.latitude: 0.0})
+        self.assertEqual(geo.geocode(["berkeley"]),
+                         {"berkeley": (0.0, -122.2730)})
+
+    def test_nearby(self):
+        self.geocode_all()
+        blocks.block(self.ids[3], self.ids[0])
+
+        user = User.query.get(self.ids[0])
+        cards = readmodels.nearby_cards(user.id, user.latitude,
+                                        user.longitude, 50)
+
+        # Oakland, then Berkeley; Palo Alto blocked, LA too far
+        self.assertEqual([card.id for card in cards], self.ids[1:3])
+        self.assertLess(cards[0].distance_km, cards[1].distance_km)
+
+        cards = readmodels.nearby_cards(user.id, user.latitude,
+                                        user.longitude, 1000)
+        self.assertIn(self.ids[4], [card.id for card in cards])
+
+    def test_nearest_limited_in_sql(self):
+        self.geocode_all()
+
+        user = User.query.get(self.ids[0])
+        cards = readmodels.nearby_cards(user.id, user.latitude,
+                                        user.longitude, 1000, limit=1)
+        self.assertEqual([card.id for card in cards], [self.ids[1]])
+
+    def test_bounding_box(self):
+        self.assertEqual(geo.bounding_box(0, 0, 0), (0, 0, 0, 0))
+
+        south, north, west, east = geo.bounding_box(0, 179.9, 50)
+        self.assertGreater(west, east)
+        self.assertEqual(geo.bounding_box(89.9, 0, 50)[2:], (None, None))
+
+    def test_unknown_places_looked_up_again(self):
+        now = datetime.utcnow()
+        berkeley = {"berkeley": (37.8715, -122.2730)}
+        self.assertEqual(geo.geocode(["berkeley"],
+                                     now - 2 * geo.UNKNOWN_PLACE_TTL),
+                         berkeley)
+        GeocodedPlace.query.filter_by(place="berkeley").update(
+            {GeocodedPlace.latitude: None, GeocodedPlace.longitude: None})
+
+        # not known, until that has expired
+        self.assertEqual(geo.geocode(["berkeley"],
+                                     now - geo.UNKNOWN_PLACE_TTL * 1.5),
+                         {"berkeley": None})
+        self.assertEqual(geo.geocode(["berkeley"], now), berkeley)
+        self.assertIsNotNone(GeocodedPlace.query.one().latitude)
+
+    def test_nearby_page(self):
+        self.geocode_all()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[0]
+        html = self.client.get("/users/nearby?radius=50").get_data(
+            as_text=True)
+        self.assertIn("@user1", html)
+        self.assertIn("13 km away", html)
+        self.assertNotIn("@user4", html)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[5]
+        html = self.client.get("/users/nearby").get_data(as_text=True)
+        self.assertIn("know where you are yet", html)
+
+    def test_profile_update_geocodes(self):
+        self.geocode_all()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[5]
+        self.client.post("/users/profile", data={
+            "username": "user5", "email": "user5@user5.com",
+            "password": "password", "location": "Tokyo, Japan"})
+
+        self.assertIsNone(User.query.get(self.ids[5]).geohash)
+        self.assertEqual(jobs.work(burst=True), 1)
+        self.assertTrue(User.query.get(self.ids[5]).geohash.startswith("xn"))
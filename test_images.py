@@ -0,0 +1,297 @@
+"""Resized profile image tests."""
+
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase, mock
+from PIL import Image
+from app import app
+from images import (process_user_images, check_url, fetch, resize,
+                    ImageRejected, URL_PREFIX)
+from jobs import work
+from models import User, CachedImage, Job, db
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+def png(width, height, color):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(out, 'PNG')
+    return out.getvalue()
+
+
+class ImageServer(BaseHTTPRequestHandler):
+    """Stands in for the external hosts users' images live on."""
+
+    files = {
+        '/face.png': png(600, 400, 'red'),
+        '/other.png': png(300, 300, 'blue'),
+        '/banner.png': png(2000, 500, 'green'),
+        '/notes.txt': b"not an image",
+    }
+    redirects = {
+        '/moved.png': '/face.png',
+        '/metadata.png': 'http://169.254.169.254/latest/meta-data/',
+    }
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+
+        if self.path in self.redirects:
+            self.send_response(302)
+            self.send_header('Location', self.redirects[self.path])
+            self.end_headers()
+            return
+
+        body = self.files.get(self.path)
+
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImagesTestCase(TestCase):
+    """Tests fetching, resizing and serving profile images."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), ImageServer)
+        cls.base = f"http://127.0.0.1:{cls.server.server_port}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        """Adds a user with external images."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.cache_dir = tempfile.mkdtemp()
+        app.config['IMAGE_CACHE_DIR'] = self.cache_dir
+        # the test server
+        app.config['IMAGE_FETCH_ALLOWED_HOSTS'] = ['127.0.0.1']
+
+        # jobs run under `flask jobs work`, inside an app context
+        self.context = app.app_context()
+        self.context.push()
+        ImageServer.hits.clear()
+
+        user = User.signup("user1", "user1@user1.com", "password",
+                           f"{self.base}/face.png")
+        user.header_image_url = f"{self.base}/banner.png"
+        db.session.commit()
+        self.user_id = user.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+        app.config['IMAGE_CACHE_DIR'] = None
+        app.config['IMAGE_FETCH_ALLOWED_HOSTS'] = ()
+        shutil.rmtree(self.cache_dir)
+
+    def open_image(self, url):
+        filename = url[len(URL_PREFIX):]
+        return Image.open(os.path.join(self.cache_dir, filename))
+
+    def test_process_user_images(self):
+        process_user_images(self.user_id)
+        user = User.query.get(self.user_id)
+
+        self.assertTrue(user.image_thumb_url.startswith(URL_PREFIX))
+        self.assertEqual(user.avatar, user.image_thumb_url)
+        self.assertEqual(user.header, user.header_image_thumb_url)
+        self.assertEqual(self.open_image(user.avatar).size, (256, 256))
+        self.assertEqual(self.open_image(user.header).size, (1280, 400))
+
+    def test_shared_source_fetched_once(self):
+        other = User.signup("user2", "user2@user2.com", "password",
+                            f"{self.base}/face.png")
+        db.session.commit()
+
+        process_user_images(self.user_id)
+        process_user_images(other.id)
+
+        self.assertEqual(ImageServer.hits.count('/face.png'), 1)
+        self.assertEqual(CachedImage.query.count(), 2)
+        self.assertEqual(User.query.get(self.user_id).image_thumb_url,
+                         User.query.get(other.id).image_thumb_url)
+
+    def test_unreadable_image_not_retried(self):
+        user = User.query.get(self.user_id)
+        user.image_url = f"{self.base}/notes.txt"
+        db.session.commit()
+
+        job = Job(name='process_user_images',
+                  payload=f'{{"user_id": {self.user_id}}}')
+        db.session.add(job)
+        db.session.commit()
+        work(burst=True)
+
+        job = Job.query.get(job.id)
+        self.assertEqual((job.status, job.attempts), ('failed', 1))
+        self.assertIn('Not a readable image', job.last_error)
+
+        user = User.query.get(self.user_id)
+        self.assertIsNone(user.image_thumb_url)
+        self.assertEqual(user.avatar, f"{self.base}/notes.txt")
+
+    def test_huge_image_rejected(self):
+        with mock.patch('images.MAX_SOURCE_PIXELS', 1000):
+            with self.assertRaises(ImageRejected):
+                resize(ImageServer.files['/face.png'], 'avatar')
+
+    def test_fetch_connects_to_checked_address(self):
+        """ the host is resolved once, when checked, so it can't resolve
+        somewhere else by the time it is fetched """
+
+        port = self.server.server_port
+        lookups = []
+        real_getaddrinfo = socket.getaddrinfo
+
+        def getaddrinfo(host, *args, **kwargs):
+            if host == "images.example":
+                lookups.append(host)
+                return [(socket.AF_INET, socket.SOCK_STREAM,
+                         socket.IPPROTO_TCP, '', ('127.0.0.1', port))]
+            return real_getaddrinfo(host, *args, **kwargs)
+
+        # images.example passes the check as if it were a public host
+        with mock.patch('socket.getaddrinfo', getaddrinfo), \
+                mock.patch('images._refused', return_value=False):
+            data = fetch(f"http://images.example:{port}/face.png")
+
+        self.assertEqual(data, ImageServer.files['/face.png'])
+        self.assertEqual(lookups, ["images.example"])
+
+    def run_job(self, image_url):
+        """Run the user's image job with `image_url` as their image; the
+        job afterwards."""
+
+        user = User.query.get(self.user_id)
+        user.image_url = image_url
+        db.session.commit()
+
+        job = Job(name='process_user_images',
+                  payload=f'{{"user_id": {self.user_id}}}')
+        db.session.add(job)
+        db.session.commit()
+        work(burst=True)
+
+        return Job.query.get(job.id)
+
+    def test_private_hosts_refused(self):
+        for url in ("http://localhost/face.png",
+                    "http://10.0.0.8/face.png",
+                    "http://169.254.169.254/latest/meta-data/",
+                    "http://[::1]/face.png",
+                    "http://[::ffff:127.0.0.1]/face.png",
+                    "file:///etc/passwd"):
+            with self.subTest(url):
+                with self.assertRaises(ImageRejected):
+                    check_url(url)
+
+        app.config['IMAGE_FETCH_ALLOWED_HOSTS'] = ()
+        job = self.run_job(f"{self.base}/face.png")
+        self.assertEqual((job.status, job.attempts), ('failed', 1))
+        self.assertIn('Not a public host', job.last_error)
+        self.assertEqual(ImageServer.hits, [])
+
+    def test_redirects_checked(self):
+        job = self.run_job(f"{self.base}/metadata.png")
+        self.assertEqual((job.status, job.attempts), ('failed', 1))
+        self.assertIn('169.254.169.254', job.last_error)
+
+        job = self.run_job(f"{self.base}/moved.png")
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(ImageServer.hits,
+                         ['/metadata.png', '/moved.png', '/face.png',
+                          '/banner.png'])
+
+    def test_missing_image_not_retried(self):
+        job = self.run_job(f"{self.base}/missing.png")
+
+        self.assertEqual((job.status, job.attempts), ('failed', 1))
+        self.assertIn('404', job.last_error)
+
+    def test_serve_image(self):
+        process_user_images(self.user_id)
+        url = User.query.get(self.user_id).image_thumb_url
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+        self.assertNotIn('no-store', resp.headers['Cache-Control'])
+
+        self.assertEqual(self.client.get('/images/missing.jpg').status_code,
+                         404)
+
+    def test_timeline_uses_resized_image(self):
+        process_user_images(self.user_id)
+
+        with self.client.session_transaction() as sess:
+            sess['curr_user'] = self.user_id
+
+        resp = self.client.get('/users')
+        html = resp.get_data(as_text=True)
+        self.assertIn(URL_PREFIX, html)
+        self.assertNotIn(f"{self.base}/face.png", html)
+
+    def test_profile_change_refetches(self):
+        process_user_images(self.user_id)
+        old_thumb = User.query.get(self.user_id).image_thumb_url
+
+        with self.client.session_transaction() as sess:
+            sess['curr_user'] = self.user_id
+
+        resp = self.client.post('/users/profile', data={
+            'username': 'user1',
+            'email': 'user1@user1.com',
+            'image_url': f"{self.base}/other.png",
+            'header_image_url': f"{self.base}/banner.png",
+            'password': 'password',
+        })
+        self.assertEqual(resp.status_code, 302)
+
+        user = User.query.get(self.user_id)
+        self.assertIsNone(user.image_thumb_url)
+        self.assertEqual(user.avatar, f"{self.base}/other.png")
+
+        work(burst=True)
+
+        user = User.query.get(self.user_id)
+        self.assertNotEqual(user.image_thumb_url, old_thumb)
+        self.assertEqual(self.open_image(user.avatar).getpixel((0, 0)),
+                         (0, 0, 254))
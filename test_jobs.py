@@ -0,0 +1,174 @@
+"""Background job queue tests."""
+
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+from app import app
+from models import Job, db
+import jobs
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+calls = []
+
+
+@jobs.job('test_record')
+def record(value):
+    calls.append(value)
+
+
+@jobs.job('test_flaky', max_attempts=2)
+def flaky():
+    raise RuntimeError("boom")
+
+
+@jobs.job('test_limited', concurrency=1)
+def limited():
+    calls.append('limited')
+
+
+@jobs.job('test_slow')
+def slow():
+    # outlive the (patched) visibility timeout, then see whether another
+    # worker would take this job for lost
+    time.sleep(1)
+    calls.append(jobs.claim(['default'], 'w2'))
+
+
+class JobQueueTestCase(TestCase):
+    """Tests enqueueing, running, retrying and deduplicating jobs."""
+
+    def setUp(self):
+        """Recreates tables."""
+
+        db.drop_all()
+        db.create_all()
+        calls.clear()
+
+    def tearDown(self):
+        """Rollback the data."""
+
+        db.session.rollback()
+
+    def test_enqueue_and_work(self):
+        """ queued jobs run with their payload and are marked done """
+
+        jobs.enqueue('test_record', value=1)
+        jobs.enqueue('test_record', value=2)
+        db.session.commit()
+
+        self.assertEqual(jobs.work(burst=True), 2)
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(Job.query.filter_by(status='done').count(), 2)
+
+    def test_dedup_key(self):
+        """ an unfinished job with the same key is reused, a finished one
+        is not """
+
+        first = jobs.enqueue('test_record', dedup_key='k', value=1)
+        second = jobs.enqueue('test_record', dedup_key='k', value=2)
+        db.session.commit()
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(Job.query.count(), 1)
+
+        jobs.work(burst=True)
+        jobs.enqueue('test_record', dedup_key='k', value=3)
+        db.session.commit()
+
+        self.assertEqual(Job.query.count(), 2)
+
+    def test_retry_then_fail(self):
+        """ a failing job is retried later, then marked failed """
+
+        failing = jobs.enqueue('test_flaky')
+        db.session.commit()
+
+        jobs.work(burst=True)
+        self.assertEqual(failing.status, 'queued')
+        self.assertEqual(failing.attempts, 1)
+        self.assertIn("boom", failing.last_error)
+        self.assertGreater(failing.run_at, datetime.utcnow())
+
+        failing.run_at = datetime.utcnow()
+        db.session.commit()
+
+        jobs.work(burst=True)
+        self.assertEqual(failing.status, 'failed')
+        self.assertEqual(failing.attempts, 2)
+
+    def test_concurrency_limit(self):
+        """ a job at its concurrency limit is not claimed """
+
+        running = jobs.enqueue('test_limited')
+        jobs.enqueue('test_limited')
+        db.session.commit()
+
+        self.assertEqual(jobs.claim(['default'], 'w1').id, running.id)
+        self.assertIsNone(jobs.claim(['default'], 'w2'))
+
+        # other jobs behind it are still claimed
+        other = jobs.enqueue('test_record', value=1)
+        db.session.commit()
+        self.assertEqual(jobs.claim(['default'], 'w2').id, other.id)
+
+    def test_lost_job_requeued(self):
+        """ a job whose worker died is queued again """
+
+        lost = jobs.enqueue('test_record', value=1)
+        db.session.commit()
+        jobs.claim(['default'], 'w1')
+
+        lost.locked_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+
+        self.assertEqual(jobs.work(burst=True), 1)
+        self.assertEqual(calls, [1])
+
+    @mock.patch('jobs.HEARTBEAT_INTERVAL', timedelta(seconds=0.1))
+    @mock.patch('jobs.VISIBILITY_TIMEOUT', timedelta(seconds=0.5))
+    def test_long_job_not_lost(self):
+        """ a job running past the visibility timeout keeps its lock """
+
+        jobs.enqueue('test_slow')
+        db.session.commit()
+
+        self.assertEqual(jobs.work(burst=True), 1)
+        self.assertEqual(calls, [None])
+        self.assertEqual(Job.query.one().attempts, 1)
+
+    def test_lost_job_fails_after_last_attempt(self):
+        """ a lost job that has used up its attempts fails """
+
+        lost = jobs.enqueue('test_flaky')
+        db.session.commit()
+        jobs.claim(['default'], 'w1')
+        lost.attempts = lost.max_attempts
+        lost.locked_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+
+        self.assertEqual(jobs.work(burst=True), 0)
+        self.assertEqual(lost.status, 'failed')
+        self.assertIn("lost", lost.last_error)
+
+    def test_queue_stats(self):
+        """ stats count jobs by queue and status """
+
+        jobs.enqueue('test_record', value=1)
+        jobs.enqueue('test_record', value=2)
+        db.session.commit()
+
+        stats = jobs.queue_stats()
+        self.assertEqual(stats['default']['queued'], 2)
+        self.assertIn('oldest_queued_seconds', stats['default'])
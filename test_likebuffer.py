@@ -0,0 +1,300 @@
+"""Write-behind like buffer tests."""
+
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from app import app, CURR_USER_KEY
+from models import User, Message, Like, Notification, TrendingScore, db
+from likebuffer import like_buffer, MemoryStore
+from pagecache import page_cache
+import readmodels
+import snowflake
+import trending
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# tests flush by hand
+app.config['LIKES_FLUSH_INTERVAL_MS'] = 0
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+def crash(store):
+    """Stop using `store` as if its process had died."""
+
+    store._journal.close()
+    store._lock_file.close()
+
+
+class LikeBufferTestCase(TestCase):
+    """Tests buffering likes, flushing them, and recovering after
+    crashes."""
+
+    def setUp(self):
+        """Adds four users; user0 posts a message. Turns write-behind on,
+        journaling to a scratch directory."""
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User.signup(f"user{i}", f"user{i}@user{i}.com",
+                             "password", None)
+                 for i in range(4)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+
+        msg = Message(id=snowflake.next_id(), text="Viral",
+                      user_id=self.ids[0])
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+
+        self.journal_dir = tempfile.mkdtemp()
+        self.store = MemoryStore(self.journal_dir)
+        like_buffer.configure(self.store)
+
+        self.context = app.app_context()
+        self.context.push()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        like_buffer.configure(None)
+        shutil.rmtree(self.journal_dir)
+        self.context.pop()
+        db.session.rollback()
+
+    def like(self, user_id, liked=None):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return self.client.post(f"/messages/{self.message_id}/like",
+                                headers={"Referer": "/"},
+                                json=None if liked is None
+                                else {"liked": liked})
+
+    def likers(self):
+        return sorted(user_id for (user_id,) in
+                      db.session.query(Like.user_id)
+                      .filter_by(message_id=self.message_id))
+
+    def score(self):
+        return (TrendingScore
+                .query
+                .filter_by(kind='message', target_id=self.message_id,
+                           window='24h')
+                .one()
+                .score)
+
+    def recover(self):
+        """A new process's store, sharing the journal directory."""
+
+        store = MemoryStore(self.journal_dir)
+        like_buffer.configure(store)
+        return store
+
+    def test_read_your_writes(self):
+        resp = self.like(self.ids[1])
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.likers(), [])
+
+        [item] = readmodels.timeline([self.ids[0]], self.ids[1])
+        self.assertTrue(item.liked)
+        [item] = readmodels.timeline([self.ids[0]], self.ids[2])
+        self.assertFalse(item.liked)
+
+        self.assertEqual(like_buffer.flush(), 1)
+        self.assertEqual(self.likers(), [self.ids[1]])
+        self.assertEqual(self.store.pending_for(self.ids[1]), {})
+
+        # unliking reads the flushed like
+        self.like(self.ids[1])
+        [item] = readmodels.timeline([self.ids[0]], self.ids[1])
+        self.assertFalse(item.liked)
+
+    def test_flush_forgets_cached_profiles(self):
+        """ a liker's cached profile shows the likes once flushed """
+
+        app.config['PAGE_CACHE_ENABLED'] = True
+        page_cache.reset()
+        try:
+            likes = f'<a href="/users/{self.ids[1]}/likes">'
+            html = self.client.get(f"/users/{self.ids[1]}").get_data(
+                as_text=True)
+            self.assertIn(f"{likes}0</a>", html)
+
+            self.like(self.ids[1])
+            like_buffer.flush()
+
+            html = self.client.get(f"/users/{self.ids[1]}").get_data(
+                as_text=True)
+            self.assertIn(f"{likes}1</a>", html)
+        finally:
+            app.config['PAGE_CACHE_ENABLED'] = None
+            page_cache.reset()
+
+    def test_state_sent_not_toggled(self):
+        """ a liked state sent by the client is kept, however often, and
+        whichever process's store recorded the earlier clicks """
+
+        self.like(self.ids[1], liked=True)
+        # another process, which hasn't seen the like yet
+        like_buffer.configure(MemoryStore(tempfile.mkdtemp(
+            dir=self.journal_dir)))
+        self.like(self.ids[1], liked=True)
+        like_buffer.flush()
+        like_buffer.configure(self.store)
+        like_buffer.flush()
+
+        self.assertEqual(self.likers(), [self.ids[1]])
+
+        # written through, too
+        like_buffer.configure(None)
+        self.like(self.ids[1], liked=True)
+        self.assertEqual(self.likers(), [self.ids[1]])
+        self.like(self.ids[1], liked=False)
+        self.assertEqual(self.likers(), [])
+
+    def test_memory_store_refused_for_several_processes(self):
+        app.config.update(LIKES_WRITE_BEHIND=True, WEB_CONCURRENCY=2)
+        try:
+            with self.assertRaises(RuntimeError):
+                like_buffer.init_app(app)
+        finally:
+            app.config.update(LIKES_WRITE_BEHIND=False, WEB_CONCURRENCY=1)
+
+    def test_batched_and_deduplicated(self):
+        for user_id in self.ids[1:]:
+            self.like(user_id)
+        # liked, unliked and liked again: one like
+        self.like(self.ids[1])
+        self.like(self.ids[1])
+
+        self.assertEqual(like_buffer.flush(), 3)
+        self.assertEqual(self.likers(), self.ids[1:])
+
+        notification = Notification.query.one()
+        self.assertEqual(notification.count, 3)
+        self.assertEqual(User.query.get(self.ids[0]).unread_notifications, 1)
+
+        # the same score as three likes written one by one (but for the
+        # time passed since)
+        batched = self.score()
+        TrendingScore.query.delete()
+        msg = Message.query.get(self.message_id)
+        for i in range(3):
+            trending.record_like(msg)
+        self.assertAlmostEqual(self.score(), batched, places=3)
+
+        self.assertEqual(like_buffer.flush(), 0)
+
+    def test_process_crash_before_flush(self):
+        self.like(self.ids[1])
+        self.like(self.ids[2])
+        crash(self.store)
+
+        self.assertEqual(self.recover().take(),
+                         {(self.ids[1], self.message_id): True,
+                          (self.ids[2], self.message_id): True})
+        like_buffer.flush()
+
+        self.assertEqual(self.likers(), self.ids[1:3])
+
+        # the dead process's journal is gone; the new one's is empty
+        base = like_buffer.store._base
+        self.assertEqual(sorted(os.listdir(self.journal_dir)),
+                         [os.path.basename(base) + '.journal',
+                          os.path.basename(base) + '.lock'])
+        self.assertEqual(os.path.getsize(base + '.journal'), 0)
+
+    def test_process_crash_mid_flush(self):
+        self.like(self.ids[1])
+
+        # the flush fails, then the user unlikes, then the process dies
+        with patch('likebuffer.apply', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                like_buffer.flush()
+        self.like(self.ids[1])
+        self.like(self.ids[2])
+        crash(self.store)
+
+        self.recover()
+        like_buffer.flush()
+
+        self.assertEqual(self.likers(), [self.ids[2]])
+
+    def test_process_crash_after_commit(self):
+        self.like(self.ids[1])
+        self.like(self.ids[2])
+
+        # the flush commits, but the process dies before removing the batch
+        with patch.object(MemoryStore, 'done'):
+            like_buffer.flush()
+        crash(self.store)
+        score = self.score()
+
+        self.recover()
+        self.assertEqual(like_buffer.flush(), 2)
+
+        # applied again, it changes nothing
+        self.assertEqual(self.likers(), self.ids[1:3])
+        self.assertEqual(Like.query.count(), 2)
+        self.assertEqual(self.score(), score)
+        self.assertEqual(Notification.query.one().count, 2)
+
+    def test_failed_flush_retried(self):
+        self.like(self.ids[1])
+
+        with patch('likebuffer.apply', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                like_buffer.flush()
+
+        self.like(self.ids[2])
+        self.assertEqual(like_buffer.flush(), 2)
+        self.assertEqual(self.likers(), self.ids[1:3])
+
+    def test_torn_write_ignored(self):
+        self.like(self.ids[1])
+        # the process died writing its next intent
+        self.store._journal.write(f"{self.ids[2]} {self.message_id} 1")
+        crash(self.store)
+
+        self.recover()
+        like_buffer.flush()
+
+        self.assertEqual(self.likers(), [self.ids[1]])
+
+    def test_live_process_not_adopted(self):
+        self.like(self.ids[1])
+
+        other = MemoryStore(self.journal_dir)
+        self.assertEqual(other.take(), {})
+
+        self.assertEqual(like_buffer.flush(), 1)
+        self.assertEqual(self.likers(), [self.ids[1]])
+
+    def test_background_flush(self):
+        app.config['LIKES_FLUSH_INTERVAL_MS'] = 10
+        try:
+            self.like(self.ids[1])
+        finally:
+            app.config['LIKES_FLUSH_INTERVAL_MS'] = 0
+
+        for attempt in range(200):
+            db.session.rollback()
+            if self.likers():
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(self.likers(), [self.ids[1]])
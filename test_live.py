@@ -0,0 +1,167 @@
+"""Live timeline tests."""
+
+import threading
+from unittest import TestCase
+from flask import g
+from app import app, CURR_USER_KEY, timeline_stream
+from live import Broker, broker
+from models import User, Message, db
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class BrokerTestCase(TestCase):
+    """Tests the in-process pub/sub broker."""
+
+    def test_delivers_only_subscribed_authors(self):
+        """ subscribers receive ids posted by their authors only """
+
+        broker = Broker()
+        subscription = broker.subscribe([1, 2])
+
+        broker.publish(1, 10)
+        broker.publish(3, 11)
+        broker.publish(2, 12)
+
+        self.assertEqual(subscription.wait(timeout=0), [10, 12])
+        self.assertEqual(subscription.wait(timeout=0), [])
+
+    def test_closed_subscription_receives_nothing(self):
+        """ closing a subscription stops delivery """
+
+        broker = Broker()
+        with broker.subscribe([1]) as subscription:
+            pass
+
+        broker.publish(1, 10)
+        self.assertEqual(subscription.wait(timeout=0), [])
+
+    def test_wait_wakes_on_publish(self):
+        """ a waiting subscriber is woken by a publish from another thread """
+
+        broker = Broker()
+        subscription = broker.subscribe([1])
+
+        threading.Timer(0.05, broker.publish, args=(1, 10)).start()
+        self.assertEqual(subscription.wait(timeout=5), [10])
+
+
+class LiveTimelineViewTestCase(TestCase):
+    """Tests the stream and long-poll endpoints."""
+
+    def setUp(self):
+        """Adds a user following another, with one message each."""
+
+        db.drop_all()
+        db.create_all()
+
+        user1 = User.signup("user1", "user1@user1.com", "password", None)
+        user2 = User.signup("user2", "user2@user2.com", "password", None)
+        user3 = User.signup("user3", "user3@user3.com", "password", None)
+        user1.following.append(user2)
+        db.session.commit()
+
+        old = Message(text="old news", user_id=user2.id)
+        db.session.add(old)
+        db.session.commit()
+
+        self.user1_id = user1.id
+        self.user2_id = user2.id
+        self.user3_id = user3.id
+        self.cursor = old.id
+
+        fresh = Message(text="fresh warble", user_id=user2.id)
+        db.session.add_all([fresh,
+                            Message(text="not followed", user_id=user3.id)])
+        db.session.commit()
+        self.fresh_id = fresh.id
+
+    def tearDown(self):
+        """Rollback the data."""
+
+        db.session.rollback()
+
+    def test_poll_returns_new_followed_messages(self):
+        """ long-poll returns messages after the cursor from followed users """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            resp = client.get(f"/timeline/poll?after={self.cursor}")
+            data = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(data['messages']), 1)
+            self.assertIn("fresh warble", data['messages'][0]['html'])
+            self.assertEqual(data['cursor'], data['messages'][0]['id'])
+            # exact, where a JavaScript number would round it
+            self.assertEqual(data['cursor'], str(self.fresh_id))
+
+    def test_stream_sends_catch_up_events(self):
+        """ the stream starts with messages posted since the cursor """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            resp = client.get(f"/timeline/stream?after={self.cursor}",
+                              buffered=False)
+            first = next(resp.response).decode()
+            resp.close()
+
+            self.assertEqual(resp.mimetype, "text/event-stream")
+            self.assertTrue(first.startswith("id: "))
+            self.assertIn("fresh warble", first)
+            self.assertNotIn("not followed", first)
+
+    def test_stream_closed_unread_unsubscribes(self):
+        """ a stream closed before its first event leaves no subscription """
+
+        with app.test_request_context(f"/timeline/stream?after={self.cursor}"):
+            g.user = User.query.get(self.user1_id)
+            resp = timeline_stream()
+            self.assertEqual(len(broker._subscriptions), 1)
+            resp.close()
+
+        self.assertEqual(broker._subscriptions, set())
+
+    def test_waiting_limited(self):
+        """ requests beyond LIVE_MAX_WAITING are answered at once and told
+        when to come back """
+
+        app.config['LIVE_MAX_WAITING'] = 0
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user1_id
+
+                data = client.get(
+                    f"/timeline/poll?after={self.fresh_id}").get_json()
+                self.assertEqual(data['messages'], [])
+                self.assertEqual(data['retry_after'], 10)
+
+                resp = client.get(f"/timeline/stream?after={self.cursor}")
+                body = resp.get_data(as_text=True)
+                self.assertIn("fresh warble", body)
+                self.assertTrue(body.endswith("retry: 10000\n\n"))
+        finally:
+            app.config['LIVE_MAX_WAITING'] = 4
+
+    def test_anonymous_is_unauthorized(self):
+        """ logged-out users can't open a live timeline """
+
+        with app.test_client() as client:
+            self.assertEqual(client.get("/timeline/poll").status_code, 401)
+            self.assertEqual(client.get("/timeline/stream").status_code, 401)
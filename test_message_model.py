@@ -1,11 +1,12 @@
-import os
-from unittest import TestCase
+from datetime import datetime, timedelta
 from app import app
+from migrations import repair_message_timestamps
 from models import (User, Follows, Message, Like, db,
                     DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import exc
+from testing import DatabaseTestCase
 
 bcrypt = Bcrypt()
 
@@ -18,30 +19,16 @@ app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 # disable CSRF checking for tests to work
 app.config['WTF_CSRF_ENABLED'] = False
 
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler-test'))
 
 
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(DatabaseTestCase):
     """  Tests Message Model  """
 
     def setUp(self):
-        """ Adds sample users """
+        """ Starts from the seeded users """
 
-        # recreates tables
-        db.drop_all()
-        db.create_all()
-
-        # add user data
-        user1 = User.signup("user1", "user1@user1.com", "password", None)
-        db.session.add(user1)
-        db.session.commit()
-        self.user1 = user1
-
-    def tearDown(self):
-        """Rollback the data."""
-
-        db.session.rollback()
+        super().setUp()
+        self.user1 = User.query.get(self.user_ids["user1"])
 
     def test_message_creation(self):
         """ successfully create new message """
@@ -67,3 +54,55 @@ class MessageModelTestCase(TestCase):
         db.session.rollback()
         self.assertEqual(len(self.user1.messages), 0)
 
+
+    def test_message_timestamps_differ(self):
+        """ each message is stamped when it is created, not at import """
+
+        first = Message(user_id=self.user1.id, text="first")
+        db.session.add(first)
+        db.session.commit()
+
+        second = Message(user_id=self.user1.id, text="second")
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertLess(first.timestamp, second.timestamp)
+        self.assertEqual([m.text for m in self.user1.messages],
+                         ["second", "first"])
+
+    def test_repair_message_timestamps(self):
+        """ messages sharing a timestamp are spread out in id order """
+
+        stamp = datetime(2021, 1, 1)
+        for text in ("a", "b", "c"):
+            db.session.add(Message(user_id=self.user1.id,
+                                   text=text,
+                                   timestamp=stamp))
+        db.session.commit()
+
+        self.assertEqual(repair_message_timestamps(), 2)
+
+        messages = Message.query.order_by(Message.id).all()
+        self.assertEqual(messages[0].timestamp, stamp)
+        self.assertLess(messages[0].timestamp, messages[1].timestamp)
+        self.assertLess(messages[1].timestamp, messages[2].timestamp)
+
+    def test_repair_message_timestamps_pushes_on_later_ones(self):
+        """ spread out messages don't run into the next ones' timestamps """
+
+        stamp = datetime(2021, 1, 1)
+        for text, timestamp in (("a", stamp),
+                                ("b", stamp),
+                                ("c", stamp),
+                                ("d", stamp + timedelta(microseconds=1))):
+            db.session.add(Message(user_id=self.user1.id,
+                                   text=text,
+                                   timestamp=timestamp))
+        db.session.commit()
+
+        self.assertEqual(repair_message_timestamps(), 3)
+
+        messages = Message.query.order_by(Message.id).all()
+        self.assertEqual([message.timestamp for message in messages],
+                         [stamp + timedelta(microseconds=i)
+                          for i in range(4)])
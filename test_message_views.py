@@ -1,7 +1,6 @@
 """Message View tests."""
 
 import os
-from unittest import TestCase
 from app import app, CURR_USER_KEY
 from flask import session
 from models import (User, Follows, Message, Like, db,
@@ -9,6 +8,7 @@ from models import (User, Follows, Message, Like, db,
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import exc
+from testing import DatabaseTestCase
 
 bcrypt = Bcrypt()
 
@@ -21,54 +21,33 @@ app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 # disable CSRF checking for tests to work
 app.config['WTF_CSRF_ENABLED'] = False
 
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler-test'))
-
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
 
 
-USER_IMG_URL = ("https://images.theconversation.com/files/350865/original/file-20200803-24-50u91u.jpg?ixlib=rb-1.1.0&q=45&auto=format&w=1200&h=675.0&fit=crop")
-
-
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
-    def setUp(self):
-        """Create test client, add sample data."""
-
-        # recreates tables
-        db.drop_all()
-        db.create_all()
-
-        # User.query.delete()
-        # Message.query.delete()
-
-        self.client = app.test_client()
-
-        self.testuser = User.signup(username="testuser",
-                                    email="test@test.com",
-                                    password="testuser",
-                                    image_url=None)
+    @classmethod
+    def seed(cls):
+        """Adds a test user to the seeded users."""
 
+        testuser = User.signup(username="testuser",
+                               email="test@test.com",
+                               password="testuser",
+                               image_url=None)
         db.session.commit()
+        cls.testuser_id = testuser.id
 
-        # add user data
-        user1 = User.signup("user1", "user1@user1.com", "password", None)
-        user2 = User.signup("user2", "user2@user2.com",
-                            "password", USER_IMG_URL)
-
-        db.session.add(user1)
-        db.session.add(user2)
-
-        db.session.commit()
+    def setUp(self):
+        """Create test client."""
 
-        self.user1_id = user1.id
-        self.user2_id = user2.id
+        super().setUp()
 
-    def tearDown(self):
-        """Rollback the data."""
+        self.client = app.test_client()
 
-        db.session.rollback()
+        self.testuser = User.query.get(self.testuser_id)
+        self.user1_id = self.user_ids["user1"]
+        self.user2_id = self.user_ids["user2"]
 
     def test_add_message(self):
         """Can use add a message?"""
@@ -0,0 +1,173 @@
+"""Notification tests."""
+
+from datetime import datetime
+from unittest import TestCase
+from app import app, CURR_USER_KEY
+from models import User, Message, Notification, db
+import follows
+import notifications
+import purge
+import snowflake
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class NotificationsTestCase(TestCase):
+    """Tests coalescing likes and follows into notifications."""
+
+    def setUp(self):
+        """Adds four users; user0 posts a message."""
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User.signup(f"user{i}", f"user{i}@user{i}.com",
+                             "password", None)
+                 for i in range(4)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+
+        msg = Message(id=snowflake.next_id(), text="Popular",
+                      user_id=self.ids[0])
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def like(self, user_id):
+        self.login(user_id)
+        self.client.post(f"/messages/{self.message_id}/like",
+                         headers={"Referer": "/"})
+
+    def unread(self, user_id):
+        return User.query.get(user_id).unread_notifications
+
+    def test_likes_coalesce(self):
+        for user_id in self.ids[1:]:
+            self.like(user_id)
+
+        row = Notification.query.one()
+        self.assertEqual((row.recipient_id, row.kind, row.target_id),
+                         (self.ids[0], 'like', self.message_id))
+        self.assertEqual(row.count, 3)
+        self.assertEqual(row.actor_id, self.ids[3])
+        self.assertEqual(self.unread(self.ids[0]), 1)
+
+    def test_liking_again_not_counted(self):
+        """ a user unliking and liking again counts once, and doesn't
+        mark the notification unread again """
+
+        self.like(self.ids[1])
+        self.like(self.ids[2])
+        self.login(self.ids[0])
+        self.client.get("/notifications")
+
+        for i in range(2):
+            self.like(self.ids[2])
+
+        row = Notification.query.one()
+        self.assertEqual(row.count, 2)
+        self.assertFalse(row.unread)
+        self.assertEqual(self.unread(self.ids[0]), 0)
+
+    def test_buckets(self):
+        msg = Message.query.get(self.message_id)
+        with app.test_request_context():
+            notifications.notify_many('like', self.ids[1],
+                                      [(msg.user_id, msg.id)],
+                                      now=datetime(2021, 5, 1, 10, 59))
+            notifications.notify_many('like', self.ids[2],
+                                      [(msg.user_id, msg.id)],
+                                      now=datetime(2021, 5, 1, 11, 0))
+            db.session.commit()
+
+        self.assertEqual(Notification.query.count(), 2)
+        self.assertEqual(self.unread(self.ids[0]), 2)
+
+    def test_own_like_not_notified(self):
+        with app.test_request_context():
+            notifications.notify_like(Message.query.get(self.message_id),
+                                      self.ids[0])
+            db.session.commit()
+
+        self.assertEqual(Notification.query.count(), 0)
+
+    def test_follows(self):
+        self.login(self.ids[1])
+        self.client.post(f"/users/follow/{self.ids[0]}",
+                         headers={"Referer": "/"})
+
+        with app.test_request_context():
+            follows.follow_many(self.ids[2], [self.ids[0], self.ids[1]])
+
+        rows = {row.recipient_id: row for row in Notification.query}
+        self.assertEqual(rows[self.ids[0]].count, 2)
+        self.assertEqual(rows[self.ids[0]].kind, 'follow')
+        self.assertEqual(rows[self.ids[1]].count, 1)
+        self.assertEqual(self.unread(self.ids[0]), 1)
+        self.assertEqual(self.unread(self.ids[1]), 1)
+
+    def test_page_marks_read(self):
+        self.like(self.ids[1])
+        self.like(self.ids[2])
+
+        self.login(self.ids[0])
+        resp = self.client.get("/notifications")
+        html = resp.get_data(as_text=True)
+
+        self.assertIn("@user2", html)
+        self.assertIn("and 1 other", html)
+        self.assertIn("liked your", html)
+        self.assertIn("list-group-item-info", html)
+
+        self.assertEqual(self.unread(self.ids[0]), 0)
+        self.assertFalse(Notification.query.one().unread)
+
+        # a read notification with new activity counts again
+        self.like(self.ids[3])
+        self.assertEqual(self.unread(self.ids[0]), 1)
+
+    def test_pages(self):
+        with app.test_request_context():
+            # a follower an hour, each in a bucket of its own
+            for hour in range(5):
+                notifications.notify_many('follow', self.ids[1 + hour % 3],
+                                          [(self.ids[0], self.ids[0])],
+                                          now=datetime(2021, 5, 1, hour))
+            db.session.commit()
+
+            first, before = notifications.page(self.ids[0], limit=3)
+            rest, after = notifications.page(self.ids[0], before, limit=3)
+
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(rest), 2)
+        self.assertIsNone(after)
+        self.assertGreater(first[-1].id, rest[0].id)
+
+    def test_purge(self):
+        self.like(self.ids[1])
+
+        purge.purge_user(self.ids[1])
+        self.assertIsNone(Notification.query.one().actor_id)
+
+        purge.purge_user(self.ids[0])
+        self.assertEqual(Notification.query.count(), 0)
@@ -0,0 +1,252 @@
+"""Page cache tests."""
+
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+from app import app, CURR_USER_KEY
+from models import User, Message, db
+import pagecache
+from pagecache import page_cache
+import snowflake
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class CountingEvent(threading.Event):
+    """An event counting the threads that waited on it."""
+
+    waiting = 0
+    lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        with CountingEvent.lock:
+            CountingEvent.waiting += 1
+        return super().wait(timeout)
+
+
+class CountedFlight(pagecache._Flight):
+    """A load whose waiters are counted."""
+
+    def __init__(self):
+        super().__init__()
+        self.done = CountingEvent()
+
+
+class PageCacheTestCase(TestCase):
+    """Tests caching pages, loading each key once at a time, and serving
+    stale entries while they are reloaded."""
+
+    def setUp(self):
+        """Adds two users; user0 posts a message. Turns the cache on."""
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User.signup(f"user{i}", f"user{i}@user{i}.com",
+                             "password", None)
+                 for i in range(2)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+
+        msg = Message(id=snowflake.next_id(), text="Cached",
+                      user_id=self.ids[0])
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+
+        app.config['PAGE_CACHE_ENABLED'] = True
+        page_cache.reset()
+
+        self.context = app.app_context()
+        self.context.push()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['PAGE_CACHE_ENABLED'] = None
+        app.config['PAGE_CACHE_TTL'] = 10
+        page_cache.reset()
+        self.context.pop()
+        db.session.rollback()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def in_threads(self, count, target):
+        """Run `target` in `count` threads, each in an app context; their
+        results in order."""
+
+        results = [None] * count
+
+        def run(i):
+            with app.app_context():
+                results[i] = target()
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_profile_cached(self):
+        resp = self.client.get(f"/users/{self.ids[0]}")
+        self.assertEqual(resp.headers['X-Page-Cache'], 'load')
+
+        resp = self.client.get(f"/users/{self.ids[0]}")
+        self.assertEqual(resp.headers['X-Page-Cache'], 'hit')
+        self.assertIn("Cached", resp.get_data(as_text=True))
+
+        # posting forgets the author's page
+        self.login(self.ids[0])
+        self.client.post("/messages/new", data={"text": "Fresh"})
+        html = self.client.get(f"/users/{self.ids[0]}").get_data(as_text=True)
+        self.assertIn("Fresh", html)
+
+        self.assertEqual(page_cache.stats, {'load': 2, 'hit': 1})
+
+    def test_viewer_parts_not_cached(self):
+        self.client.get(f"/users/{self.ids[0]}")
+
+        self.login(self.ids[1])
+        self.client.post(f"/messages/{self.message_id}/like",
+                         headers={"Referer": "/"})
+
+        resp = self.client.get(f"/users/{self.ids[0]}")
+        self.assertEqual(resp.headers['X-Page-Cache'], 'hit')
+        self.assertIn("liked-message", resp.get_data(as_text=True))
+
+        # the liker's own page counts the like
+        html = self.client.get(f"/users/{self.ids[1]}").get_data(as_text=True)
+        self.assertIn(f'<a href="/users/{self.ids[1]}/likes">1</a>', html)
+
+    def test_message_page(self):
+        self.assertEqual(
+            self.client.get(f"/messages/{self.message_id}").status_code, 200)
+
+        self.login(self.ids[0])
+        self.client.post(f"/messages/{self.message_id}/delete")
+
+        self.assertEqual(
+            self.client.get(f"/messages/{self.message_id}").status_code, 404)
+
+    def held_load(self, count, load):
+        """Have `count` threads get "key", the first loading it with
+        `load`, which returns once the rest are waiting. Their results in
+        order of starting."""
+
+        release = threading.Event()
+        CountingEvent.waiting = 0
+
+        def held():
+            release.wait(5)
+            return load()
+
+        def get():
+            try:
+                return page_cache.get("key", held)
+            except RuntimeError as error:
+                return f"error: {error}"
+
+        results = []
+        with patch('pagecache._Flight', CountedFlight):
+            leader = threading.Thread(
+                target=lambda: results.extend(self.in_threads(1, get)))
+            leader.start()
+            while "key" not in page_cache._flights:
+                leader.join(0.001)
+
+            waiters = threading.Thread(
+                target=lambda: results.extend(self.in_threads(count - 1,
+                                                              get)))
+            waiters.start()
+            while CountingEvent.waiting < count - 1:
+                waiters.join(0.001)
+
+            release.set()
+            leader.join()
+            waiters.join()
+
+        return results
+
+    def test_full_store_evicts_expired_then_oldest(self):
+        store = pagecache.MemoryStore(max_keys=2)
+        fresh = pagecache.Entry("value", 20, 30)
+
+        store.set("expired", pagecache.Entry("value", 5, 10), now=0)
+        store.set("busy", fresh, now=0)
+        store.set("new1", fresh, now=15)
+        self.assertIsNone(store.get("expired"))
+        self.assertIsNotNone(store.get("busy"))
+
+        # none has expired: "new1" is the least recently used
+        store.set("new2", fresh, now=15)
+        self.assertIsNone(store.get("new1"))
+        self.assertIsNotNone(store.get("busy"))
+
+    def test_single_flight(self):
+        loads = []
+
+        def load():
+            loads.append(1)
+            return "value"
+
+        self.assertEqual(self.held_load(6, load), ["value"] * 6)
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(page_cache.stats, {'load': 1, 'coalesced': 5})
+
+    def test_stale_while_revalidate(self):
+        app.config['PAGE_CACHE_TTL'] = 0
+        page_cache.get("key", lambda: "old")
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def reload():
+            started.set()
+            release.wait(5)
+            return "new"
+
+        leader = threading.Thread(
+            target=self.in_threads,
+            args=(1, lambda: page_cache.get("key", reload)))
+        leader.start()
+        started.wait(5)
+
+        # served at once while the reload is held up
+        self.assertEqual(self.in_threads(3, lambda: page_cache.get(
+            "key", reload)), ["old"] * 3)
+
+        release.set()
+        leader.join()
+        self.assertEqual(page_cache.store.get("key").value, "new")
+        self.assertEqual(page_cache.stats, {'load': 2, 'stale': 3})
+
+    def test_errors_shared_not_cached(self):
+        def fail():
+            raise RuntimeError("down")
+
+        self.assertEqual(self.held_load(3, fail), ["error: down"] * 3)
+        self.assertIsNone(page_cache.store.get("key"))
+
+    def test_forgotten_during_load(self):
+        def load():
+            # a write changes the page while it is read
+            page_cache.forget("key")
+            return "old"
+
+        self.assertEqual(page_cache.get("key", load), "old")
+        self.assertIsNone(page_cache.store.get("key"))
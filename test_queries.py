@@ -0,0 +1,273 @@
+"""SQL regression tests for every route.
+
+Each route is requested against the same seeded dataset while recording
+the statements it runs. A route may not run more statements than
+test_queries.json allows, so an N+1 query fails here rather than in
+production. On Postgres, the plans of its SELECTs are also checked for
+sequential scans of the big tables.
+
+After a deliberate change in a route's queries, rewrite the golden file
+and review its diff:
+
+    UPDATE_QUERY_GOLDEN=1 python3 -m unittest test_queries
+"""
+
+import json
+import os
+import re
+from datetime import datetime, timedelta
+from unittest import TestCase
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app, CURR_USER_KEY
+from models import User, Message, Like, Follows, db
+import rollups
+import snowflake
+from usernames import username_filter
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), 'test_queries.json')
+
+USERS = 20
+MESSAGES_PER_USER = 5
+FOLLOWS_PER_USER = 8
+
+# tables that must be read through an index
+INDEXED_TABLES = {'messages', 'likes', 'follows'}
+
+# (method, path, logged in, form data); {name}s are filled in from
+# RouteQueriesTestCase.ids. Requests that change data come last.
+ROUTES = [
+    ('GET', '/', False, None),
+    ('GET', '/', True, None),
+    ('GET', '/signup', False, None),
+    ('GET', '/login', False, None),
+    ('GET', '/users', True, None),
+    ('GET', '/users?q=user1', True, None),
+    ('GET', '/users/{other}', True, None),
+    ('GET', '/users/{other}/following', True, None),
+    ('GET', '/users/{other}/followers', True, None),
+    ('GET', '/users/{viewer}/likes', True, None),
+    ('GET', '/users/{other}/mentions', True, None),
+    ('GET', '/users/nearby', True, None),
+    ('GET', '/users/profile', True, None),
+    ('GET', '/messages/new', True, None),
+    ('GET', '/messages/{message}', True, None),
+    ('GET', '/trending', True, None),
+    ('GET', '/tags/python', True, None),
+    ('GET', '/notifications', True, None),
+    ('GET', '/api/users/{other}', False, None),
+    ('GET', '/api/messages/{message}', False, None),
+    ('GET', '/api/username-available?username=user1', False, None),
+    ('GET', '/api/stats', False, None),
+    ('POST', '/login', False, {'username': 'user0', 'password': 'password'}),
+    ('POST', '/messages/new', True, {'text': 'Hello'}),
+    ('POST', '/messages/{message}/like', True, None),
+    ('POST', '/users/follow/{stranger}', True, None),
+    ('POST', '/users/stop-following/{other}', True, None),
+    ('POST', '/users/mute/{other}', True, None),
+    ('POST', '/users/block/{stranger}', True, None),
+    ('POST', '/messages/{own_message}/delete', True, None),
+]
+
+
+def summarize(statement):
+    """A statement as its verb and the tables it names, e.g.
+    'SELECT likes messages'."""
+
+    verb = statement.split(None, 1)[0].upper()
+    # not columns named like a table, as in daily_stats.messages
+    tables = [name for name in sorted(db.metadata.tables)
+              if re.search(rf'(?<!\.)\b{name}\b', statement)]
+    return ' '.join([verb] + tables)
+
+
+def seq_scans(plan):
+    """Tables (not partitions) a Postgres JSON plan reads sequentially."""
+
+    if plan['Node Type'] == 'Seq Scan':
+        yield re.sub(r'_\d{4}_\d{2}$', '', plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+class RouteQueriesTestCase(TestCase):
+    """Tests the statements each route runs."""
+
+    golden = {}
+
+    @classmethod
+    def setUpClass(cls):
+        if os.path.exists(GOLDEN_PATH):
+            with open(GOLDEN_PATH) as f:
+                cls.golden = json.load(f)
+        cls.recorded = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.environ.get('UPDATE_QUERY_GOLDEN'):
+            with open(GOLDEN_PATH, 'w') as f:
+                json.dump(cls.recorded, f, indent=2, sort_keys=True)
+                f.write('\n')
+
+    def setUp(self):
+        """Seeds USERS users, each with MESSAGES_PER_USER messages and
+        following the next FOLLOWS_PER_USER users; the viewer (user0)
+        likes one message of each user it follows."""
+
+        db.drop_all()
+        db.create_all()
+
+        # no worker id leases in the middle of a request
+        snowflake.generator.configure(worker_id=1)
+
+        viewer = User.signup("user0", "user0@user0.com", "password", None)
+        db.session.commit()
+
+        db.session.bulk_insert_mappings(User, [
+            {'username': f"user{i}", 'email': f"user{i}@user{i}.com",
+             'password': viewer.password}
+            for i in range(1, USERS)])
+        user_ids = [id for (id,) in (db.session
+                                     .query(User.id)
+                                     .order_by(User.id))]
+
+        now = datetime.utcnow()
+        messages = []
+        for index, user_id in enumerate(user_ids):
+            for i in range(MESSAGES_PER_USER):
+                timestamp = now - timedelta(hours=index * MESSAGES_PER_USER
+                                            + i)
+                messages.append({'id': snowflake.from_datetime(timestamp),
+                                 'text': f"Message {i} by user{index}",
+                                 'timestamp': timestamp,
+                                 'user_id': user_id})
+        db.session.bulk_insert_mappings(Message, messages)
+
+        db.session.bulk_insert_mappings(Follows, [
+            {'user_following_id': user_id,
+             'user_being_followed_id': user_ids[(index + step) % USERS]}
+            for index, user_id in enumerate(user_ids)
+            for step in range(1, FOLLOWS_PER_USER + 1)])
+
+        followed = user_ids[1:FOLLOWS_PER_USER + 1]
+        by_author = {}
+        for msg in messages:
+            by_author.setdefault(msg['user_id'], msg['id'])
+        db.session.bulk_insert_mappings(Like, [
+            {'message_id': by_author[user_id], 'user_id': viewer.id}
+            for user_id in followed[1:]])
+        db.session.commit()
+
+        self.ids = {
+            'viewer': viewer.id,
+            'other': followed[0],
+            'stranger': user_ids[-1],
+            'message': by_author[followed[0]],
+            'own_message': by_author[viewer.id],
+        }
+
+        # for /api/stats
+        rollups.roll_up(now=now + timedelta(days=1))
+
+        # build the username filter now, not in the middle of a request
+        with app.app_context():
+            username_filter.rebuild()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        snowflake.generator.configure()
+
+    def request(self, method, path, logged_in, data):
+        """Make the request; returns [(statement, parameters)] it ran."""
+
+        with self.client.session_transaction() as sess:
+            if logged_in:
+                sess[CURR_USER_KEY] = self.ids['viewer']
+            else:
+                sess.pop(CURR_USER_KEY, None)
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, many):
+            statements.append((statement, None if many else parameters))
+
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            resp = self.client.open(path.format(**self.ids), method=method,
+                                    data=data, headers={'Referer': '/'})
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+
+        self.assertLess(resp.status_code, 400, f"{method} {path}")
+        return statements
+
+    def assert_indexed(self, route, statements):
+        """Fail if any SELECT reads an INDEXED_TABLES table sequentially
+        where an index could be used."""
+
+        raw = db.engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            # on a small table a sequential scan is cheapest; only take
+            # one if there is no index to use
+            cursor.execute("SET enable_seqscan = off")
+
+            for statement, parameters in statements:
+                if not statement.lstrip().upper().startswith('SELECT'):
+                    continue
+
+                cursor.execute("EXPLAIN (FORMAT JSON) " + statement,
+                               parameters)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+
+                scanned = set(seq_scans(plan[0]['Plan'])) & INDEXED_TABLES
+                self.assertFalse(
+                    scanned,
+                    f"{route} reads {', '.join(sorted(scanned))} "
+                    f"without an index:\n{statement}")
+        finally:
+            raw.rollback()
+            raw.close()
+
+    def test_routes(self):
+        for method, path, logged_in, data in ROUTES:
+            route = f"{method} {path}" + (" (logged in)" if logged_in else "")
+
+            with self.subTest(route):
+                statements = self.request(method, path, logged_in, data)
+                summaries = [summarize(statement)
+                             for statement, parameters in statements]
+                self.recorded[route] = {'max_statements': len(summaries),
+                                        'statements': summaries}
+
+                if os.environ.get('UPDATE_QUERY_GOLDEN'):
+                    continue
+
+                self.assertIn(route, self.golden,
+                              "New route: run with UPDATE_QUERY_GOLDEN=1")
+                expected = self.golden[route]
+                self.assertLessEqual(
+                    len(summaries), expected['max_statements'],
+                    f"{route} ran more statements than before.\n"
+                    f"Expected: {expected['statements']}\n"
+                    f"Ran: {summaries}")
+
+                if db.engine.dialect.name == 'postgresql':
+                    self.assert_indexed(route, statements)
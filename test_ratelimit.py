@@ -0,0 +1,139 @@
+"""Rate limiting tests."""
+
+from unittest import TestCase
+from app import app, limiter, CURR_USER_KEY
+from models import User, db
+from ratelimit import MemoryStore, parse_rate
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class TokenBucketTestCase(TestCase):
+    """Tests the in-process token bucket store."""
+
+    def test_parse_rate(self):
+        """ rates parse to capacity and tokens per second """
+
+        self.assertEqual(parse_rate("30/minute"), (30, 0.5))
+        self.assertEqual(parse_rate("2/seconds"), (2, 2))
+
+    def test_bucket_empties_and_refills(self):
+        """ a bucket allows `capacity` hits, then refills over time """
+
+        store = MemoryStore()
+
+        self.assertEqual(store.take("k", 2, 1, now=0), 0)
+        self.assertEqual(store.take("k", 2, 1, now=0), 0)
+        self.assertAlmostEqual(store.take("k", 2, 1, now=0), 1)
+        self.assertAlmostEqual(store.take("k", 2, 1, now=0.25), 0.75)
+        self.assertEqual(store.take("k", 2, 1, now=1), 0)
+
+    def test_buckets_are_independent(self):
+        """ each key has its own bucket """
+
+        store = MemoryStore()
+
+        self.assertEqual(store.take("a", 1, 1, now=0), 0)
+        self.assertEqual(store.take("b", 1, 1, now=0), 0)
+        self.assertGreater(store.take("a", 1, 1, now=0), 0)
+
+
+    def test_full_store_evicts_refilled_then_oldest(self):
+        """ at max_keys, refilled buckets go first, then the least
+        recently used one; busy buckets keep their state """
+
+        store = MemoryStore(max_keys=2)
+
+        store.take("victim", 1, 1, now=0)
+        store.take("idle", 1, 0.001, now=0)
+        store.take("new1", 1, 1, now=2)
+        # "victim" had refilled, so it went, not "idle"
+        self.assertGreater(store.take("idle", 1, 0.001, now=2), 0)
+
+        # none has refilled: "new1" is the least recently used
+        store.take("victim", 1, 1, now=2)
+        store.take("new2", 1, 1, now=2.1)
+        self.assertGreater(store.take("victim", 1, 1, now=2.1), 0)
+
+
+class RateLimitViewTestCase(TestCase):
+    """Tests limits applied to routes."""
+
+    def setUp(self):
+        """Adds a user and turns limiting on."""
+
+        db.drop_all()
+        db.create_all()
+
+        user1 = User.signup("user1", "user1@user1.com", "password", None)
+        db.session.commit()
+        self.user1_id = user1.id
+
+        app.config['RATELIMIT_ENABLED'] = True
+        app.config['RATELIMITS'] = {'messages_add': "2/minute"}
+        limiter.store.reset()
+
+    def tearDown(self):
+        """Rollback the data and turn limiting back off."""
+
+        db.session.rollback()
+        app.config['RATELIMIT_ENABLED'] = None
+        app.config['RATELIMITS'] = {}
+
+    def test_messages_add_limited(self):
+        """ posting too fast gets a 429 with Retry-After """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            for text in ("one", "two"):
+                resp = client.post("/messages/new", data={"text": text})
+                self.assertEqual(resp.status_code, 302)
+
+            resp = client.post("/messages/new", data={"text": "three"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.headers["Retry-After"], "30")
+
+            # showing the form doesn't spend tokens
+            resp = client.get("/messages/new")
+            self.assertEqual(resp.status_code, 200)
+
+    def test_login_limited_by_ip(self):
+        """ repeated login attempts from one IP are limited """
+
+        with app.test_client() as client:
+            statuses = [client.post("/login",
+                                    data={"username": "nobody",
+                                          "password": "password"}).status_code
+                        for i in range(11)]
+
+        self.assertEqual(statuses[:10], [200] * 10)
+        self.assertEqual(statuses[10], 429)
+
+    def test_clients_behind_proxy_limited_apart(self):
+        """ clients are told apart by the address the proxy forwarded """
+
+        def attempt(address):
+            return client.post("/login",
+                               data={"username": "nobody",
+                                     "password": "password"},
+                               headers={"X-Forwarded-For": address})
+
+        with app.test_client() as client:
+            statuses = [attempt("203.0.113.1").status_code
+                        for i in range(11)]
+            self.assertEqual(statuses[10], 429)
+
+            self.assertEqual(attempt("203.0.113.2").status_code, 200)
@@ -0,0 +1,143 @@
+"""Daily rollup tests."""
+
+from datetime import date, datetime, timedelta
+from app import app, CURR_USER_KEY
+from models import (Message, Like, Follows, DailyStats, UserDailyStats,
+                    db)
+import rollups
+import snowflake
+from testing import DatabaseTestCase
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+DAY1 = date(2026, 10, 1)
+DAY2 = date(2026, 10, 2)
+
+
+def at(day, hour):
+    return datetime(day.year, day.month, day.day, hour)
+
+
+class RollupsTestCase(DatabaseTestCase):
+    """Tests rolling up each day's activity once, and reading it back."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user1_id = self.user_ids["user1"]
+        self.user2_id = self.user_ids["user2"]
+        self.sequence = 0
+
+    def post(self, user_id, when):
+        self.sequence += 1
+        msg = Message(id=snowflake.from_datetime(when, sequence=self.sequence),
+                      text="hello", timestamp=when, user_id=user_id)
+        db.session.add(msg)
+        db.session.commit()
+        return msg.id
+
+    def add_activity(self):
+        """On DAY1 user1 posts twice and user2 once, user2 likes one of
+        user1's messages and follows them; on DAY2 user1 posts once."""
+
+        first = self.post(self.user1_id, at(DAY1, 9))
+        self.post(self.user1_id, at(DAY1, 23))
+        self.post(self.user2_id, at(DAY1, 12))
+        self.post(self.user1_id, at(DAY2, 0))
+
+        db.session.add(Like(message_id=first, user_id=self.user2_id,
+                            created_at=at(DAY1, 10)))
+        db.session.add(Follows(user_being_followed_id=self.user1_id,
+                               user_following_id=self.user2_id,
+                               created_at=at(DAY1, 11)))
+        db.session.commit()
+
+    def daily(self):
+        return [(row.day, row.messages, row.posters, row.likes, row.follows)
+                for row in DailyStats.query.order_by(DailyStats.day)]
+
+    def test_roll_up_days(self):
+        self.add_activity()
+
+        self.assertEqual(rollups.roll_up(now=at(DAY2 + rollups.DAY, 1)), 2)
+
+        self.assertEqual(self.daily(), [(DAY1, 3, 2, 1, 1),
+                                        (DAY2, 1, 1, 0, 0)])
+
+        user1 = UserDailyStats.query.get((DAY1, self.user1_id))
+        self.assertEqual((user1.messages, user1.likes_received,
+                          user1.followers_gained), (2, 1, 1))
+        user2 = UserDailyStats.query.get((DAY1, self.user2_id))
+        self.assertEqual((user2.messages, user2.likes_given,
+                          user2.follows_made), (1, 1, 1))
+
+    def test_only_new_days_read(self):
+        self.add_activity()
+        rollups.roll_up(now=at(DAY2, 1))
+        self.assertEqual(self.daily(), [(DAY1, 3, 2, 1, 1)])
+
+        # past the watermark: left for a backfill
+        self.post(self.user2_id, at(DAY1, 22))
+        self.assertEqual(rollups.roll_up(now=at(DAY2, 2)), 0)
+
+        self.assertEqual(rollups.roll_up(now=at(DAY2 + rollups.DAY, 1)), 1)
+        self.assertEqual(self.daily(), [(DAY1, 3, 2, 1, 1),
+                                        (DAY2, 1, 1, 0, 0)])
+
+        rollups.rewind(DAY1)
+        self.assertEqual(rollups.roll_up(now=at(DAY2 + rollups.DAY, 1)), 2)
+        self.assertEqual(self.daily()[0], (DAY1, 4, 2, 1, 1))
+
+    def test_day_rolled_up_after_lag(self):
+        self.add_activity()
+
+        self.assertEqual(rollups.roll_up(now=at(DAY2, 0)), 0)
+        self.assertEqual(
+            rollups.roll_up(now=at(DAY2, 0) + rollups.LAG), 1)
+
+    def test_chunks(self):
+        self.add_activity()
+
+        self.assertEqual(rollups.roll_up(now=at(DAY2 + rollups.DAY, 1),
+                                         chunk_days=1), 2)
+        self.assertEqual(len(self.daily()), 2)
+
+    def test_follows_stamped(self):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            client.post("/api/following", json={"users": [self.user2_id]})
+
+        self.assertIsNotNone(Follows.query.one().created_at)
+
+    def test_api_stats(self):
+        with app.test_client() as client:
+            self.assertEqual(client.get("/api/stats").get_json(),
+                             {'through': None, 'days': [], 'top_users': []})
+
+            self.add_activity()
+            rollups.roll_up(now=at(DAY2 + rollups.DAY, 1))
+
+            data = client.get("/api/stats?days=1").get_json()
+            self.assertEqual(data['through'], '2026-10-02')
+            self.assertEqual(data['days'], [
+                {'day': '2026-10-02', 'messages': 1, 'posters': 1,
+                 'likes': 0, 'follows': 0}])
+
+            data = client.get("/api/stats?by=messages").get_json()
+            self.assertEqual(len(data['days']), 2)
+            self.assertEqual(
+                [(user['user_id'], user['messages'])
+                 for user in data['top_users']],
+                [(self.user1_id, 3), (self.user2_id, 1)])
+
+            resp = client.get("/api/stats?by=password")
+            self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,308 @@
+"""Sharded message and like tests.
+
+These use three SQLite files as shards next to the main test database.
+"""
+
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+from sqlalchemy import event
+from app import app, CURR_USER_KEY
+from models import (User, Follows, Message, Like, ShardBucket,
+                    MessageBucket, db)
+import purge
+import readmodels
+import shards as sharding
+from shards import shards, bucket_of, BucketMoving
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class ShardsTestCase(TestCase):
+    """Tests routing messages and likes over several databases."""
+
+    def setUp(self):
+        """Adds three users, each on their own shard, and turns
+        sharding on."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.shard_dir = tempfile.mkdtemp()
+        self.use_shards(3)
+
+        users = [User.signup(f"user{i}", f"user{i}@user{i}.com",
+                             "password", None)
+                 for i in range(3)]
+        db.session.commit()
+        self.user_ids = [user.id for user in users]
+
+        # user0 follows the others
+        for user in users[1:]:
+            db.session.add(Follows(user_following_id=users[0].id,
+                                   user_being_followed_id=user.id))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shards.configure(None)
+        db.session.rollback()
+        shutil.rmtree(self.shard_dir)
+
+    def use_shards(self, count):
+        shards.configure([f"sqlite:///{self.shard_dir}/shard{i}.db"
+                          for i in range(count)])
+        sharding.init_shards()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, user_id, text, minutes_ago=0):
+        msg = Message(text=text, user_id=user_id,
+                      timestamp=datetime.utcnow()
+                      - timedelta(minutes=minutes_ago))
+        shards.add_message(msg)
+        shards.commit()
+        return msg.id
+
+    def count_on(self, shard, model):
+        return shards.sessions[shard].query(model).count()
+
+    def test_users_on_separate_shards(self):
+        self.assertEqual(
+            sorted(shards.shard_of_bucket(bucket_of(id))
+                   for id in self.user_ids),
+            [0, 1, 2])
+
+    def test_shard_tables_have_no_user_foreign_keys(self):
+        tables = sharding.shard_metadata().tables
+
+        self.assertEqual(
+            [fk.target_fullname for fk in tables['likes'].foreign_keys],
+            ['messages.id'])
+        self.assertEqual(tables['messages'].foreign_keys, set())
+
+    def test_messages_add(self):
+        user_id = self.user_ids[1]
+        self.login(user_id)
+
+        resp = self.client.post("/messages/new", data={"text": "Hello"})
+        self.assertEqual(resp.status_code, 302)
+
+        shard = shards.shard_of_bucket(bucket_of(user_id))
+        for index in range(3):
+            self.assertEqual(self.count_on(index, Message),
+                             1 if index == shard else 0)
+
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_ids_unique_across_shards(self):
+        ids = [self.post(user_id, "Hi") for user_id in self.user_ids * 2]
+
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_homepage_merges_shards(self):
+        user0, user1, user2 = self.user_ids
+        self.post(user1, "oldest", minutes_ago=30)
+        self.post(user2, "middle", minutes_ago=20)
+        self.post(user0, "newest", minutes_ago=10)
+        self.post(user1, "latest", minutes_ago=0)
+
+        items = readmodels.timeline({user0, user1, user2}, user0)
+        self.assertEqual([item.text for item in items],
+                         ["latest", "newest", "middle", "oldest"])
+        self.assertEqual(items[0].username, "user1")
+
+        self.assertEqual(
+            [item.text for item in readmodels.timeline({user0, user1, user2},
+                                                       user0, limit=2)],
+            ["latest", "newest"])
+
+        self.login(user0)
+        html = self.client.get("/").get_data(as_text=True)
+        positions = [html.index(text)
+                     for text in ("latest", "newest", "middle", "oldest")]
+        self.assertEqual(positions, sorted(positions))
+
+    def test_timeline_since(self):
+        user0, user1, user2 = self.user_ids
+        first = self.post(user1, "first")
+        self.post(user2, "second")
+        self.post(user0, "third")
+
+        items = readmodels.timeline_since({user0, user1, user2}, first)
+        self.assertEqual([item.text for item in items], ["second", "third"])
+        self.assertEqual(shards.last_message_id(), items[-1].id)
+
+    def test_like_toggle(self):
+        user0, user1, user2 = self.user_ids
+        msg_id = self.post(user2, "Like me")
+        self.login(user0)
+
+        self.client.post(f"/messages/{msg_id}/like", headers={"Referer": "/"})
+
+        shard = shards.shard_of_bucket(bucket_of(user2))
+        self.assertEqual(self.count_on(shard, Like), 1)
+        self.assertTrue(readmodels.timeline({user2}, user0)[0].liked)
+        self.assertFalse(readmodels.timeline({user2}, user1)[0].liked)
+        self.assertEqual(readmodels.user_counts(user0).likes, 1)
+        self.assertEqual(readmodels.user_counts(user2).messages, 1)
+        items, before = readmodels.liked_timeline(user0)
+        self.assertEqual([item.id for item in items], [msg_id])
+
+        self.client.post(f"/messages/{msg_id}/like", headers={"Referer": "/"})
+        self.assertEqual(self.count_on(shard, Like), 0)
+
+    def test_show_and_destroy(self):
+        user1 = self.user_ids[1]
+        msg_id = self.post(user1, "Short-lived")
+        self.login(user1)
+
+        resp = self.client.get(f"/messages/{msg_id}")
+        self.assertIn("Short-lived", resp.get_data(as_text=True))
+
+        resp = self.client.post(f"/messages/{msg_id}/delete")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.client.get(f"/messages/{msg_id}").status_code,
+                         404)
+
+    def test_write_to_moving_bucket_refused(self):
+        user1 = self.user_ids[1]
+        msg_id = self.post(user1, "Hello")
+        bucket = bucket_of(user1)
+
+        ShardBucket.query.get(bucket).moving = True
+        db.session.commit()
+        shards.reload()
+
+        self.login(self.user_ids[0])
+        resp = self.client.post(f"/messages/{msg_id}/like")
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('Retry-After', resp.headers)
+
+        # reads still work
+        self.assertEqual(len(readmodels.timeline({user1})), 1)
+
+    def test_write_checks_bucket_past_cached_map(self):
+        user1 = self.user_ids[1]
+        msg_id = self.post(user1, "Hello")
+
+        # marked by another process; this one's map is still fresh
+        ShardBucket.query.get(bucket_of(user1)).moving = True
+        db.session.commit()
+
+        with self.assertRaises(BucketMoving):
+            shards.find_message(msg_id, write=True)
+        self.assertIsNotNone(shards.find_message(msg_id)[1])
+
+    def test_find_message_reads_its_shard(self):
+        user1 = self.user_ids[1]
+        msg_id = self.post(user1, "Hello")
+        self.assertEqual(MessageBucket.query.get(msg_id).bucket,
+                         bucket_of(user1))
+
+        statements = []
+        for engine in shards.engines:
+            event.listen(engine, 'before_cursor_execute',
+                         lambda *args: statements.append(args[2]))
+        session, msg = shards.find_message(msg_id)
+
+        self.assertEqual(msg.text, "Hello")
+        self.assertEqual(len(statements), 1)
+
+    def test_move_buckets(self):
+        user0, user1, user2 = self.user_ids
+        msg_id = self.post(user1, "Moving house")
+        shards.sessions[shards.shard_of_bucket(bucket_of(user1))].add(
+            Like(message_id=msg_id, user_id=user0))
+        shards.commit()
+
+        bucket = bucket_of(user1)
+        source = shards.shard_of_bucket(bucket)
+        target = (source + 1) % 3
+
+        self.assertEqual(sharding.move_buckets({bucket: target}, wait=0), 1)
+
+        self.assertEqual(shards.shard_of_bucket(bucket), target)
+        self.assertEqual(self.count_on(source, Message), 0)
+        self.assertEqual(self.count_on(source, Like), 0)
+        self.assertEqual(self.count_on(target, Message), 1)
+        self.assertEqual(self.count_on(target, Like), 1)
+        self.assertTrue(readmodels.timeline({user1}, user0)[0].liked)
+
+    def test_init_keeps_assignments(self):
+        self.use_shards(4)
+
+        self.assertEqual(shards.shard_of_bucket(3), 0)
+        self.assertEqual(ShardBucket.query.count(), sharding.NUM_BUCKETS)
+
+    def test_rebalance_after_adding_shard(self):
+        ShardBucket.query.delete()
+        db.session.commit()
+        self.use_shards(2)
+        for user_id in self.user_ids:
+            self.post(user_id, f"Hi from {user_id}")
+
+        self.use_shards(3)
+        self.assertEqual(shards.shard_of_bucket(bucket_of(3)), 1)
+        sharding.rebalance(wait=0)
+
+        for user_id in self.user_ids:
+            shard = bucket_of(user_id) % 3
+            session = shards.sessions[shard]
+            self.assertEqual(
+                session.query(Message).filter_by(user_id=user_id).count(), 1)
+
+        self.assertEqual(
+            sum(self.count_on(index, Message) for index in range(3)), 3)
+
+    def test_import_from_main(self):
+        shards.configure(None)
+        user0, user1, user2 = self.user_ids
+        msg = Message(text="Before sharding", user_id=user2)
+        db.session.add(msg)
+        db.session.commit()
+        db.session.add(Like(message_id=msg.id, user_id=user0))
+        db.session.commit()
+
+        self.use_shards(3)
+        self.assertEqual(sharding.import_from_main(), 1)
+
+        shard = shards.shard_of_bucket(bucket_of(user2))
+        self.assertEqual(self.count_on(shard, Message), 1)
+        self.assertEqual(self.count_on(shard, Like), 1)
+        self.assertEqual(MessageBucket.query.get(msg.id).bucket,
+                         bucket_of(user2))
+        self.assertGreater(self.post(user0, "After"), msg.id)
+
+    def test_purge_user(self):
+        user0, user1, user2 = self.user_ids
+        own = self.post(user1, "Mine")
+        other = self.post(user2, "Theirs")
+        shards.for_user(user2).add(Like(message_id=other, user_id=user1))
+        shards.for_user(user1).add(Like(message_id=own, user_id=user0))
+        shards.commit()
+
+        purge.purge_user(user1)
+
+        for index in range(3):
+            session = shards.sessions[index]
+            self.assertEqual(
+                session.query(Message).filter_by(user_id=user1).count(), 0)
+            self.assertEqual(session.query(Like).count(), 0)
+        self.assertEqual(
+            [item.text for item in readmodels.timeline({user2})], ["Theirs"])
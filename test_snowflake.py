@@ -0,0 +1,281 @@
+"""Snowflake message id tests."""
+
+import multiprocessing
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+from app import app
+from migrations import (migrate_to_snowflake_ids, renumber_messages,
+                        LEGACY_ID_LIMIT)
+from models import (User, Message, Like, TrendingScore, SnowflakeWorker,
+                    MessageTag, MessageMention, MessageBucket, Notification,
+                    db)
+import shards as sharding
+import snowflake
+from shards import shards
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+def make_ids(count, results):
+    # runs in a forked child: don't share the parent's connections
+    db.engine.dispose()
+    ids = [snowflake.next_id() for i in range(count)]
+    results.put((snowflake.generator.worker_id, ids))
+
+
+class SnowflakeTestCase(TestCase):
+    """Tests generating, leasing and migrating to snowflake ids."""
+
+    def setUp(self):
+        """Recreates tables."""
+
+        db.drop_all()
+        db.create_all()
+        snowflake.generator.configure()
+
+    def tearDown(self):
+        db.session.rollback()
+        snowflake.generator.release()
+
+    def test_layout(self):
+        stamp = datetime(2021, 3, 4, 5, 6, 7, 8000)
+        snowflake_id = snowflake.from_datetime(stamp, worker_id=5, sequence=7)
+
+        self.assertEqual(snowflake.to_datetime(snowflake_id), stamp)
+        self.assertEqual(snowflake_id & snowflake.MAX_SEQUENCE, 7)
+        self.assertEqual(
+            snowflake_id >> snowflake.SEQUENCE_BITS & snowflake.MAX_WORKER_ID,
+            5)
+        self.assertLess(snowflake_id, 1 << 63)
+
+        with self.assertRaises(ValueError):
+            snowflake.from_datetime(datetime(2009, 12, 31))
+
+    def test_ids_follow_the_clock(self):
+        generator = snowflake.Generator(worker_id=1)
+        before = datetime.utcnow() - timedelta(milliseconds=1)
+        snowflake_id = generator.next_id()
+
+        self.assertGreaterEqual(snowflake.to_datetime(snowflake_id), before)
+        self.assertLess(snowflake.to_datetime(snowflake_id),
+                        datetime.utcnow() + timedelta(milliseconds=1))
+
+    def test_monotonic_when_clock_steps_back(self):
+        generator = snowflake.Generator(worker_id=1)
+
+        with mock.patch('time.time', side_effect=[1700000000.5,
+                                                  1700000000.2,
+                                                  1700000000.2]):
+            ids = [generator.next_id() for i in range(3)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_sequence_overflow_borrows_next_millisecond(self):
+        generator = snowflake.Generator(worker_id=1)
+
+        with mock.patch('time.time', return_value=1700000000.5):
+            ids = [generator.next_id()
+                   for i in range(snowflake.MAX_SEQUENCE + 2)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(snowflake.to_datetime(ids[-1])
+                         - snowflake.to_datetime(ids[0]),
+                         timedelta(milliseconds=1))
+
+    def test_monotonic_across_threads(self):
+        generator = snowflake.Generator(worker_id=1)
+        per_thread = [[] for i in range(8)]
+
+        def make(ids):
+            for i in range(5000):
+                ids.append(generator.next_id())
+
+        threads = [threading.Thread(target=make, args=(ids,))
+                   for ids in per_thread]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for ids in per_thread:
+            self.assertEqual(ids, sorted(ids))
+
+        all_ids = [id for ids in per_thread for id in ids]
+        self.assertEqual(len(set(all_ids)), len(all_ids))
+
+    def test_unique_across_processes(self):
+        # the parent's lease must not carry over into its children
+        parent_worker = (snowflake.next_id() >> snowflake.SEQUENCE_BITS
+                         & snowflake.MAX_WORKER_ID)
+
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        processes = [context.Process(target=make_ids, args=(2000, results))
+                     for i in range(4)]
+        for process in processes:
+            process.start()
+
+        outcomes = [results.get(timeout=60) for process in processes]
+        for process in processes:
+            process.join()
+
+        workers = [worker for worker, ids in outcomes]
+        self.assertEqual(len(set(workers + [parent_worker])), 5)
+
+        all_ids = []
+        for worker, ids in outcomes:
+            self.assertEqual(ids, sorted(ids))
+            all_ids += ids
+        self.assertEqual(len(set(all_ids)), len(all_ids))
+
+    def test_leases(self):
+        first, expires = snowflake.lease_worker_id('host:1')
+        second, _ = snowflake.lease_worker_id('host:2')
+        self.assertNotEqual(first, second)
+
+        renewed, later = snowflake.lease_worker_id('host:1', renew=first)
+        self.assertEqual(renewed, first)
+        self.assertGreaterEqual(later, expires)
+
+        # an expired lease is handed to the next process
+        SnowflakeWorker.query.get(first).expires_at = datetime(2020, 1, 1)
+        db.session.commit()
+        taken, _ = snowflake.lease_worker_id('host:3')
+        self.assertEqual(taken, first)
+
+        snowflake.release_worker_id('host:2', second)
+        self.assertIsNone(SnowflakeWorker.query.get(second))
+
+    def test_message_ids_time_ordered(self):
+        user = User.signup("user1", "user1@user1.com", "password", None)
+        db.session.commit()
+
+        messages = [Message(text=f"#{i}", user_id=user.id) for i in range(3)]
+        for msg in messages:
+            db.session.add(msg)
+            db.session.commit()
+
+        ids = [msg.id for msg in messages]
+        self.assertEqual(ids, sorted(ids))
+        self.assertGreater(ids[0], LEGACY_ID_LIMIT)
+        self.assertEqual([msg.text for msg in user.messages],
+                         ["#2", "#1", "#0"])
+
+    def test_migrate_to_snowflake_ids(self):
+        user = User.signup("user1", "user1@user1.com", "password", None)
+        db.session.commit()
+
+        # old autoincrement ids, not in time order
+        newer = Message(id=1, text="newer", user_id=user.id,
+                        timestamp=datetime(2018, 5, 1))
+        older = Message(id=2, text="older", user_id=user.id,
+                        timestamp=datetime(2017, 5, 1))
+        db.session.add_all([newer, older])
+        db.session.commit()
+        db.session.add(Like(message_id=1, user_id=user.id))
+        db.session.add(TrendingScore(kind='message', target_id=1,
+                                     window='24h', score=1.0,
+                                     updated_at=datetime.utcnow()))
+        db.session.commit()
+
+        self.assertEqual(migrate_to_snowflake_ids(), 2)
+        db.session.expire_all()
+
+        messages = Message.query.order_by(Message.id).all()
+        self.assertEqual([msg.text for msg in messages], ["older", "newer"])
+        self.assertEqual(snowflake.to_datetime(messages[1].id),
+                         datetime(2018, 5, 1))
+        self.assertEqual(Like.query.one().message_id, messages[1].id)
+        self.assertEqual(TrendingScore.query.one().target_id, messages[1].id)
+        self.assertEqual(migrate_to_snowflake_ids(), 0)
+
+    def test_migrate_sharded(self):
+        """ message buckets, tags, mentions and like notifications follow
+        renumbered messages on shards """
+
+        shard_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shard_dir)
+        self.addCleanup(shards.configure, None)
+        shards.configure([f"sqlite:///{shard_dir}/shard{i}.db"
+                          for i in range(2)])
+        sharding.init_shards()
+
+        user = User.signup("user1", "user1@user1.com", "password", None)
+        db.session.commit()
+
+        session = shards.add_message(Message(id=1, text="old", user_id=user.id,
+                                             timestamp=datetime(2018, 5, 1)))
+        session.add_all([Like(message_id=1, user_id=user.id),
+                         MessageTag(tag="old", message_id=1),
+                         MessageMention(user_id=user.id, message_id=1)])
+        db.session.add(Notification(recipient_id=user.id, kind='like',
+                                    target_id=1, bucket=0,
+                                    actor_id=user.id))
+        shards.commit()
+
+        self.assertEqual(migrate_to_snowflake_ids(), 1)
+        db.session.expire_all()
+
+        new_id = session.query(Message.id).scalar()
+        self.assertGreater(new_id, LEGACY_ID_LIMIT)
+        for model in (Like, MessageTag, MessageMention):
+            self.assertEqual(session.query(model.message_id).scalar(), new_id)
+        self.assertEqual(
+            [row.message_id for row in MessageBucket.query], [new_id])
+        self.assertEqual(Notification.query.one().target_id, new_id)
+        found_in, msg = shards.find_message(new_id)
+        self.assertEqual(msg.text, "old")
+
+    def test_renumbered_links_redirect(self):
+        user = User.signup("user1", "user1@user1.com", "password", None)
+        db.session.commit()
+        db.session.add(Message(id=7, text="old link", user_id=user.id,
+                               timestamp=datetime(2018, 5, 1)))
+        db.session.commit()
+
+        migrate_to_snowflake_ids()
+        new_id = Message.query.one().id
+
+        with app.test_client() as client:
+            resp = client.get("/messages/7")
+            self.assertEqual(resp.status_code, 301)
+            self.assertTrue(resp.location.endswith(f"/messages/{new_id}"))
+
+            self.assertEqual(client.get("/messages/8").status_code, 404)
+
+            resp = client.get(f"/api/messages/{new_id}")
+            self.assertEqual(resp.get_json()['message']['id'], str(new_id))
+
+    def test_renumbering_keeps_to_the_worker_id(self):
+        user = User.signup("user1", "user1@user1.com", "password", None)
+        db.session.commit()
+        when = datetime(2018, 5, 1)
+        db.session.add_all([Message(id=i, text=f"#{i}", user_id=user.id,
+                                    timestamp=when)
+                            for i in range(1, 4)])
+        db.session.commit()
+
+        # a sequence of two ids per millisecond runs out at the third
+        with mock.patch('snowflake.MAX_SEQUENCE', 1):
+            renumber_messages(db.session, worker_id=3)
+
+        ms = snowflake.from_datetime(when) >> snowflake.TIMESTAMP_SHIFT
+        self.assertEqual([msg.id for msg in
+                          Message.query.order_by(Message.id)],
+                         [snowflake.make_id(ms, 3, 0),
+                          snowflake.make_id(ms, 3, 1),
+                          snowflake.make_id(ms + 1, 3, 0)])
@@ -0,0 +1,164 @@
+"""Hashtag and mention index tests."""
+
+from unittest import TestCase
+from app import app, CURR_USER_KEY
+from models import User, Message, MessageTag, MessageMention, db
+import jobs
+import purge
+import readmodels
+import snowflake
+import tags
+from usernames import username_filter
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class TagsTestCase(TestCase):
+    """Tests indexing messages' tags and mentions and reading them back."""
+
+    def setUp(self):
+        """Adds user0 and user1, and logs in user0."""
+
+        db.drop_all()
+        db.create_all()
+
+        # no worker id leases in the middle of a request
+        snowflake.generator.configure(worker_id=1)
+
+        users = [User.signup(f"user{i}", f"user{i}@user{i}.com",
+                             "password", None)
+                 for i in range(2)]
+        db.session.commit()
+        self.user0, self.user1 = [user.id for user in users]
+
+        self.context = app.app_context()
+        self.context.push()
+        username_filter.rebuild()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user0
+
+    def tearDown(self):
+        self.context.pop()
+        db.session.rollback()
+        snowflake.generator.configure()
+
+    def post(self, text):
+        self.client.post("/messages/new", data={"text": text})
+        return (db.session
+                .query(Message.id)
+                .filter_by(text=text)
+                .order_by(Message.id.desc())
+                .first()
+                .id)
+
+    def test_extract(self):
+        self.assertEqual(tags.extract_tags("#Flask and #flask, a#b, #2021!"),
+                         {"flask", "2021"})
+        self.assertEqual(
+            tags.extract_mentions("@user1, me@example.com and @j.doe."),
+            {"user1", "j.doe"})
+
+    def test_link_tags(self):
+        self.assertEqual(
+            str(tags.link_tags("<b>#Flask</b> & #1's")),
+            '&lt;b&gt;<a href="/tags/flask">#Flask</a>&lt;/b&gt; &amp; '
+            '<a href="/tags/1">#1</a>&#39;s')
+
+    def test_post_indexes(self):
+        message_id = self.post("Hi @user1 and @nobody, #Python #python #web")
+
+        self.assertEqual(
+            sorted(row.tag for row in MessageTag.query.filter_by(
+                message_id=message_id)),
+            ["python", "web"])
+        self.assertEqual(
+            [row.user_id for row in MessageMention.query.filter_by(
+                message_id=message_id)],
+            [self.user1])
+
+    def test_tag_page(self):
+        self.post("Nothing tagged")
+        self.post("About #Flask")
+
+        resp = self.client.get("/tags/FLASK")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('<a href="/tags/flask">#Flask</a>', html)
+        self.assertNotIn("Nothing tagged", html)
+        self.assertNotIn("?before=", html)
+
+    def test_keyset_pages(self):
+        ids = [self.post(f"Number {i} #count") for i in range(5)]
+
+        items, before = readmodels.tag_timeline("count", limit=2)
+        self.assertEqual([item.id for item in items], ids[:2:-1])
+
+        items, before = readmodels.tag_timeline("count", before=before,
+                                                limit=2)
+        self.assertEqual([item.id for item in items], ids[2:0:-1])
+
+        items, before = readmodels.tag_timeline("count", before=before,
+                                                limit=2)
+        self.assertEqual([item.id for item in items], [ids[0]])
+        self.assertIsNone(before)
+
+    def test_mentions_page(self):
+        self.post("Hello @user1")
+        self.post("Hello everyone")
+
+        resp = self.client.get(f"/users/{self.user1}/mentions")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Hello @user1", html)
+        self.assertNotIn("Hello everyone", html)
+
+    def test_delete_forgets(self):
+        message_id = self.post("Bye @user1 #gone")
+
+        self.client.post(f"/messages/{message_id}/delete")
+
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(MessageMention.query.count(), 0)
+
+    def test_purge_forgets(self):
+        self.post("Hi @user1 #purged")
+
+        purge.purge_user(self.user1)
+        self.assertEqual(MessageMention.query.count(), 0)
+
+        purge.purge_user(self.user0)
+        self.assertEqual(MessageTag.query.count(), 0)
+
+    def test_backfill(self):
+        # messages from before the index existed
+        db.session.bulk_insert_mappings(Message, [
+            {'id': snowflake.next_id(), 'text': f"Old #{i % 2} @user1",
+             'user_id': self.user0}
+            for i in range(5)])
+        db.session.commit()
+
+        self.assertEqual(tags.queue_backfill(batch_size=2), 3)
+        self.assertEqual(jobs.work(burst=True), 3)
+
+        self.assertEqual(MessageTag.query.filter_by(tag="0").count(), 3)
+        self.assertEqual(MessageTag.query.filter_by(tag="1").count(), 2)
+        self.assertEqual(MessageMention.query.count(), 5)
+
+        # reindexing adds nothing twice
+        tags.index_messages(shard=0, after=0, through=2 ** 62)
+        self.assertEqual(MessageTag.query.count(), 5)
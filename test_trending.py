@@ -0,0 +1,175 @@
+"""Trending rankings tests."""
+
+import math
+import threading
+from datetime import datetime, timedelta
+from unittest import TestCase
+from app import app, CURR_USER_KEY
+from models import User, Message, TrendingScore, db
+import trending
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class TrendingTestCase(TestCase):
+    """Tests incremental trending scores and the /trending page."""
+
+    def setUp(self):
+        """Adds two users with one message each."""
+
+        db.drop_all()
+        db.create_all()
+
+        user1 = User.signup("user1", "user1@user1.com", "password", None)
+        user2 = User.signup("user2", "user2@user2.com", "password", None)
+        db.session.commit()
+
+        msg1 = Message(text="first", user_id=user1.id)
+        msg2 = Message(text="second", user_id=user2.id)
+        db.session.add_all([msg1, msg2])
+        db.session.commit()
+
+        self.user1_id = user1.id
+        self.user2_id = user2.id
+        self.msg1_id = msg1.id
+        self.msg2_id = msg2.id
+
+    def tearDown(self):
+        """Rollback the data."""
+
+        db.session.rollback()
+
+    def test_like_ranks_message_higher(self):
+        """ a liked message outranks an unliked one posted at the same time """
+
+        msg1 = Message.query.get(self.msg1_id)
+        msg2 = Message.query.get(self.msg2_id)
+        trending.record_message(msg1)
+        trending.record_message(msg2)
+        trending.record_like(msg2)
+        db.session.commit()
+
+        self.assertEqual([m.id for m in trending.top_messages('1h')],
+                         [self.msg2_id, self.msg1_id])
+        self.assertEqual([u.id for u in trending.top_users('1h')],
+                         [self.user2_id, self.user1_id])
+
+    def test_unlike_removes_like_weight(self):
+        """ undoing a like restores the original score """
+
+        msg1 = Message.query.get(self.msg1_id)
+        trending.record_message(msg1)
+        db.session.commit()
+        before = TrendingScore.query.get(('message', self.msg1_id, '24h'))
+        score = before.score
+
+        liked_at = datetime.utcnow()
+        trending.record_like(msg1)
+        trending.record_like(msg1, liked=False, liked_at=liked_at)
+        db.session.commit()
+
+        after = TrendingScore.query.get(('message', self.msg1_id, '24h'))
+        self.assertAlmostEqual(after.score, score, places=6)
+
+    def test_later_unlike_removes_what_the_like_added(self):
+        """ undoing an old like takes away its weight from when it was
+        made, not from now """
+
+        now = datetime.utcnow()
+        posted_at = now - timedelta(hours=3)
+        liked_at = now - timedelta(hours=2)
+        trending._bump('message', self.msg1_id,
+                       trending.MESSAGE_POST_WEIGHT, posted_at)
+        db.session.commit()
+        key = ('message', self.msg1_id, '1h')
+        score = TrendingScore.query.get(key).score
+
+        trending._bump('message', self.msg1_id,
+                       trending.MESSAGE_LIKE_WEIGHT, liked_at)
+        trending.record_like(Message.query.get(self.msg1_id), liked=False,
+                             liked_at=liked_at)
+        db.session.commit()
+
+        after = TrendingScore.query.get(key)
+        self.assertAlmostEqual(after.score, score, places=6)
+        self.assertGreater(after.updated_at, liked_at)
+
+    def test_concurrent_first_bumps(self):
+        """ two first bumps of one target at once both count """
+
+        now = datetime.utcnow()
+        start = threading.Barrier(2)
+        errors = []
+
+        def bump():
+            with app.app_context():
+                try:
+                    start.wait()
+                    trending._bump('message', self.msg1_id, 1.0, now)
+                    db.session.commit()
+                except Exception as exc:
+                    errors.append(exc)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=bump) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        score = TrendingScore.query.get(('message', self.msg1_id, '1h'))
+        self.assertAlmostEqual(
+            score.score,
+            math.log(2) + (now - trending.EPOCH).total_seconds() / 3600,
+            places=6)
+
+    def test_newer_activity_outweighs_older(self):
+        """ equal activity counts less the longer ago it happened """
+
+        now = datetime.utcnow()
+        trending._bump('message', self.msg1_id, 1.0, now - timedelta(hours=6))
+        trending._bump('message', self.msg2_id, 1.0, now)
+        db.session.commit()
+
+        self.assertEqual([m.id for m in trending.top_messages('24h')],
+                         [self.msg2_id, self.msg1_id])
+
+    def test_window_drops_stale_targets(self):
+        """ targets with no activity inside the window are not listed """
+
+        now = datetime.utcnow()
+        trending._bump('message', self.msg1_id, 1.0, now - timedelta(hours=2))
+        db.session.commit()
+
+        self.assertEqual(trending.top_messages('1h'), [])
+        self.assertEqual(len(trending.top_messages('24h')), 1)
+
+    def test_like_route_updates_scores(self):
+        """ liking through the route records trending activity """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            client.post(f"/messages/{self.msg2_id}/like",
+                        headers={"Referer": "/"})
+
+            resp = client.get("/trending")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<!-- Trending HTML Test Comment -->", html)
+            self.assertIn("second", html)
@@ -1,11 +1,12 @@
-import os
-from unittest import TestCase
+from datetime import datetime
 from app import app
+from purge import purge_deleted_users
 from models import (User, Follows, Message, Like, db,
                     DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import exc
+from testing import DatabaseTestCase, USER_IMG_URL
 
 bcrypt = Bcrypt()
 
@@ -18,47 +19,21 @@ app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 # disable CSRF checking for tests to work
 app.config['WTF_CSRF_ENABLED'] = False
 
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler-test'))
 
-USER_IMG_URL = ("https://images.theconversation.com/files/350865/original/file-20200803-24-50u91u.jpg?ixlib=rb-1.1.0&q=45&auto=format&w=1200&h=675.0&fit=crop")
 
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """  Tests User Model  """
 
     def setUp(self):
-        """ Adds sample users """
+        """ Starts from the seeded users """
 
-        # recreates tables
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         #TODO: make passwords different as well
-        # add user data
-        user1 = User.signup("user1",
-                            "user1@user1.com",
-                            "password",
-                            None)
-        user2 = User.signup("user2",
-                            "user2@user2.com",
-                            "password",
-                            USER_IMG_URL)
-
-        db.session.add(user1)
-        db.session.add(user2)
-
-        db.session.commit()
-
-        self.user1_id = user1.id
-        self.user2_id = user2.id
-        self.user1 = user1
-        self.user2 = user2
-
-    def tearDown(self):
-        """Rollback the data."""
-
-        db.session.rollback()
+        self.user1_id = self.user_ids["user1"]
+        self.user2_id = self.user_ids["user2"]
+        self.user1 = User.query.get(self.user1_id)
+        self.user2 = User.query.get(self.user2_id)
 
     def test_user_model(self):
         """Does basic model work?"""
@@ -218,3 +193,40 @@ class UserModelTestCase(TestCase):
             method. 
         """
         self.assertFalse(User.authenticate(self.user1.username, 'passw0rd'))
+
+    def test_purge_user(self):
+        """ purging a deleted user removes their messages, likes and
+        follows in batches """
+
+        self.user1.following.append(self.user2)
+        self.user2.following.append(self.user1)
+        messages = [Message(text=f"msg {i}", user_id=self.user1_id)
+                    for i in range(5)]
+        other = Message(text="other", user_id=self.user2_id)
+        db.session.add_all(messages + [other])
+        db.session.commit()
+
+        db.session.add(Like(message_id=other.id, user_id=self.user1_id))
+        db.session.add(Like(message_id=messages[0].id, user_id=self.user2_id))
+        self.user1.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        self.assertEqual(purge_deleted_users(batch_size=2), 1)
+
+        self.assertIsNone(User.query.get(self.user1_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.user1_id).count(), 0)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Message.query.count(), 1)
+
+    def test_deleted_user_hidden_from_following(self):
+        """ a deleted user drops out of other users' following lists """
+
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        self.user2.deleted_at = datetime.utcnow()
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(self.user1.following, [])
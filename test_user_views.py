@@ -1,12 +1,14 @@
 import os
-from unittest import TestCase
 from app import app, CURR_USER_KEY
+from jobs import work
+import readmodels
 from flask import session
 from models import (User, Follows, Message, Like, db,
                     DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import exc
+from testing import DatabaseTestCase
 
 bcrypt = Bcrypt()
 
@@ -19,41 +21,19 @@ app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 # disable CSRF checking for tests to work
 app.config['WTF_CSRF_ENABLED'] = False
 
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler-test'))
-
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
 
-USER_IMG_URL = ("https://images.theconversation.com/files/350865/original/file-20200803-24-50u91u.jpg?ixlib=rb-1.1.0&q=45&auto=format&w=1200&h=675.0&fit=crop")
-
 
-class UserViewTestCase(TestCase):
+class UserViewTestCase(DatabaseTestCase):
     """  Tests User Views  """
 
     def setUp(self):
-        """ Adds sample users """
-
-        # recreates tables
-        db.drop_all()
-        db.create_all()
+        """ Starts from the seeded users """
 
-        # add user data
-        user1 = User.signup("user1", "user1@user1.com", "password", None)
-        user2 = User.signup("user2", "user2@user2.com",
-                            "password", USER_IMG_URL)
+        super().setUp()
 
-        db.session.add(user1)
-        db.session.add(user2)
-
-        db.session.commit()
-
-        self.user1_id = user1.id
-        self.user2_id = user2.id
-
-    def tearDown(self):
-        """Rollback the data."""
-
-        db.session.rollback()
+        self.user1_id = self.user_ids["user1"]
+        self.user2_id = self.user_ids["user2"]
 
     def test_signup_load_page(self):
         """ Test that signup route properly renders signup page on a
@@ -211,3 +191,101 @@ class UserViewTestCase(TestCase):
             self.assertIn("<!-- Home Anon HTML Test Comment -->", html)
 
             self.assertEqual(len(User.query.all()), 2)
+
+    def test_delete_user_hides_account(self):
+        """ Deleting a user hides the account at once and keeps its rows
+        until they are purged """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            resp = client.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+            resp = client.get(f"/users/{self.user1_id}")
+            self.assertEqual(resp.status_code, 404)
+
+            resp = client.get("/users")
+            html = resp.get_data(as_text=True)
+            self.assertNotIn("@user1<", html)
+            self.assertIn("@user2<", html)
+
+        self.assertIsNotNone(User.query.get(self.user1_id).deleted_at)
+        self.assertFalse(User.authenticate("user1", "password"))
+
+        work(burst=True)
+        self.assertIsNone(User.query.get(self.user1_id))
+
+    def test_show_user_page(self):
+        """ A profile lists the user's messages and their counts, and can
+        be viewed logged out """
+
+        db.session.add(Message(text="profile warble", user_id=self.user1_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get(f"/users/{self.user1_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("profile warble", html)
+            self.assertIn(f'<a href="/users/{self.user1_id}">1</a>', html)
+            self.assertNotIn("like-button", html)
+
+    def test_profile_and_likes_pages_older(self):
+        """ Profiles and likes pages show a page of messages at a time,
+        linking to older ones """
+
+        msgs = [Message(text=f"warble {i}.", user_id=self.user1_id)
+                for i in range(readmodels.PAGE_SIZE + 1)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        db.session.add_all([Like(message_id=msg.id, user_id=self.user2_id)
+                            for msg in msgs])
+        db.session.commit()
+
+        with app.test_client() as client:
+            for url in (f"/users/{self.user1_id}",
+                        f"/users/{self.user2_id}/likes"):
+                html = client.get(url).get_data(as_text=True)
+                self.assertIn(f"warble {readmodels.PAGE_SIZE}.", html)
+                self.assertNotIn("warble 0.", html)
+                self.assertIn(f'{url}?before={msgs[1].id}"', html)
+
+                html = client.get(f"{url}?before={msgs[1].id}").get_data(
+                    as_text=True)
+                self.assertIn("warble 0.", html)
+                self.assertNotIn("warble 1.", html)
+                self.assertNotIn("?before=", html)
+
+    def test_likes_and_following_pages(self):
+        """ The likes and following pages list liked messages and followed
+        users """
+
+        user1 = User.query.get(self.user1_id)
+        user2 = User.query.get(self.user2_id)
+        msg = Message(text="liked warble", user_id=self.user2_id)
+        db.session.add(msg)
+        user1.following.append(user2)
+        db.session.commit()
+        db.session.add(Like(message_id=msg.id, user_id=self.user1_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            html = client.get(f"/users/{self.user1_id}/likes").get_data(
+                as_text=True)
+            self.assertIn("liked warble", html)
+            self.assertIn("fas liked-message", html)
+
+            html = client.get(f"/users/{self.user1_id}/following").get_data(
+                as_text=True)
+            self.assertIn("@user2", html)
+            self.assertIn(f"/users/stop-following/{self.user2_id}", html)
+
+            html = client.get(f"/users/{self.user2_id}/followers").get_data(
+                as_text=True)
+            self.assertIn("@user1", html)
@@ -0,0 +1,217 @@
+"""Username filter tests."""
+
+from unittest import TestCase, mock
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+from bloom import CountingBloomFilter
+from models import User, db
+import purge
+from usernames import username_filter
+from testing import database_url
+
+# Make Flask errors be real errors, not HTML pages with error info
+app.config['TESTING'] = True
+
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# disable CSRF checking for tests to work
+app.config['WTF_CSRF_ENABLED'] = False
+
+# this worker's own database; see testing.py
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+
+
+class CountingBloomFilterTestCase(TestCase):
+    """Tests the filter itself."""
+
+    def test_membership(self):
+        bloom = CountingBloomFilter(1000, 0.01)
+        names = [f"user{i}" for i in range(1000)]
+        for name in names:
+            bloom.add(name)
+
+        self.assertTrue(all(name in bloom for name in names))
+
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_discard(self):
+        bloom = CountingBloomFilter(100)
+        bloom.add("user1")
+        bloom.add("user2")
+
+        bloom.discard("user1")
+
+        self.assertNotIn("user1", bloom)
+        self.assertIn("user2", bloom)
+        self.assertEqual(len(bloom), 1)
+
+
+class UsernameFilterTestCase(TestCase):
+    """Tests the filter of taken names and the routes it short-circuits."""
+
+    def setUp(self):
+        """Adds user1 and builds the filter."""
+
+        db.drop_all()
+        db.create_all()
+
+        user = User.signup("user1", "user1@user1.com", "password", None)
+        db.session.commit()
+        self.user1 = user.id
+
+        self.context = app.app_context()
+        self.context.push()
+        username_filter.rebuild()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.context.pop()
+        db.session.rollback()
+
+    def named_long_ago(self):
+        """user1, as if named before the filter was built, so the filter
+        certainly holds its names."""
+
+        user = User.query.get(self.user1)
+        user.names_changed_at = None
+        db.session.commit()
+        return user
+
+    def count_statements(self, func):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            func()
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+
+        return len(statements)
+
+    def test_is_taken(self):
+        self.assertTrue(username_filter.is_taken("user1", "new@new.com"))
+        self.assertTrue(username_filter.is_taken("new", "user1@user1.com"))
+        self.assertFalse(username_filter.is_taken("new", "new@new.com"))
+
+        self.assertEqual(self.count_statements(
+            lambda: username_filter.is_taken("new", "new@new.com")), 0)
+
+    def test_signup_added(self):
+        User.signup("user2", "user2@user2.com", "password", None)
+        db.session.commit()
+
+        self.assertTrue(username_filter.might_exist("user2"))
+        self.assertTrue(username_filter.might_exist("user2@user2.com"))
+
+    def test_rename(self):
+        user = self.named_long_ago()
+
+        # the old name must be loaded to be removed
+        self.assertEqual(user.username, "user1")
+        user.username = "renamed"
+        db.session.commit()
+
+        self.assertTrue(username_filter.might_exist("renamed"))
+        self.assertFalse(username_filter.might_exist("user1"))
+        self.assertTrue(username_filter.might_exist("user1@user1.com"))
+        self.assertIsNotNone(user.names_changed_at)
+
+    def test_rename_rolled_back(self):
+        user = self.named_long_ago()
+
+        # the old name must be loaded to be removed
+        self.assertEqual(user.username, "user1")
+        user.username = "renamed"
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertTrue(username_filter.might_exist("user1"))
+
+    def test_recent_rename_keeps_old_name(self):
+        """A name set since the last look might not be in the filter, so
+        it isn't removed."""
+
+        user = User.query.get(self.user1)
+        user.username = "renamed"
+        db.session.commit()
+
+        self.assertTrue(username_filter.might_exist("renamed"))
+        self.assertTrue(username_filter.might_exist("user1"))
+
+    def test_sync_finds_other_signups(self):
+        # as if another process signed up user2
+        db.session.bulk_insert_mappings(User, [
+            {'username': "user2", 'email': "user2@user2.com",
+             'password': "x"}])
+        db.session.commit()
+        self.assertFalse(username_filter.might_exist("user2"))
+
+        username_filter.sync()
+
+        self.assertTrue(username_filter.might_exist("user2"))
+
+    def test_sync_holds_lock_while_reading(self):
+        # another sync must wait, or it could move the filter's `since`
+        # past rows this one has yet to add
+        locked = []
+
+        def record(conn, cursor, statement, *args):
+            locked.append(username_filter._lock.locked())
+
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            username_filter.sync()
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+
+        self.assertTrue(locked)
+        self.assertTrue(all(locked))
+
+    def test_purge_frees_names(self):
+        user = self.named_long_ago()
+
+        purge.purge_user(user.id)
+
+        self.assertFalse(username_filter.might_exist("user1"))
+        self.assertFalse(username_filter.might_exist("user1@user1.com"))
+
+    def test_duplicate_signup_not_hashed(self):
+        with mock.patch('models.bcrypt.generate_password_hash') as hash:
+            resp = self.client.post("/signup", data={
+                "username": "user1",
+                "email": "other@other.com",
+                "password": "password"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Username/Email already taken",
+                      resp.get_data(as_text=True))
+        hash.assert_not_called()
+
+    def test_unknown_login_not_queried(self):
+        count = self.count_statements(lambda: self.client.post(
+            "/login", data={"username": "nobody", "password": "password"}))
+
+        self.assertEqual(count, 0)
+
+        resp = self.client.post("/login",
+                                data={"username": "user1",
+                                      "password": "password"})
+        self.assertEqual(resp.status_code, 302)
+
+    def test_username_available(self):
+        resp = self.client.get("/api/username-available?username=user1")
+        self.assertEqual(resp.json, {"username": "user1",
+                                     "available": False})
+
+        resp = self.client.get("/api/username-available?username=user2")
+        self.assertEqual(resp.json, {"username": "user2", "available": True})
+
+        resp = self.client.get("/api/username-available")
+        self.assertEqual(resp.status_code, 400)
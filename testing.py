@@ -0,0 +1,393 @@
+"""Fast, isolated databases for the test suite.
+
+`DatabaseTestCase` runs each test inside a SAVEPOINT that is rolled back
+afterwards, so tests share one database without rebuilding it: nothing a
+test writes, commits included, outlives it. Its database is cloned, once
+per process, from a template holding the schema and SEED_USERS. The
+template is built only when the schema or seeds change, so passwords are
+hashed once rather than for every test.
+
+Each test process has databases of its own, named after its worker (the
+TEST_WORKER environment variable, or pytest-xdist's PYTEST_XDIST_WORKER),
+so test modules can run in parallel:
+
+    python -m testing -j 4                   # every test module
+    python -m testing -j 2 test_user_views   # some of them
+
+Modules not (yet) using `DatabaseTestCase` rebuild their tables in
+`setUp`; they use `database_url()`, the worker's scratch database.
+
+DATABASE_URL names the database the others are named after (default
+postgres:///warbler-test): e.g. warbler-test-template, and for worker w1
+warbler-test-w1 and warbler-test-w1-fixtures. With a sqlite:/// file URL
+the databases are files beside it.
+"""
+
+import argparse
+import fcntl
+import glob
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+from contextlib import contextmanager
+from unittest import TestCase
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import (MetaData, Table, Column, String, create_engine,
+                        event, select)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
+
+DEFAULT_DATABASE_URL = 'postgres:///warbler-test'
+
+USER_IMG_URL = ("https://images.theconversation.com/files/350865/original/file-20200803-24-50u91u.jpg?ixlib=rb-1.1.0&q=45&auto=format&w=1200&h=675.0&fit=crop")
+
+# (username, email, password, image_url) of the users every
+# DatabaseTestCase starts with
+SEED_USERS = [
+    ("user1", "user1@user1.com", "password", None),
+    ("user2", "user2@user2.com", "password", USER_IMG_URL),
+]
+
+# records which schema and seeds the template was built with
+_template_info = Table('test_template', MetaData(),
+                       Column('fingerprint', String(40), primary_key=True))
+
+
+def worker():
+    """This test process's worker name, or None if it is the only one."""
+
+    return (os.environ.get('TEST_WORKER')
+            or os.environ.get('PYTEST_XDIST_WORKER')
+            or None)
+
+
+def _named(url, suffix):
+    """`url` with `suffix` added to its database name (or file name)."""
+
+    url = make_url(url)
+    if url.drivername.startswith('sqlite'):
+        root, ext = os.path.splitext(url.database)
+        url.database = f"{root}{suffix}{ext}"
+    else:
+        url.database = f"{url.database}{suffix}"
+    return str(url)
+
+
+def base_url():
+    return os.environ.get('DATABASE_URL', DEFAULT_DATABASE_URL)
+
+
+def database_url():
+    """The scratch database of this process's worker."""
+
+    name = worker()
+    return _named(base_url(), f"-{name}") if name else base_url()
+
+
+def fixture_url():
+    """The database `DatabaseTestCase` tests run in, for this worker."""
+
+    return _named(database_url(), '-fixtures')
+
+
+def template_url():
+    return _named(base_url(), '-template')
+
+
+def _fingerprint(dialect):
+    """Changes whenever the schema or SEED_USERS do."""
+
+    from models import db
+
+    ddl = [str(CreateTable(table).compile(dialect=dialect))
+           for table in db.metadata.sorted_tables]
+    return hashlib.sha1(repr((ddl, SEED_USERS)).encode()).hexdigest()
+
+
+def _is_sqlite(url):
+    return make_url(url).drivername.startswith('sqlite')
+
+
+@contextmanager
+def _server():
+    """An autocommit connection to the Postgres server's maintenance
+    database, for creating and dropping databases."""
+
+    url = make_url(base_url())
+    url.database = 'postgres'
+    engine = create_engine(url, isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as conn:
+            yield conn
+    finally:
+        engine.dispose()
+
+
+def _quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+@contextmanager
+def _template_lock():
+    """Held while the template is checked or built, so parallel workers
+    build it once."""
+
+    if _is_sqlite(base_url()):
+        with open(make_url(template_url()).database + '.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+    else:
+        with _server() as conn:
+            conn.execute("SELECT pg_advisory_lock(hashtext('test_template'))")
+            try:
+                yield
+            finally:
+                conn.execute(
+                    "SELECT pg_advisory_unlock(hashtext('test_template'))")
+
+
+def _template_fingerprint(engine):
+    """The fingerprint the template at `engine` was built with, or None."""
+
+    try:
+        with engine.connect() as conn:
+            return conn.execute(
+                select([_template_info.c.fingerprint])).scalar()
+    except Exception:
+        return None
+
+
+def prepare_template():
+    """Build the template database, unless it is up to date."""
+
+    from models import db, bcrypt, User
+
+    url = template_url()
+
+    with _template_lock():
+        engine = create_engine(url)
+        fingerprint = _fingerprint(engine.dialect)
+        if _template_fingerprint(engine) == fingerprint:
+            engine.dispose()
+            return
+        engine.dispose()
+
+        if _is_sqlite(url):
+            path = make_url(url).database
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            name = make_url(url).database
+            with _server() as conn:
+                conn.execute(f"DROP DATABASE IF EXISTS {_quote(conn, name)}")
+                conn.execute(f"CREATE DATABASE {_quote(conn, name)}")
+
+        engine = create_engine(url)
+        db.metadata.create_all(bind=engine)
+        _template_info.create(bind=engine)
+
+        # as User.signup() would, but in this session
+        session = sessionmaker(bind=engine)()
+        session.add_all([
+            User(username=username,
+                 email=email,
+                 password=bcrypt.generate_password_hash(password)
+                 .decode('UTF-8'),
+                 image_url=image_url)
+            for username, email, password, image_url in SEED_USERS])
+        session.commit()
+        session.close()
+
+        with engine.begin() as conn:
+            conn.execute(_template_info.insert(), fingerprint=fingerprint)
+        engine.dispose()
+
+
+def clone_template(url):
+    """(Re)create the database at `url` as a copy of the template."""
+
+    if _is_sqlite(url):
+        shutil.copyfile(make_url(template_url()).database,
+                        make_url(url).database)
+        return
+
+    name = make_url(url).database
+    template = make_url(template_url()).database
+    with _server() as conn:
+        conn.execute(f"DROP DATABASE IF EXISTS {_quote(conn, name)}")
+        conn.execute(f"CREATE DATABASE {_quote(conn, name)} "
+                     f"TEMPLATE {_quote(conn, template)}")
+
+
+class _TestSession(SignallingSession):
+    """A session whose work is all done in SAVEPOINTs of the test's
+    transaction: committing releases one and starts the next, rolling
+    back returns to where it began."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._closing = False
+        self.begin_nested()
+
+    def close(self):
+        self._closing = True
+        try:
+            super().close()
+        finally:
+            self._closing = False
+
+
+@event.listens_for(_TestSession, 'after_transaction_end')
+def _restart_savepoint(session, transaction):
+    if (transaction.nested and not transaction._parent.nested
+            and not session._closing):
+        session.expire_all()
+        session.begin_nested()
+
+
+def _sqlite_savepoints(engine):
+    """Let pysqlite's connections run SAVEPOINTs: it would otherwise
+    begin and commit transactions by itself, around them."""
+
+    if event.contains(engine, 'begin', _sqlite_begin):
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _no_implicit_transactions(dbapi_connection, record):
+        dbapi_connection.isolation_level = None
+
+    event.listen(engine, 'begin', _sqlite_begin)
+
+
+def _sqlite_begin(conn):
+    conn.execute("BEGIN")
+
+
+_cloned = set()
+
+
+class DatabaseTestCase(TestCase):
+    """A test case whose tests each run in a SAVEPOINT of one transaction
+    per class, in the worker's clone of the template database.
+
+    `user_ids` maps the usernames of SEED_USERS to their ids. Override
+    `seed()` to add rows every test of the class starts with.
+    """
+
+    user_ids = {}
+
+    @classmethod
+    def setUpClass(cls):
+        from app import app
+        from models import db, User
+        import snowflake
+
+        url = fixture_url()
+        if url not in _cloned:
+            prepare_template()
+            clone_template(url)
+            _cloned.add(url)
+
+        cls._app = app
+        cls._saved_url = app.config['SQLALCHEMY_DATABASE_URI']
+        # the scoped session itself stays, as modules hold on to it;
+        # only the sessions it makes change
+        cls._saved_factory = db.session.registry.createfunc
+        cls._saved_worker_id = snowflake.generator.fixed_worker_id
+
+        db.session.remove()
+        app.config['SQLALCHEMY_DATABASE_URI'] = url
+        engine = db.get_engine(app)
+        if _is_sqlite(url):
+            _sqlite_savepoints(engine)
+
+        # ids are made without leasing a worker id in another transaction
+        snowflake.generator.configure(_worker_number() % 1024)
+
+        cls._connection = engine.connect()
+        cls._transaction = cls._connection.begin()
+        db.session.registry.createfunc = sessionmaker(
+            class_=_TestSession, db=db, bind=cls._connection, binds={})
+
+        with app.app_context():
+            cls.user_ids = dict(db.session.query(User.username, User.id))
+            cls.seed()
+            db.session.commit()
+        db.session.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        from models import db
+        import snowflake
+
+        db.session.remove()
+        cls._transaction.rollback()
+        cls._connection.close()
+
+        db.session.registry.createfunc = cls._saved_factory
+        cls._app.config['SQLALCHEMY_DATABASE_URI'] = cls._saved_url
+        snowflake.generator.configure(cls._saved_worker_id)
+
+    @classmethod
+    def seed(cls):
+        """Add rows for every test of the class to start with; runs once,
+        in an app context."""
+
+    def setUp(self):
+        from models import db
+
+        db.session.remove()
+        self._savepoint = self._connection.begin_nested()
+
+    def tearDown(self):
+        from models import db
+
+        db.session.remove()
+        if self._savepoint.is_active:
+            self._savepoint.rollback()
+
+
+def _worker_number():
+    match = re.search(r'\d+$', worker() or '')
+    return int(match.group()) if match else 0
+
+
+def main(argv=None):
+    """Run test modules in parallel worker processes."""
+
+    parser = argparse.ArgumentParser(
+        prog='python -m testing',
+        description="Run test modules in parallel, each worker process "
+                    "with databases of its own.")
+    parser.add_argument('-j', '--workers', type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument('modules', nargs='*',
+                        help="test modules (default: all test_*.py)")
+    args = parser.parse_args(argv)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    modules = [os.path.splitext(os.path.basename(module))[0]
+               for module in (args.modules
+                              or sorted(glob.glob(os.path.join(
+                                  here, 'test_*.py'))))]
+
+    # built once here rather than raced for by the workers
+    prepare_template()
+
+    groups = [modules[i::args.workers] for i in range(args.workers)]
+    workers = [subprocess.Popen([sys.executable, '-m', 'unittest', *group],
+                                cwd=here,
+                                env={**os.environ, 'TEST_WORKER': f"w{i}"})
+               for i, group in enumerate(groups) if group]
+
+    failed = [process for process in workers if process.wait()]
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""Incrementally maintained trending rankings for messages and users.
+
+Every recorded event adds `weight * exp((t - EPOCH) / tau)` to a target's
+score for each window, which is equivalent to decaying all older activity
+by `exp(-age / tau)`. Scores are stored in log space (see TrendingScore) so
+they never overflow and never need to be rewritten as time passes: ranking
+by the stored score is the same as ranking by current decayed activity.
+"""
+
+import math
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql
+
+from models import db, TrendingScore, User
+import readmodels
+
+EPOCH = datetime(2021, 1, 1)
+
+WINDOWS = {
+    '1h': timedelta(hours=1),
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7),
+}
+DEFAULT_WINDOW = '24h'
+
+MESSAGE_POST_WEIGHT = 1.0
+MESSAGE_LIKE_WEIGHT = 2.0
+USER_POST_WEIGHT = 1.0
+USER_LIKE_WEIGHT = 2.0
+
+# Postgres raises on exp() underflow, so log_add in SQL stops here: what
+# it leaves out is below double precision anyway
+MIN_EXPONENT = -700
+
+
+def _log_add(a, b):
+    """Return log(exp(a) + exp(b)) without overflowing."""
+
+    if a is None:
+        return b
+
+    hi, lo = max(a, b), min(a, b)
+    return hi + math.log1p(math.exp(lo - hi))
+
+
+def _log_sub(a, b):
+    """Return log(exp(a) - exp(b)), or None when nothing is left."""
+
+    if a is None or b >= a:
+        return None
+
+    return a + math.log1p(-math.exp(b - a))
+
+
+def _add(kind, target_id, window, delta, now):
+    """Add `delta` (in log space) to a score, creating its row if need be.
+
+    Concurrent first adds can't both insert: Postgres merges them in one
+    upsert; SQLite inserts the row unless it exists, then updates it.
+    """
+
+    table = TrendingScore.__table__
+    row = dict(kind=kind, target_id=target_id, window=window,
+               score=delta, updated_at=now)
+
+    # rows changed through the ORM go first
+    db.session.flush()
+
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(row)
+        hi = func.greatest(table.c.score, statement.excluded.score)
+        lo = func.least(table.c.score, statement.excluded.score)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.kind, table.c.target_id, table.c.window],
+            set_={'score': hi + func.ln(
+                      1 + func.exp(func.greatest(lo - hi, MIN_EXPONENT))),
+                  'updated_at': statement.excluded.updated_at}))
+        return
+
+    inserted = db.session.execute(
+        table.insert().prefix_with('OR IGNORE').values(row)).rowcount
+    if not inserted:
+        score = (TrendingScore
+                 .query
+                 .filter_by(kind=kind, target_id=target_id, window=window)
+                 .with_for_update()
+                 .populate_existing()
+                 .one())
+        score.score = _log_add(score.score, delta)
+        score.updated_at = now
+
+
+def _bump(kind, target_id, weight, now=None, at=None):
+    """Add (or, with a negative weight, remove) activity for a target that
+    happened `at` (default: `now`).
+
+    Removing takes away exactly what adding the same weight `at` the same
+    time added. Rows are upserted, or updated under a row lock, so
+    concurrent writers don't lose each other's increments; callers commit.
+    """
+
+    now = now or datetime.utcnow()
+    elapsed = ((at or now) - EPOCH).total_seconds()
+
+    for window, span in WINDOWS.items():
+        delta = math.log(abs(weight)) + elapsed / span.total_seconds()
+
+        if weight > 0:
+            _add(kind, target_id, window, delta, now)
+            continue
+
+        row = (TrendingScore
+               .query
+               .filter_by(kind=kind, target_id=target_id, window=window)
+               .with_for_update()
+               .populate_existing()
+               .one_or_none())
+
+        if row:
+            score = _log_sub(row.score, delta)
+            if score is None:
+                db.session.delete(row)
+            else:
+                row.score = score
+                row.updated_at = now
+
+
+def record_message(msg):
+    """Record a newly posted message for its own and its author's score."""
+
+    _bump('message', msg.id, MESSAGE_POST_WEIGHT)
+    _bump('user', msg.user_id, USER_POST_WEIGHT)
+
+
+def record_like(msg, liked=True, count=1, liked_at=None):
+    """Record a like on `msg`; with `count`, that many at once.
+
+    With `liked=False`, undo likes made at `liked_at` (their
+    `Like.created_at`), taking away the weight they added then. Likes from
+    before that was recorded are left to decay.
+    """
+
+    if liked:
+        _bump('message', msg.id, count * MESSAGE_LIKE_WEIGHT)
+        _bump('user', msg.user_id, count * USER_LIKE_WEIGHT)
+    elif liked_at is not None:
+        _bump('message', msg.id, -count * MESSAGE_LIKE_WEIGHT, at=liked_at)
+        _bump('user', msg.user_id, -count * USER_LIKE_WEIGHT, at=liked_at)
+
+
+def forget_message(message_id):
+    """Drop all scores of a deleted message."""
+
+    (TrendingScore
+     .query
+     .filter_by(kind='message', target_id=message_id)
+     .delete(synchronize_session=False))
+
+
+def top_messages(window=DEFAULT_WINDOW, limit=20, now=None):
+    """Return the `limit` hottest messages for `window`, hottest first, as
+    timeline items (see readmodels.py)."""
+
+    now = now or datetime.utcnow()
+
+    message_ids = [id for (id,) in (
+        db.session
+        .query(TrendingScore.target_id)
+        .filter(TrendingScore.kind == 'message',
+                TrendingScore.window == window,
+                TrendingScore.updated_at >= now - WINDOWS[window])
+        .order_by(TrendingScore.score.desc())
+        .limit(limit))]
+
+    # messages may be on any shard; those by deleted users are left out
+    return readmodels.messages_by_id(message_ids)
+
+
+def top_users(window=DEFAULT_WINDOW, limit=20, now=None):
+    """Return the `limit` most active users for `window`, most active first."""
+
+    now = now or datetime.utcnow()
+
+    return (User
+            .query
+            .join(TrendingScore, TrendingScore.target_id == User.id)
+            .filter(User.deleted_at.is_(None),
+                    TrendingScore.kind == 'user',
+                    TrendingScore.window == window,
+                    TrendingScore.updated_at >= now - WINDOWS[window])
+            .order_by(TrendingScore.score.desc())
+            .limit(limit)
+            .all())
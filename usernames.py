@@ -0,0 +1,239 @@
+"""An in-memory filter of the usernames and emails that are taken.
+
+`username_filter` answers "might this name be taken?" without a query: a
+name it has never seen is certainly free. Signup uses it to turn away a
+duplicate before hashing the password, login to reject an unknown
+username without looking it up, and `/api/username-available` to answer
+most checks from memory. When the filter says a name might be taken, an
+exact query decides.
+
+Each process builds its filter from the users table on first use and
+rebuilds it every USERNAME_FILTER_REBUILD_INTERVAL seconds. In between,
+names this process signs up or renames to are added as they are flushed,
+and every USERNAME_FILTER_SYNC_INTERVAL seconds it adds the names of users
+whose `names_changed_at` is newer than its last look, which catches
+signups and renames made by other processes. Names of deleted accounts
+stay taken until the account is purged.
+
+Names given up by a rename or a purge are removed after commit, but only
+when the filter certainly holds them, since removing a name it doesn't
+hold could remove another one with it. Any other old name lingers as a
+false positive, costing a query, until the next rebuild.
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event, func, inspect, or_
+from sqlalchemy.orm import Session, object_session
+
+from bloom import CountingBloomFilter
+from models import db, User
+
+BATCH_SIZE = 1000
+
+# a transaction that changes a user's names is assumed to commit within
+# this long of stamping `names_changed_at`, clock skew included
+SYNC_OVERLAP = timedelta(minutes=5)
+
+# session.info key of the names to remove once the session commits
+_FORGET_KEY = 'usernames_forget'
+
+
+class UsernameFilter:
+    """A counting Bloom filter of taken usernames and emails, kept up to
+    date with the users table."""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        # counts rebuilds, so names held by an older filter aren't
+        # removed from a newer one
+        self._generation = 0
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('USERNAME_FILTER_CAPACITY', 100000)
+        app.config.setdefault('USERNAME_FILTER_ERROR_RATE', 0.01)
+        app.config.setdefault('USERNAME_FILTER_SYNC_INTERVAL', 30)
+        app.config.setdefault('USERNAME_FILTER_REBUILD_INTERVAL', 60 * 60)
+
+    def reset(self):
+        """Forget the filter; it is rebuilt on next use."""
+
+        with self._lock:
+            self._filter = None
+            self._generation += 1
+            # names added while a rebuild runs, or None
+            self._pending = None
+            # users whose names changed before this (less SYNC_OVERLAP)
+            # are in the filter
+            self._since = None
+            self._built_at = self._synced_at = 0
+
+    def rebuild(self):
+        """Build a new filter from every user, deleted ones included."""
+
+        with self._lock:
+            if self._pending is not None:
+                # another thread is at it
+                return
+            self._pending = []
+
+        try:
+            config = current_app.config
+            started = datetime.utcnow()
+
+            count = db.session.query(func.count(User.id)).scalar()
+            bloom = CountingBloomFilter(
+                max(config['USERNAME_FILTER_CAPACITY'], 4 * count),
+                config['USERNAME_FILTER_ERROR_RATE'])
+
+            for username, email in (db.session
+                                    .query(User.username, User.email)
+                                    .yield_per(BATCH_SIZE)):
+                bloom.add(username)
+                bloom.add(email)
+
+            with self._lock:
+                for name in self._pending:
+                    bloom.add(name)
+
+                self._filter = bloom
+                self._generation += 1
+                self._since = started
+                self._built_at = self._synced_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def sync(self):
+        """Add the names of users whose names changed since the last look.
+
+        Holds the lock from reading `_since` to moving it on, so that two
+        syncs can't move it past names neither of them added.
+        """
+
+        with self._lock:
+            if self._filter is None:
+                # reset meanwhile; the next use rebuilds it
+                return
+
+            started = datetime.utcnow()
+            self._synced_at = time.monotonic()
+
+            rows = (db.session
+                    .query(User.username, User.email)
+                    .filter(User.names_changed_at > self._since - SYNC_OVERLAP)
+                    .all())
+
+            for names in rows:
+                for name in names:
+                    self._filter.add(name)
+            self._since = max(self._since, started)
+
+    def _current(self):
+        """The filter, rebuilt or synced first if it is due; None while
+        another thread builds the first one."""
+
+        config = current_app.config
+        now = time.monotonic()
+
+        if (self._filter is None or now - self._built_at
+                > config['USERNAME_FILTER_REBUILD_INTERVAL']):
+            self.rebuild()
+        elif now - self._synced_at > config['USERNAME_FILTER_SYNC_INTERVAL']:
+            self.sync()
+
+        return self._filter
+
+    def might_exist(self, name):
+        """False if no user has `name` as their username or email."""
+
+        bloom = self._current()
+        return bloom is None or name in bloom
+
+    def is_taken(self, username=None, email=None):
+        """Whether a user (deleted or not) has `username` or `email`.
+
+        Only queries if the filter says either might be taken.
+        """
+
+        criteria = [column == value
+                    for column, value in ((User.username, username),
+                                          (User.email, email))
+                    if value is not None and self.might_exist(value)]
+        if not criteria:
+            return False
+
+        return db.session.query(
+            User.query.filter(or_(*criteria)).exists()).scalar()
+
+    def add(self, *names):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.extend(names)
+            if self._filter is not None:
+                for name in names:
+                    self._filter.add(name)
+
+    def forget_on_commit(self, session, names, changed_at):
+        """Remove `names`, last changed at `changed_at`, once `session`
+        commits, if the filter certainly holds them."""
+
+        with self._lock:
+            if self._filter is None or (
+                    changed_at is not None
+                    and changed_at > self._since - SYNC_OVERLAP):
+                return
+            generation = self._generation
+
+        session.info.setdefault(_FORGET_KEY, []).append((generation, names))
+
+    def _forget(self, generation, names):
+        with self._lock:
+            # a rebuild since may not have had them
+            if generation != self._generation:
+                return
+            for name in names:
+                self._filter.discard(name)
+
+
+username_filter = UsernameFilter()
+
+
+@event.listens_for(User, 'after_insert')
+def _user_added(mapper, connection, user):
+    username_filter.add(user.username, user.email)
+
+
+@event.listens_for(User, 'before_update')
+def _user_renaming(mapper, connection, user):
+    state = inspect(user)
+    changes = [attr.history
+               for attr in (state.attrs.username, state.attrs.email)
+               if attr.history.has_changes()]
+    if not changes:
+        return
+
+    username_filter.forget_on_commit(
+        object_session(user),
+        [name for history in changes for name in history.deleted],
+        user.names_changed_at)
+    user.names_changed_at = datetime.utcnow()
+    username_filter.add(*[name for history in changes
+                          for name in history.added])
+
+
+@event.listens_for(Session, 'after_commit')
+def _forget_names(session):
+    for generation, names in session.info.pop(_FORGET_KEY, []):
+        username_filter._forget(generation, names)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_names(session):
+    session.info.pop(_FORGET_KEY, None)